@@ -7,3 +7,7 @@ admin.site.register(models.Offer)
 admin.site.register(models.Currency)
 admin.site.register(models.ExchangeRate)
 
+admin.site.register(models.LoadCheckpoint)
+admin.site.register(models.LoadManifest)
+admin.site.register(models.BatchSummary)
+admin.site.register(models.ArchivedRow)
@@ -0,0 +1,329 @@
+'''
+Archival of the rows that are done with.
+
+The rows of a processed batch that are processed (state 2) or ignored errors
+(state 4) are only history, yet they stay in the staging tables for good and
+every index and list view gets slower.  Here the rows of the processed
+batches older than a retention window (`HQ_DW_ARCHIVE_DAYS`, default 30) are
+moved out, in one of these ways:
+
+*   `table`: into `ArchivedRow`, the input fields as a CSV line.
+*   `file`: into a gzipped CSV file per table and batch, in a directory
+    (`HQ_DW_ARCHIVE_DIR`).  The columns are the id, the batch, the insert
+    date, whether the row was ignored and its fields in error, followed by
+    the columns of the input file.  Every chunk is a gzip member of its own,
+    appended to the file and synced before the rows are deleted.  If the
+    deletion fails the chunk is written again by the next run: the rows of
+    a chunk may appear twice in a file, never zero times.
+*   `delete`: nowhere, the rows are just deleted.
+*   `detach`: only for tables partitioned by batch (see `partitions`), the
+    partition of the batch is detached and kept as a table of its own.
+
+The rows in the other states are left alone, even in processed batches.  But
+when the table is partitioned and all rows of the batch are processed or
+ignored the `delete` mode drops the partition of the batch, and the `detach`
+mode skips the batches that still have other rows.
+
+Nothing is done in one go.  The rows are moved in chunks of consecutive
+primary keys, every chunk is read (locked, where the database does that),
+written out and deleted in its own short transaction together with the change
+of the `BatchSummary`.  The loads only ever write into batches that are not
+processed, so an archival can run while they are going, it only competes with
+them for the locks of a chunk at a time.  And it does not hog them either,
+after every chunk it pauses for as long as the chunk took (times
+`HQ_DW_ARCHIVE_SLEEP`, default 1).
+
+`drop_batch` invalidates a batch, it deletes the rows in every state the same
+way (or drops the partitions).
+
+This module imports the models, only import it after django.setup().
+'''
+
+import os, io, csv, gzip, time, datetime, collections
+
+from django.conf import settings
+from django.db import transaction, connections, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from pytz import timezone
+
+from . import models, loader, sizing, processing, bulk, partitions, caching
+
+
+MODES = [ 'table' , 'file' , 'delete' , 'detach' ]
+
+
+def retention():
+    return getattr(settings, 'HQ_DW_ARCHIVE_DAYS', 30)
+
+def batches(days=None, batch=None):
+    '''
+    The ids of the processed batches created more than `days` days ago, or
+    only the given `batch` if it is one of them.
+    '''
+    if days is None:
+        days = retention()
+    tz = timezone(settings.TIME_ZONE)
+    cutoff = tz.localize(datetime.datetime.now()) \
+           - datetime.timedelta(days=days)
+    q = models.Batch.objects.filter(processed=True, date_created__lt=cutoff)
+    if batch is not None:
+        q = q.filter(id=batch)
+    return list(q.order_by('id').values_list('id', flat=True))
+
+def archivable(model, batch):
+    '''
+    The rows of the batch that are processed or ignored.
+    '''
+    return model.objects.filter( Q(**models.ROW_STATES['processed'])
+                               | Q(**models.ROW_STATES['ignored'])
+                               , batch_id=batch )
+
+def csv_line(values):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerow(values)
+    return out.getvalue()[:-1]
+
+
+class TableSink(object):
+    '''
+    Writes the rows into `ArchivedRow`, with `bulk.insert_rows` (COPY on
+    PostgreSQL).  The rows of a load share their insert date, it is made
+    ready for the database once.
+    '''
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        tz = timezone(settings.TIME_ZONE)
+        self.connection = connections[using]
+        self.field = models.ArchivedRow._meta.get_field('insert_date')
+        self.now = self.prepare(tz.localize(datetime.datetime.now()))
+        self.dates = {}
+        self.columns = [ 'table' , 'row_id' , 'batch_id' , 'insert_date'
+                       , 'ignore' , 'fields_in_error' , 'data'
+                       , 'date_archived' ]
+
+    def prepare(self, date):
+        return self.field.get_db_prep_save(date, self.connection)
+
+    def write(self, spec, batch, rows):
+        dates = self.dates
+        for row in rows:
+            if not row[1] in dates:
+                dates[row[1]] = self.prepare(row[1])
+        bulk.insert_rows( models.ArchivedRow, self.columns
+                        , [ ( spec.table, row[0], batch, dates[row[1]]
+                            , row[4], row[5], csv_line(row[6:]), self.now )
+                            for row in rows ]
+                        , self.connection.alias )
+
+
+class FileSink(object):
+    '''
+    Appends the rows to `<directory>/<table>-<batch>.csv.gz`.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, spec, batch):
+        name = '%s-%i.csv.gz' % (spec.table, batch)
+        return os.path.join(self.directory, name)
+
+    def write(self, spec, batch, rows):
+        path = self.path(spec, batch)
+        new = not os.path.exists(path)
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as z:
+                text = io.TextIOWrapper(z, encoding='utf-8', newline='')
+                out = csv.writer(text, lineterminator='\n')
+                if new:
+                    out.writerow( [ 'id' , 'batch' , 'insert_date' , 'ignored'
+                                  , 'fields_in_error' ] + spec.infields )
+                for row in rows:
+                    out.writerow( [ row[0] , batch , row[1].isoformat()
+                                  , int(row[4]) , row[5] or '' ]
+                                + list(row[6:]) )
+                text.flush()
+                text.detach()
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+class DeleteSink(object):
+    '''
+    Throws the rows away.
+    '''
+    def write(self, spec, batch, rows):
+        pass
+
+
+def sink(mode, directory=None):
+    '''
+    Where the rows go in the `mode`, the `file` mode needs a `directory`
+    (default `HQ_DW_ARCHIVE_DIR`).  Raises ValueError if that is missing.
+    '''
+    if 'table' == mode:
+        return TableSink()
+    if mode in ('delete', 'detach'):
+        return DeleteSink()
+    if not 'file' == mode:
+        raise ValueError('no such mode: %s' % mode)
+    directory = directory or getattr(settings, 'HQ_DW_ARCHIVE_DIR', None)
+    if not directory or not os.path.isdir(directory):
+        raise ValueError('no archive directory: %s' % directory)
+    return FileSink(directory)
+
+def archive_table( spec, batch, out, chunk, pause=None, progress=None
+                 , everything=False ):
+    '''
+    Move the processed and ignored rows (or, with `everything`, all rows) of
+    the table in the batch to `out`, `chunk` rows at a time.  After every
+    chunk we wait `pause` (default `HQ_DW_ARCHIVE_SLEEP`, or 1) times as long
+    as the chunk took.  Returns a counter of the rows moved by state.
+    '''
+    if pause is None:
+        pause = getattr(settings, 'HQ_DW_ARCHIVE_SLEEP', 1.0)
+    model = spec.model
+    states = list(models.ROW_STATES) if everything \
+             else [ 'processed' , 'ignored' ]
+    todo = sum( models.BatchSummary.count_rows(model, x, batch)
+                for x in states )
+    rows = model.objects.filter(batch_id=batch) if everything \
+           else archivable(model, batch)
+    values = rows.select_for_update().order_by('id').values_list(
+          'id', 'insert_date', 'processed', 'in_error', 'ignore'
+        , 'fields_in_error', *spec.infields )
+    summary = models.BatchSummary.objects.filter(
+        batch_id=batch, table=model._meta.model_name )
+    tz = timezone(settings.TIME_ZONE)
+    last = 0
+    done = collections.Counter()
+    while True:
+        began = time.time()
+        with transaction.atomic():
+            # start with a write, as the loads do: on SQLite a transaction
+            # that reads first cannot take the write lock while a load holds
+            # it and fails at once instead of waiting its turn
+            summary.update(date_updated=tz.localize(datetime.datetime.now()))
+            rows = list(values.filter(id__gt=last)[:chunk])
+            if not rows:
+                break
+            out.write(spec, batch, rows)
+            ids = [ row[0] for row in rows ]
+            for start in range(0, len(ids), processing.ID_BATCH):
+                model.objects.filter(
+                    id__in=ids[start:start+processing.ID_BATCH] ).delete()
+            moved = collections.Counter( models.row_state(*row[2:5])
+                                       for row in rows )
+            models.BatchSummary.add(
+                model, batch, dict( (k, -v) for k, v in moved.items() ) )
+        # give the loads their turn at the locks
+        time.sleep(pause * (time.time() - began))
+        done.update(moved)
+        last = rows[-1][0]
+        if progress:
+            progress( '%s (batch %i)' % (spec.table, batch)
+                    , sum(done.values()), todo )
+    # an empty summary is the same as none, as `reconcile` would leave it
+    summary.filter( pending=0, processed=0, in_error=0, ignored=0 ).delete()
+    return done
+
+def drop_partition(spec, batch, mode, everything=False):
+    '''
+    Drop (`delete` mode) or detach (`detach` mode) the partition of the table
+    of the batch, in one go, together with its summary.  Unless `everything`
+    goes, only if all its rows are processed or ignored.  Returns a counter
+    of the rows by state (from the summary), or None if the partition has
+    other rows.
+    '''
+    model = spec.model
+    summary = models.BatchSummary.objects.filter(
+        batch_id=batch, table=model._meta.model_name )
+    with transaction.atomic():
+        if not everything and processing.eligible(model, batch).exists():
+            return None
+        counts = collections.Counter()
+        for x in summary.select_for_update():
+            counts.update(dict( (k, getattr(x, k))
+                                for k in models.ROW_STATES ))
+        if 'detach' == mode:
+            partitions.detach(model, batch)
+        else:
+            partitions.drop(model, batch)
+        summary.delete()
+        caching.bump(batch)
+    return counts
+
+def archive( mode='table', days=None, batch=None, tables=None, chunk=None
+           , directory=None, dry_run=False, pause=None, progress=None ):
+    '''
+    Archive the processed and ignored rows of the `tables` (all tables by
+    default) of the processed batches older than `days` (or only of the
+    `batch`).  With `dry_run` the rows are only counted.  See `archive_table`
+    for the `pause`.
+
+    Returns an ordered dictionary from batch and table to the numbers of
+    processed and ignored rows archived (or that would be archived).
+    '''
+    out = sink(mode, directory)
+    if tables is None:
+        tables = sorted(loader.TABLES.keys())
+    if 'detach' == mode:
+        flat = [ x for x in tables
+                 if not partitions.partitioned(loader.TABLES[x].model) ]
+        if flat:
+            raise ValueError('not partitioned: %s' % ', '.join(flat))
+    chunk = chunk or sizing.fixed_size()
+    counts = collections.OrderedDict()
+    for b in batches(days, batch):
+        for table in tables:
+            spec = loader.TABLES[table]
+            whole = mode in ('delete', 'detach') \
+                    and partitions.partitioned(spec.model)
+            if dry_run:
+                if whole and 'detach' == mode \
+                   and processing.eligible(spec.model, b).exists():
+                    counts[(b, table)] = None
+                    continue
+                rows = archivable(spec.model, b)
+                counts[(b, table)] = ( rows.filter(ignore=False).count()
+                                     , rows.filter(ignore=True).count() )
+                continue
+            moved = None
+            if whole:
+                moved = drop_partition(spec, b, mode)
+            if moved is None and not 'detach' == mode:
+                moved = archive_table(spec, b, out, chunk, pause, progress)
+            if moved is not None:
+                moved = (moved['processed'], moved['ignored'])
+            counts[(b, table)] = moved
+    return counts
+
+def drop_batch( batch, tables=None, chunk=None, dry_run=False, pause=None
+              , progress=None ):
+    '''
+    Invalidate a batch: delete all its rows from the `tables` (all tables by
+    default) and mark it processed, nothing can be loaded into it anymore.
+    The partitions of a partitioned table are dropped, from the other tables
+    the rows are deleted in chunks as the archival does.  With `dry_run` the
+    rows are only counted.
+
+    Returns an ordered dictionary from table to the number of rows deleted
+    (or that would be deleted).
+    '''
+    if tables is None:
+        tables = sorted(loader.TABLES.keys())
+    chunk = chunk or sizing.fixed_size()
+    counts = collections.OrderedDict()
+    if not dry_run:
+        models.Batch.objects.filter(id=batch).update(processed=True)
+        caching.bump(batch)
+    for table in tables:
+        spec = loader.TABLES[table]
+        if dry_run:
+            counts[table] = spec.model.objects.filter(batch_id=batch).count()
+        elif partitions.partitioned(spec.model):
+            moved = drop_partition(spec, batch, 'delete', everything=True)
+            counts[table] = sum(moved.values())
+        else:
+            moved = archive_table( spec, batch, DeleteSink(), chunk, pause
+                                 , progress, everything=True )
+            counts[table] = sum(moved.values())
+    return counts
@@ -0,0 +1,10 @@
+'''
+Benchmarks of the staging area.
+
+*   `generate`: deterministic synthetic CSV files in the layouts of the real
+    input files.
+*   `load`: throughput of the loader over generated files.
+*   `queries`: plans and latencies of the queries on large staging tables.
+
+Only `generate` can be imported before django is set up.
+'''
@@ -0,0 +1,120 @@
+'''
+Deterministic generator of CSV files for the staging tables.
+
+The files have the quirks of the real input (see the `loader` module): the
+currency file has a header and a dummy row, the exchange rate file a header
+only and the offer file a dummy row only.  A share of the rows is short (the
+loader pads them) and another share is overlong (on the offer table the first
+extra column goes into `dummy_field`).  Some fields are quoted because they
+contain commas, quotes or newlines.
+
+The same table, number of rows and seed always give the same file.
+
+Do not import django (or models) here, the generator is useful on its own.
+'''
+
+import io, csv, gzip, random, datetime
+
+
+CODES = [ 'GBP' , 'USD' , 'EUR' , 'THB' , 'JPY' , 'SGD' , 'HKD' , 'AUD' ]
+WORDS = [ 'Pound' , 'Dollar' , 'Euro' , 'Baht' , 'Yen' , 'Sterling'
+        , 'Hong Kong' , 'Singapore' , 'Australian' , 'New' , 'Old' ]
+START = datetime.date(2016, 1, 1)
+
+
+def day(rnd, days=365):
+    return (START + datetime.timedelta(days=rnd.randrange(days))).isoformat()
+
+def currency_row(rnd, i):
+    name = ' '.join(rnd.choice(WORDS) for x in range(rnd.randint(1, 3)))
+    if rnd.random() < 0.01:
+        name += rnd.choice([ ', "old"' , '\nsecond line' ])
+    return [ str(i), rnd.choice(CODES), name ]
+
+def exchange_rate_row(rnd, i):
+    return [ str(i), str(rnd.randint(1, 200)), str(rnd.randint(1, 200))
+           , day(rnd), '%.4f' % rnd.uniform(0.001, 1000) ]
+
+def offer_row(rnd, i):
+    checkin = START + datetime.timedelta(days=rnd.randrange(365))
+    checkout = checkin + datetime.timedelta(days=rnd.randint(1, 14))
+    price = rnd.uniform(10, 5000)
+    if rnd.random() < 0.05:
+        price = '{:,.2f}'.format(price)  # with a comma, must be quoted
+    else:
+        price = '%.2f' % price
+    return [ str(i), str(rnd.randint(1, 100000)), str(rnd.randint(1, 200))
+           , rnd.choice([ 'SYS' , 'EXT' , 'AGG' ]), str(rnd.randint(0, 20))
+           , price, checkin.isoformat(), checkout.isoformat()
+           , rnd.choice('01'), day(rnd), day(rnd), rnd.choice('01')
+           , day(rnd) + ' %02i:%02i:%02i' % ( rnd.randrange(24)
+                                             , rnd.randrange(60)
+                                             , rnd.randrange(60) ) ]
+
+# header, dummy row and row generator of every table
+LAYOUTS = {
+      'currency' : (
+          [ 'id' , 'code' , 'name' ]
+        , [ '0' , 'XXX' , 'dummy' ]
+        , currency_row )
+    , 'exchange-rate' : (
+          [ 'id' , 'primary' , 'secondary' , 'date' , 'rate' ]
+        , None
+        , exchange_rate_row )
+    , 'offer' : (
+          None
+        , [ '0' , 'dummy' ] + [ '' ] * 11
+        , offer_row )
+    }
+
+
+def rows(table, count, seed=0, short=0.01, overlong=0.01):
+    '''
+    Iterate over the rows of a file of the table, with `count` data rows
+    after the header and dummy rows.  A share of `short` rows is cut and a
+    share of `overlong` rows gets extra columns.
+    '''
+    header, dummy, make = LAYOUTS[table]
+    rnd = random.Random(seed)
+    if header:
+        yield header
+    if dummy:
+        yield dummy
+    for i in range(1, count + 1):
+        row = make(rnd, i)
+        odd = rnd.random()
+        if odd < short:
+            row = row[:rnd.randint(1, len(row) - 1)]
+        elif odd < short + overlong:
+            row += [ 'extra %i' % x for x in range(rnd.randint(1, 3)) ]
+        yield row
+
+def generate(table, path, count, seed=0, short=0.01, overlong=0.01):
+    '''
+    Write a CSV file for the table in the UNIX dialect read by the loader,
+    gzip compressed if the path ends in `.gz`.  Returns the number of
+    characters written (before compression).
+    '''
+    if path.endswith('.gz'):
+        out = gzip.open(path, 'wt', newline='')
+    else:
+        out = io.open(path, 'w', newline='')
+    with out:
+        counter = Counter(out)
+        writer = csv.writer( counter, delimiter=',', quotechar='"'
+                           , lineterminator='\n' )
+        writer.writerows(rows(table, count, seed, short, overlong))
+    return counter.size
+
+
+class Counter(object):
+    '''
+    Forwards writes to a file and counts the characters written.
+    '''
+    def __init__(self, out):
+        self.out = out
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.out.write(data)
@@ -0,0 +1,113 @@
+'''
+Throughput of the loader.
+
+Files of the requested sizes are generated (see `generate`) and loaded into a
+fresh test database, once per table, number of rows, engine and commit size.
+Every run reports the rows per second, the time spent in each phase of the
+load (see `loadstats`), the peak resident memory of the process and the number
+of statements sent to the database (per commit).  The results
+come with the versions of everything involved, as JSON, so that the numbers
+of two releases can be compared.
+
+The database is the configured one (its test database, that is), to compare
+SQLite and PostgreSQL run the benchmark once with each in the settings.  COPY
+statements of the `copy` engine on PostgreSQL do not go through the Django
+cursor and are not counted.
+
+The peak resident memory is the peak of the whole process so far, run the
+sizes in increasing order (as we do) for it to mean something.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import os, sys, platform, resource, contextlib
+
+import django
+from django.db import connection
+
+import hq_stage
+from .. import models, loader
+from ..loadstats import LoadStats
+from . import generate
+from .queries import test_database
+
+
+def peak_rss():
+    '''
+    Peak resident memory of the process in KiB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if 'darwin' == sys.platform:
+        peak //= 1024  # bytes there
+    return peak
+
+def csv_path(work_dir, table, rows, seed):
+    '''
+    Generate the file unless we did already, the same arguments always give
+    the same file.
+    '''
+    path = os.path.join(work_dir, '%s-%i-%i.csv' % (table, rows, seed))
+    if not os.path.exists(path):
+        generate.generate(table, path + '.part', rows, seed)
+        os.rename(path + '.part', path)
+    return path
+
+def load_once(table, csv_file, engine, commit_size, work_dir):
+    '''
+    Load the file into a fresh test database and measure it.
+    '''
+    sqlite_file = os.path.join(work_dir, 'bench.sqlite3')
+    with test_database(sqlite_file):
+        batch = models.Batch()
+        batch.save()
+        with open(os.devnull, 'w') as devnull, \
+             contextlib.redirect_stdout(devnull):
+            stats = LoadStats(table)
+            loaded = loader.load( loader.TABLES[table], csv_file, batch
+                                , engine, stats=stats
+                                , commit_size=commit_size )
+            stats = stats.as_dict()
+    chunks = stats['chunks']
+    seconds = stats['seconds']
+    return {
+          'table' : table
+        , 'rows' : loaded
+        , 'engine' : engine
+        , 'commit_size' : commit_size
+        , 'file_bytes' : os.path.getsize(csv_file)
+        , 'seconds' : round(seconds, 3)
+        , 'rows_per_s' : round(loaded / seconds, 1) if seconds else None
+        , 'peak_rss_kb' : peak_rss()
+        , 'queries' : stats['queries']
+        , 'queries_per_commit' : round(stats['queries'] / float(chunks), 2)
+        , 'phases' : stats['phases']
+        , 'commit_sizes' : stats['commit_sizes'][0]
+        }
+
+def run( tables, sizes, engines, commit_sizes, work_dir, seed=0
+       , progress=None ):
+    '''
+    Run every combination, smallest files first.  `progress`, if given, is
+    called with every result as it comes.  Returns the report.
+    '''
+    results = []
+    for rows in sorted(sizes):
+        for table in tables:
+            csv_file = csv_path(work_dir, table, rows, seed)
+            for engine in engines:
+                for commit_size in commit_sizes:
+                    result = load_once( table, csv_file, engine, commit_size
+                                      , work_dir )
+                    if progress:
+                        progress(result)
+                    results.append(result)
+    return {
+          'hq_stage' : hq_stage.__version__
+        , 'django' : django.get_version()
+        , 'python' : platform.python_version()
+        , 'platform' : platform.platform()
+        , 'database' : connection.vendor
+        , 'seed' : seed
+        , 'date' : loader.now().isoformat()
+        , 'results' : results
+        }
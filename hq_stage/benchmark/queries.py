@@ -0,0 +1,245 @@
+'''
+Benchmark of the queries on the staging tables.
+
+The staging tables are seeded with a large number of rows, spread over many
+batches and in all states, and the queries of the loader, of the views and of
+`hqs-print-errors` are timed.  The plan the database chose for every query is
+reported as well, and a query whose plan reads a whole table is flagged: a
+missing index shows up here long before it shows up in production.
+
+Everything happens in a test database (named as the one the Django test runner
+would create) so the data in the configured database is never touched.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import re, time, bisect, random, itertools, statistics, contextlib
+
+from django.db import connection, transaction
+
+from .. import models, loader, bulk, pagination, states, sizing
+
+
+# Share of the rows in each state, roughly what a staging table looks like
+# after a few uploads to the warehouse.
+STATE_MIX = [
+      ( 'processed' , 70 )
+    , ( 'pending' , 20 )
+    , ( 'in_error' , 8 )
+    , ( 'ignored' , 2 )
+    ]
+
+
+@contextlib.contextmanager
+def test_database(sqlite_file=None):
+    '''
+    Create and migrate the test database, and destroy it when done.  The test
+    database of SQLite lives in memory unless a file is given.
+    '''
+    old_name = connection.settings_dict['NAME']
+    old_test = connection.settings_dict['TEST'].get('NAME')
+    if sqlite_file and 'sqlite' == connection.vendor:
+        connection.settings_dict['TEST']['NAME'] = sqlite_file
+    try:
+        connection.creation.create_test_db( verbosity=0, autoclobber=True
+                                          , serialize=False )
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, 0)
+    finally:
+        connection.settings_dict['TEST']['NAME'] = old_test
+
+def analyze():
+    '''
+    Refresh the statistics of the planner after seeding.
+    '''
+    with connection.cursor() as cursor:
+        if 'mysql' == connection.vendor:
+            for spec in loader.TABLES.values():
+                cursor.execute( 'ANALYZE TABLE %s' % connection.ops.quote_name(
+                    spec.model._meta.db_table ) )
+        else:
+            cursor.execute('ANALYZE')
+
+def seed(table, rows, batches, mix=STATE_MIX, rnd=None):
+    '''
+    Fill the table with `rows` rows over `batches` new batches.  The rows of
+    a batch have consecutive ids, as they would after a load, and their state
+    is drawn at random following `mix`.  Returns the batches.
+    '''
+    rnd = rnd or random.Random(0)
+    spec = loader.TABLES[table]
+    names = [ x[0] for x in mix ]
+    # drawn by bisecting the cumulative weights, rnd.choices is too recent
+    cumulative = list(itertools.accumulate(x[1] for x in mix))
+    commit_num = sizing.fixed_size()
+    insert_date = loader.now()
+    created = []
+    for i in range(batches):
+        batch = models.Batch()
+        batch.save()
+        created.append(batch)
+        layouts = {}
+        for state in names:
+            values = dict(models.ROW_STATES[state])
+            values.update({ 'batch' : batch.id , 'insert_date' : insert_date })
+            if values['in_error']:
+                values['fields_in_error'] = spec.infields[0]
+            layouts[state] = bulk.prepare_layout( spec.model, spec.infields
+                                                , values )
+        columns = layouts[names[0]][0]
+        count = rows // batches + (i < rows % batches)
+        for start in range(0, count, commit_num):
+            n = min(commit_num, count - start)
+            drawn = [ names[bisect.bisect( cumulative
+                                         , rnd.random() * cumulative[-1] )]
+                      for j in range(n) ]
+            chunk = [ layouts[state][1] + (str(start + j),) * spec.width
+                      for j, state in enumerate(drawn) ]
+            bulk.insert_rows(spec.model, columns, chunk)
+    models.BatchSummary.reconcile(spec.model)
+    analyze()
+    return created
+
+def explain(queryset):
+    '''
+    The plan of the query, as a list of lines.
+    '''
+    sql, params = queryset.query.sql_with_params()
+    vendor = connection.vendor
+    with connection.cursor() as cursor:
+        if 'postgresql' == vendor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            return [ x[0] for x in cursor.fetchall() ]
+        if 'sqlite' == vendor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [ x[-1] for x in cursor.fetchall() ]
+        if 'mysql' == vendor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            names = [ x[0] for x in cursor.description ]
+            return [ ' '.join( '%s=%s' % x for x in zip(names, row)
+                               if x[0] in ('table', 'type', 'key', 'rows') )
+                     for row in cursor.fetchall() ]
+    return []
+
+def full_scan(plan):
+    '''
+    Whether the plan reads a whole table (or a whole index).
+    '''
+    for line in plan:
+        if 'Seq Scan' in line or 'type=ALL' in line:
+            return True
+        if re.match(r'\s*(SCAN|\|--SCAN|`--SCAN)\b', line):
+            return True
+    return False
+
+def timed(action, repeat):
+    '''
+    Run the action `repeat` times, returns the minimum and the median time in
+    milliseconds.
+    '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        action()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times), statistics.median(times)
+
+def queries(table, batch, page=25):
+    '''
+    The queries we care about on a table, as (name, queryset, action) where
+    the action runs the queryset the way the application does.
+    '''
+    model = loader.TABLES[table].model
+    chunk = sizing.fixed_size()
+    pending = states.selection(model, 'pending', batch)
+    errors = states.selection(model, 'in_error', batch)
+    ignored = states.selection(model, 'ignored')
+    first_page = lambda q: q.order_by('pk')[:page+1]
+    batches = models.Batch.objects.filter(processed=False)
+    bound = errors.order_by('id').values_list('id', flat=True)[chunk-1:chunk]
+    stream = errors.order_by('id').values_list(
+        'id', 'batch_id', 'fields_in_error' )
+    return [
+          ( 'view: rows of a batch'
+          , first_page(model.objects.filter(batch_id=batch))
+          , lambda q: list(q) )
+        , ( 'view: pending rows of a batch', first_page(pending)
+          , lambda q: list(q) )
+        , ( 'view: errors of a batch', first_page(errors)
+          , lambda q: list(q) )
+        , ( 'view: ignored rows', first_page(ignored)
+          , lambda q: list(q) )
+        , ( 'view: estimated count of pending rows', pending
+          , pagination.estimate_count )
+        , ( 'view: unprocessed batches', first_page(batches)
+          , lambda q: list(q) )
+        , ( 'print_errors: errors of a batch', stream
+          , lambda q: sum(1 for x in q.iterator()) )
+        , ( 'print_errors: count of a batch', errors
+          , lambda q: q.count() )
+        , ( 'print_errors: count of a batch from the summary'
+          , models.BatchSummary.objects.filter(
+                table=model._meta.model_name, batch_id=batch )
+          , lambda q: models.BatchSummary.count_rows(
+                model, 'in_error', batch ) )
+        , ( 'print_errors: count of the table'
+          , states.selection(model, 'in_error')
+          , lambda q: q.count() )
+        , ( 'set_state: end of a chunk of errors', bound
+          , lambda q: list(q) )
+        , ( 'loader: checkpoint of a file'
+          , models.LoadCheckpoint.objects.filter(
+                batch_id=batch, file_name='/dev/null', table=table )
+          , lambda q: list(q) )
+        , ( 'loader: manifest of a fingerprint'
+          , models.LoadManifest.objects.filter(
+                table=table, fingerprint='0:0' )
+          , lambda q: q.exists() )
+        ]
+
+def load_chunk(table, batch):
+    '''
+    Insert a chunk of rows into the table the way the loader does, and roll
+    it back.  Every index on the table makes this slower.
+    '''
+    spec = loader.TABLES[table]
+    build, insert = spec.compile(batch, loader.now(), 'copy')
+    chunk = [ (str(i),) * spec.width
+              for i in range(sizing.fixed_size()) ]
+
+    def action():
+        with transaction.atomic():
+            insert(build(chunk))
+            transaction.set_rollback(True)
+    return action
+
+def run(table, rows, batches, repeat=5):
+    '''
+    Seed the table and benchmark its queries on the batch in the middle.
+    Returns a list of dictionaries, one per query.
+    '''
+    seeded = seed(table, rows, batches)
+    batch = seeded[len(seeded) // 2]
+    results = []
+    for name, q, action in queries(table, batch.id):
+        plan = explain(q)
+        best, median = timed(lambda: action(q.all()), repeat)
+        results.append({
+              'query' : name
+            , 'min_ms' : round(best, 3)
+            , 'median_ms' : round(median, 3)
+            , 'full_scan' : full_scan(plan)
+            , 'plan' : plan
+            })
+    best, median = timed(load_chunk(table, batch), repeat)
+    results.append({
+          'query' : 'loader: insert a chunk of %i rows'
+                    % sizing.fixed_size()
+        , 'min_ms' : round(best, 3)
+        , 'median_ms' : round(median, 3)
+        , 'full_scan' : False
+        , 'plan' : []
+        })
+    return results
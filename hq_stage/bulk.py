@@ -0,0 +1,110 @@
+'''
+Raw bulk insertion into the staging tables.
+
+The ORM path builds a model instance for every row just to have `bulk_create`
+throw it away again.  The procedures here skip the models altogether: the rows
+are plain tuples of column values and are pushed to the database with the
+fastest mechanism the backend offers.
+
+*   PostgreSQL: `COPY ... FROM STDIN` in text format.
+*   Anything else: a single `cursor.executemany` on an `INSERT` statement.
+
+Do not import models here, pass the model class as an argument instead.
+'''
+
+import io
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+
+def fixed_values(model, infields, values):
+    '''
+    Compute the columns that are the same for every row of a load.  These are
+    all concrete fields of the model that do not come from the input file and
+    are not the primary key.  `values` maps field names to the values we must
+    use (e.g. batch and insert date), anything not in there uses the default of
+    the field, exactly as a model instance would.
+
+    Returns a list of fields and a list of python values, in the same order.
+    '''
+    fields = []
+    prefix = []
+    for f in model._meta.concrete_fields:
+        if f.primary_key or f.name in infields:
+            continue
+        fields.append(f)
+        if f.name in values:
+            prefix.append(values[f.name])
+        else:
+            prefix.append(f.get_default())
+    return fields, prefix
+
+def prepare_layout(model, infields, values, using=DEFAULT_DB_ALIAS):
+    '''
+    Build the column list and the (database ready) constant prefix for rows
+    inserted with `insert_rows`.  A row is then simply `prefix + input values`.
+    '''
+    connection = connections[using]
+    fields, prefix = fixed_values(model, infields, values)
+    prefix = tuple( f.get_db_prep_save(v, connection)
+                    for f, v in zip(fields, prefix) )
+    columns = [ f.column for f in fields ]
+    columns += [ model._meta.get_field(x).column for x in infields ]
+    return columns, prefix
+
+def copy_escape(value):
+    '''
+    Serialise a single value for the text format of PostgreSQL's COPY.
+    '''
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    return ( str(value)
+             .replace('\\', '\\\\')
+             .replace('\t', '\\t')
+             .replace('\n', '\\n')
+             .replace('\r', '\\r') )
+
+def copy_rows(cursor, table, columns, rows):
+    '''
+    Stream the rows into the table with COPY FROM STDIN.  The rows are
+    serialised into one buffer per call, so call this once per commit chunk
+    to keep the memory bounded.
+    '''
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(copy_escape, row)))
+        buf.write('\n')
+    buf.seek(0)
+    sql = 'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns))
+    # the django cursor hands it to the psycopg2 one, which knows about COPY
+    cursor.copy_expert(sql, buf)
+
+def executemany_rows(cursor, table, columns, rows):
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+          table
+        , ', '.join(columns)
+        , ', '.join(['%s'] * len(columns))
+        )
+    cursor.executemany(sql, rows)
+
+def insert_rows(model, columns, rows, using=DEFAULT_DB_ALIAS, table=None):
+    '''
+    Insert a list of tuples, ordered as `columns`, into the table of the model
+    (or into `table`, e.g. a partition of it).  Everything happens inside a
+    single transaction, the same way `bulk_create` would have behaved.
+    '''
+    if not rows:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(table or model._meta.db_table)
+    columns = [ qn(c) for c in columns ]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        if 'postgresql' == connection.vendor:
+            copy_rows(cursor, table, columns, rows)
+        else:
+            executemany_rows(cursor, table, columns, rows)
@@ -0,0 +1,151 @@
+'''
+Cache of the pages and aggregates of the staging area.
+
+The pages only change when rows or batches change, and that happens in a few
+well known places.  Every batch has a version counter in the cache, and there
+is one more counter for everything that covers all batches.  A cached entry
+is stored under a key that contains the version it was computed from, when the
+data of a batch changes its counter (and the global one) is bumped and the
+entries computed from the old version are never looked up again, they just
+expire.  Nothing needs to be deleted and a reader racing a writer can at worst
+store an entry that nobody will read.
+
+The counters are bumped by whoever changes the rows (`BatchSummary.add`,
+`DataRow.save`, `Batch.save` and friends), after the transaction commits.
+
+Caching is off unless `HQ_DW_CACHE` names one of the `CACHES` of the project.
+The counters must be seen by every process that writes (the loaders too), so
+use a shared backend (memcached, database, file...).  The local memory backend
+is only good for tests and single process setups.  Entries expire after
+`HQ_DW_CACHE_TIMEOUT` seconds (default 600).
+
+Do not import models here, the models bump the counters.
+'''
+
+import time, hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+PREFIX = 'hq_stage:'
+KINDS = [ 'page' , 'aggregate' ]
+
+
+def get_cache():
+    '''
+    The cache to use, or None if caching is off.
+    '''
+    alias = getattr(settings, 'HQ_DW_CACHE', None)
+    if not alias:
+        return None
+    return caches[alias]
+
+def version_key(batch_id=None):
+    if batch_id is None:
+        return PREFIX + 'v'
+    return PREFIX + 'v:%i' % batch_id
+
+def version(cache, batch_id=None):
+    '''
+    The current version of a batch, or of everything if no batch is given.
+    '''
+    key = version_key(batch_id)
+    current = cache.get(key)
+    if current is None:
+        # a counter that was evicted must not start again from a version
+        # that was used before, hence we start from the clock
+        cache.add(key, int(time.time() * 1000), None)
+        current = cache.get(key)
+    return current
+
+def bump(*batch_ids):
+    '''
+    Invalidate what was cached for the batches, and for all batches, once the
+    current transaction (if any) commits.
+    '''
+    cache = get_cache()
+    if cache is None:
+        return
+    keys = [ version_key() ]
+    keys += [ version_key(x) for x in set(batch_ids) if x is not None ]
+
+    def incr():
+        for key in keys:
+            try:
+                cache.incr(key)
+            except ValueError:
+                pass  # no counter, nothing was cached with it either
+    transaction.on_commit(incr)
+
+def make_key(cache, kind, name, batch_id=None):
+    '''
+    Cache key of an entry computed from the current version of a batch (or
+    of all batches).  Names may be of any length, they are hashed.
+    '''
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    batch = 'all' if batch_id is None else str(batch_id)
+    return '%s%s:%s:%s:%s' % ( PREFIX, kind, batch
+                             , version(cache, batch_id), digest )
+
+def timeout():
+    return getattr(settings, 'HQ_DW_CACHE_TIMEOUT', 600)
+
+def record(cache, kind, hit):
+    '''
+    Count a hit or a miss, in the cache so that all processes add up.
+    '''
+    key = PREFIX + 'stats:%s:%s' % (kind, 'hits' if hit else 'misses')
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+def lookup(kind, name, batch_id=None):
+    '''
+    Look an entry up, returns the key to store it under and the entry, which
+    is None on a miss.  The key is None if caching is off.
+    '''
+    cache = get_cache()
+    if cache is None:
+        return None, None
+    key = make_key(cache, kind, name, batch_id)
+    entry = cache.get(key)
+    record(cache, kind, entry is not None)
+    return key, entry
+
+def store(key, entry):
+    if key is not None:
+        get_cache().set(key, entry, timeout())
+
+def memoize(name, batch_id, compute):
+    '''
+    The result of `compute()` as of the current version of the batch (or of
+    all batches), computed only on a miss.
+    '''
+    key, entry = lookup('aggregate', name, batch_id)
+    if entry is not None:
+        return entry[0]
+    value = compute()
+    store(key, (value,))  # so that a None result is cached as well
+    return value
+
+def stats():
+    '''
+    Hits, misses and hit rate of every kind of entry.
+    '''
+    cache = get_cache()
+    if cache is None:
+        return { 'enabled' : False }
+    result = { 'enabled' : True }
+    for kind in KINDS:
+        hits = cache.get(PREFIX + 'stats:%s:hits' % kind) or 0
+        misses = cache.get(PREFIX + 'stats:%s:misses' % kind) or 0
+        result[kind] = {
+              'hits' : hits
+            , 'misses' : misses
+            , 'hit_rate' : hits / float(hits + misses) if hits + misses else 0
+            }
+    return result
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
-import os, sys, getopt, csv, datetime
-from pytz import timezone
+import os, sys, csv, json, getopt, hashlib, multiprocessing
 from . import util
+from .csvio import split_csv, is_plain_file
 
 def settings_path():
     '''
@@ -16,7 +16,8 @@ def settings_path():
              + 'to the path of the main django project (hq-dw).'
              )
         sys.exit(1)
-    sys.path.append(project_path)
+    if not project_path in sys.path:
+        sys.path.append(project_path)
     settings = os.environ.get('DJANGO_SETTINGS_MODULE')
     if not settings:
         print( 'ERROR: You need to set DJANGO_SETTINGS_MODULE environment '
@@ -24,117 +25,61 @@ def settings_path():
              )
         sys.exit(1)
 
-def read_unix_csv(csv_file):
-    '''
-    Iterator over CSV files in the dialect commonly found on UNIX systems:
-    delimited by commas (,) and quoted in double quotes (").  This simplifies
-    the handling of such a CSV file.
-    '''
-    with open(csv_file, newline='') as csvf:
-        reader = csv.reader(csvf, delimiter=',', quotechar='"')
-        for row in reader:
-            yield row
-
-def load_currency(csv_file, batch, models, settings):
-    '''
-    Bulk insert of the Currency model.
-
-    Since we may have a lot of records being inserted firing an insert for each
-    would not be quick enough in most warehouses.  Instead we use a bulk insert
-    every a certain number of records.
-    '''
-    infields = util.remove_abstract_fields( models.Currency
-                                          , models.DataRow, ['id'] )
-    commit_num = settings.HQ_DW_COMMIT_SIZE
-    commit_list = []
-    iter = read_unix_csv(csv_file)
-    next(iter, None)  # ignore header
-    next(iter, None)  # ignore dummy row
-    # bulk_create does not call save(), we need to add the date manually
-    tz = timezone(settings.TIME_ZONE)
-    insert_date = tz.localize(datetime.datetime.now())
-    for row in iter:
-        field_dict = util.zip_default(infields, row)
-        cur = models.Currency(
-              batch=batch
-            , insert_date=insert_date
-            , **field_dict
-            )
-        commit_list.append(cur)
-        if len(commit_list) % commit_num == 0:
-            models.Currency.objects.bulk_create(commit_list)
-            print('commit', commit_num, 'currencies')
-            commit_list = []
-    models.Currency.objects.bulk_create(commit_list)
-    print('final commit, and we are done')
-
-def load_exchange_rate(csv_file, batch, models, settings):
-    '''
-    Bulk insert of the Exchange Rate model.
-
-    This has a lot of duplicated code from load_currency, someday it will need
-    to be refactored.
-    '''
-    infields = util.remove_abstract_fields( models.ExchangeRate
-                                          , models.DataRow, ['id'] )
-    commit_num = settings.HQ_DW_COMMIT_SIZE
-    commit_list = []
-    iter = read_unix_csv(csv_file)
-    next(iter, None)  # ignore header
-    # bulk_create does not call save(), we need to add the date manually
-    tz = timezone(settings.TIME_ZONE)
-    insert_date = tz.localize(datetime.datetime.now())
-    for row in iter:
-        field_dict = util.zip_default(infields, row)
-        cur = models.ExchangeRate(
-              batch=batch
-            , insert_date=insert_date
-            , **field_dict
-            )
-        commit_list.append(cur)
-        if len(commit_list) % commit_num == 0:
-            models.ExchangeRate.objects.bulk_create(commit_list)
-            print('commit', commit_num, 'exchange rates')
-            commit_list = []
-    models.ExchangeRate.objects.bulk_create(commit_list)
-    print('final commit, and we are done')
-
-def load_offer(csv_file, batch, models, settings):
-    '''
-    Bulk insert of the Offer model.
-
-    Again, duplicated code.  The main difficulty in making a generic function
-    is the fact that the files are not consistent:
-
-    *   currency has a header and a dummy row
-    *   exchange rate has a header only
-    *   and offer has a dummy row only
-
-    I could edit the files, but that would be cheating.
-    '''
-    infields = util.remove_abstract_fields( models.Offer
-                                          , models.DataRow, ['id'] )
-    commit_num = settings.HQ_DW_COMMIT_SIZE
-    commit_list = []
-    iter = read_unix_csv(csv_file)
-    next(iter, None)  # ignore header
-    # bulk_create does not call save(), we need to add the date manually
-    tz = timezone(settings.TIME_ZONE)
-    insert_date = tz.localize(datetime.datetime.now())
-    for row in iter:
-        field_dict = util.zip_default(infields, row)
-        cur = models.Offer(
-              batch=batch
-            , insert_date=insert_date
-            , **field_dict
-            )
-        commit_list.append(cur)
-        if len(commit_list) % commit_num == 0:
-            models.Offer.objects.bulk_create(commit_list)
-            print('commit', commit_num, 'offers')
-            commit_list = []
-    models.Offer.objects.bulk_create(commit_list)
-    print('final commit, and we are done')
+def load_span(job):
+    '''
+    Worker of a parallel load, runs in a process forked after django has been
+    set up.  Loads a single span of the file and returns the number of rows,
+    and the stats of the load if it is instrumented.  The `options` are
+    passed on to the loader.
+    '''
+    from hq_stage import loader
+    from hq_stage.loadstats import LoadStats
+    table, csv_file, batch, engine, span, instrument, progress, options = job
+    if not instrument:
+        return loader.load( loader.TABLES[table], csv_file, batch, engine
+                          , span, **options ), None
+    stats = LoadStats('%s@%i' % (table, span[0]), span[1], progress)
+    rows = loader.load( loader.TABLES[table], csv_file, batch, engine, span
+                      , stats=stats, **options )
+    return rows, stats.as_dict()
+
+def load_parallel( table, csv_file, batch, engine, jobs, stats=None
+                 , **options ):
+    '''
+    Split the file at record boundaries and load the pieces in a pool of
+    worker processes, all into the same batch.  The loaders only skip the
+    header and dummy rows in the span that starts at the beginning of the file.
+    The file is hashed while it is split, for the manifest.
+
+    If `stats` are given every worker instruments its own load (and reports
+    its progress) and the numbers are added up into them.  The `options` of
+    the loader (commit size, writers...) apply to every worker.
+    '''
+    from django import db
+    from hq_stage import loader
+    started = loader.now()
+    digest = hashlib.sha256()
+    spans = split_csv(csv_file, jobs, digest=digest)
+    if 1 == len(spans) < jobs:
+        print('WARNING: %s cannot be split, loading it in a single job'
+              % csv_file)
+    # every worker must open its own connection, a forked one is not usable
+    db.connections.close_all()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(len(spans)) as pool:
+        progress = stats and stats.progress
+        results = pool.map( load_span
+                          , [ ( table, csv_file, batch, engine, s
+                              , stats is not None, progress, options )
+                              for s in spans ]
+                          , chunksize=1 )
+    rows = sum(x[0] for x in results)
+    if stats:
+        for x in results:
+            stats.merge(x[1])
+    loader.record_manifest( loader.TABLES[table], csv_file, batch, digest
+                          , os.path.getsize(csv_file), rows, started )
+    return rows
 
 def load_table():
     '''
@@ -143,115 +88,1238 @@ def load_table():
     data from a file.
 
     We check that the file exists but it is the responsibility of the called
-    function to verify if the file is in the correct format.
+    function to verify if the file is in the correct format.  A file name of
+    `-` reads the standard input, and compressed files are decompressed on the
+    fly.
+
+    With `--stats` a JSON summary of the load (see `loadstats`) is printed
+    as the last line, with `--progress` the rate and ETA are printed to the
+    standard error every `HQ_DW_PROGRESS_INTERVAL` seconds (default 5) and
+    with `--prometheus` (or `HQ_DW_PROMETHEUS_TEXTFILE`) the numbers are
+    written to a file for the textfile collector of the node exporter.  With
+    none of them the load is not instrumented at all.
+
+    The commit size given with -c overrides `HQ_DW_COMMIT_SIZE`, either of
+    them may be `auto` (see `sizing`).  With -w the load is pipelined (see
+    `pipeline`).  The rows are validated (see `validation`) with -V or if
+    `HQ_DW_VALIDATE` is set, unless --no-validate is given.
     '''
     settings_path()
     import django
     django.setup()
     from django.conf import settings
-    from hq_stage import models
+    from hq_stage import models, loader, sizing
+    from hq_stage.loadstats import LoadStats
 
-    tables = {
-          'currency' : load_currency
-        , 'exchange-rate' : load_exchange_rate
-        , 'offer' : load_offer
-        }
+    tables = loader.TABLES
+    engines = [ 'orm' , 'copy' ]
 
-    usage = 'hqs-load-table [-h] [-b <batch>] -f <csv file> -t <table>'
+    usage = ( 'hqs-load-table [-h] [-r] [-F] [-b <batch>] [-e <engine>] '
+            + '[-j <jobs>] [-w <writers>] [-c <commit size>] '
+            + '[-V | --no-validate] [--stats] [--progress] '
+            + '[--prometheus <file>] -f <csv file> -t <table>' )
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hb:f:t:')
+        opts, args = getopt.getopt( sys.argv[1:], 'hrFVb:c:e:f:j:t:w:'
+                                  , [ 'engine=', 'resume', 'force'
+                                    , 'commit-size=', 'writers=', 'validate'
+                                    , 'no-validate', 'stats', 'progress'
+                                    , 'prometheus=' ] )
     except getopt.GetoptError as e:
         print(e)
         print(usage)
         sys.exit(2)
     batchno = None
+    commit_size = None
+    engine = 'orm'
     infile = None
+    force = False
+    jobs = 1
+    writers = 0
+    validate = getattr(settings, 'HQ_DW_VALIDATE', False)
+    resume = False
     table = None
+    show_stats = False
+    progress = None
+    prometheus = getattr(settings, 'HQ_DW_PROMETHEUS_TEXTFILE', None)
     for o, a in opts:
         if '-h' == o:
             print(usage)
             sys.exit(0)
         elif '-b' == o:
             batchno = a
+        elif o in ('-c', '--commit-size'):
+            commit_size = a
+        elif o in ('-e', '--engine'):
+            engine = a
         elif '-f' == o:
             infile = a
+        elif '-j' == o:
+            jobs = a
+        elif o in ('-w', '--writers'):
+            writers = a
+        elif o in ('-V', '--validate'):
+            validate = True
+        elif '--no-validate' == o:
+            validate = False
+        elif o in ('-r', '--resume'):
+            resume = True
+        elif o in ('-F', '--force'):
+            force = True
         elif '-t' == o:
             table = a
+        elif '--stats' == o:
+            show_stats = True
+        elif '--progress' == o:
+            progress = getattr(settings, 'HQ_DW_PROGRESS_INTERVAL', 5)
+        elif '--prometheus' == o:
+            prometheus = a
         else:
             assert False, 'unhandled option [%s]' % o
     if not infile or not table:
         print(usage)
         sys.exit(1)
-    if not os.path.isfile(infile):
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        print(usage)
+        print('The number of jobs must be a positive integer')
+        sys.exit(1)
+    try:
+        writers = int(writers)
+    except ValueError:
+        writers = -1
+    if writers < 0:
+        print(usage)
+        print('The number of writers must be a positive integer')
+        sys.exit(1)
+    try:
+        if commit_size is not None:
+            commit_size = sizing.parse(commit_size)
+    except ValueError:
+        print(usage)
+        print('The commit size must be a positive integer or auto')
+        sys.exit(1)
+    if '-' != infile and not os.path.isfile(infile):
         print(usage)
         print('%s: No such file' % infile)
         sys.exit(1)
+    if 1 != jobs and not is_plain_file(infile):
+        print(usage)
+        print('Parallel loads (-j) need a plain uncompressed file')
+        sys.exit(1)
+    if resume and (1 != jobs or '-' == infile or not batchno):
+        print(usage)
+        print('Only a serial (no -j) load of a file into a batch (-b) '
+              + 'can be resumed')
+        sys.exit(1)
     if not table in tables:
         print(usage)
         print('No such table to load.  Available tables:')
         print(', '.join(sorted(tables.keys())))
         sys.exit(1)
+    if not engine in engines:
+        print(usage)
+        print('No such engine.  Available engines:')
+        print(', '.join(engines))
+        sys.exit(1)
+
+    loaded = None if force else loader.find_loaded(tables[table], infile)
+    if loaded:
+        print( '%s was already loaded into batch %i (%i rows), skipping it.  '
+             % (infile, loaded.batch_id, loaded.row_count)
+             + 'Use --force to load it again.' )
+        sys.exit(0)
 
     batch = util.get_new_model(models.Batch, batchno)
     if not batch:
         # we got rubbish, build a new one
         batch = models.Batch()
+    if resume and str(batch.id) != batchno.strip():
+        print('Batch %s does not exist or has been processed, '
+              % batchno + 'there is nothing to resume')
+        sys.exit(1)
     batch.save()
     print('Using batch [%i]' % batch.id)
-    tables[table](infile, batch, models, settings)
+    stats = None
+    if show_stats or progress or prometheus:
+        size = os.path.getsize(infile) if is_plain_file(infile) else None
+        stats = LoadStats(table, size, progress)
+    options = { 'commit_size' : commit_size
+              , 'writers' : writers
+              , 'validate' : validate
+              }
+    done = False
+    try:
+        if 1 == jobs:
+            rows = loader.load( tables[table], infile, batch, engine, None
+                              , resume, manifest=True, stats=stats
+                              , **options )
+        else:
+            rows = load_parallel( table, infile, batch, engine, jobs, stats
+                                , **options )
+        done = True
+    except loader.LoadError as e:
+        print('ERROR: %s' % e)
+        sys.exit(1)
+    finally:
+        if prometheus:
+            stats.write_prometheus(prometheus, done)
+    print('Rows: [ %i ]' % rows)
     print('Batch: [ %i ]' % batch.id)
+    if show_stats:
+        print(json.dumps(stats.as_dict(), sort_keys=True))
+
+def error_rows(model, batchno=None):
+    '''
+    The rows of a table that are in error and not ignored, possibly only the
+    ones of a batch.
+    '''
+    q = model.objects.filter(in_error=True, ignore=False)
+    if batchno is not None:
+        q = q.filter(batch_id=batchno)
+    return q
+
+def url_template(model):
+    '''
+    Split the url of an object of the model around its primary key, so that we
+    only call reverse() once per table.
+    '''
+    sentinel = '987654321'
+    url = model(id=int(sentinel)).get_absolute_url()
+    prefix, suffix = url.split(sentinel, 1)
+    return prefix, suffix
 
 def print_errors():
     '''
     Print the current rows in error from the command line.
 
-    TODO:
-
-    *   This should receive a batch argument and then print errors from all
-        tables in that batch.
+    The rows of a single table or of all tables, possibly only the ones of a
+    single batch, are printed as links to the web interface (the default), as
+    CSV or as newline delimited JSON.  With `--count-only` only the number of
+    rows in error of each table is printed, which is cheap enough to be polled
+    by monitoring.
     '''
     settings_path()
     import django
     django.setup()
     from django.conf import settings
-    from hq_stage import models
+    from hq_stage import models, loader
 
-    tables = {
-          'currency' : models.Currency.objects
-        , 'exchange-rate' : models.ExchangeRate.objects
-        , 'offer' : models.Offer.objects
-        }
+    tables = loader.TABLES
+    formats = [ 'urls' , 'csv' , 'ndjson' ]
 
-    usage = 'hqs-print-errors [-h] -t <table>'
+    usage = ( 'hqs-print-errors [-h] [-c [-x]] [-b <batch>] [-o <format>] '
+            + '[-t <table>]' )
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'ht:')
+        opts, args = getopt.getopt( sys.argv[1:], 'hcxb:o:t:'
+                                  , ['format=', 'count-only', 'exact'] )
     except getopt.GetoptError as e:
         print(e)
         print(usage)
         sys.exit(2)
+    batchno = None
+    count_only = False
+    exact = False
+    fmt = 'urls'
     table = None
     for o, a in opts:
         if '-h' == o:
             print(usage)
             sys.exit(0)
+        elif '-b' == o:
+            batchno = a
+        elif o in ('-c', '--count-only'):
+            count_only = True
+        elif o in ('-x', '--exact'):
+            exact = True
+        elif o in ('-o', '--format'):
+            fmt = a
         elif '-t' == o:
             table = a
         else:
             assert False, 'unhandled option [%s]' % o
-    if not table:
+    if table and not table in tables:
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    if not fmt in formats:
         print(usage)
+        print('No such format.  Available formats:')
+        print(', '.join(formats))
         sys.exit(1)
+    if batchno is not None:
+        try:
+            batchno = int(batchno)
+        except ValueError:
+            print(usage)
+            print('The batch must be a number.')
+            sys.exit(1)
+    names = [table] if table else sorted(tables.keys())
+
+    if count_only:
+        if 'csv' == fmt:
+            out = csv.writer(sys.stdout, lineterminator='\n')
+            out.writerow(['table', 'batch', 'count'])
+        for name in names:
+            model = tables[name].model
+            if exact:
+                count = error_rows(model, batchno).count()
+            else:
+                count = models.BatchSummary.count_rows( model, 'in_error'
+                                                      , batchno )
+            if 'csv' == fmt:
+                out.writerow([name, batchno, count])
+            elif 'ndjson' == fmt:
+                print(json.dumps({ 'table' : name
+                                 , 'batch' : batchno
+                                 , 'count' : count }))
+            else:
+                print(name, count)
+        return
+
+    # There are still no proper views for the errors, we link to the forms
+    hosts = [ x.lstrip('.') for x in settings.ALLOWED_HOSTS if '*' != x ]
+    domain = hosts[0] if hosts else 'localhost'
+    if settings.DEBUG:
+        domain += ':8000'
+    root = 'http://' + domain
+    if 'csv' == fmt:
+        out = csv.writer(sys.stdout, lineterminator='\n')
+        out.writerow(['table', 'batch', 'id', 'fields_in_error', 'url'])
+    for name in names:
+        model = tables[name].model
+        prefix, suffix = url_template(model)
+        prefix = root + prefix
+        # only the columns we print, streamed without caching the queryset
+        q = error_rows(model, batchno).order_by('id').values_list(
+            'id', 'batch_id', 'fields_in_error' )
+        for pk, batch, fields in q.iterator():
+            url = prefix + str(pk) + suffix
+            if 'csv' == fmt:
+                out.writerow([name, batch, pk, fields, url])
+            elif 'ndjson' == fmt:
+                print(json.dumps({ 'table' : name
+                                 , 'batch' : batch
+                                 , 'id' : pk
+                                 , 'fields_in_error' : fields
+                                 , 'url' : url }))
+            else:
+                print(url)
+
+def set_state():
+    '''
+    Move the rows of a batch, or of a table, from one state to another.  The
+    transition is checked against the state machine described in `DataRow`,
+    and without a source state (-f) the rows in every state that can move into
+    the new state are moved.  The rows can be narrowed down further to the
+    ones with a field in error containing a pattern.
+
+    With -n nothing is changed, we only count the rows that would move.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import models, loader, states
+
+    tables = loader.TABLES
+
+    usage = ( 'hqs-set-state [-h] [-n] [-b <batch>] [-t <table>] '
+            + '[-f <state>] [-p <pattern>] [-c <chunk>] -s <state>' )
+    try:
+        opts, args = getopt.getopt( sys.argv[1:], 'hnb:c:f:p:s:t:'
+                                  , ['dry-run'] )
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    batchno = None
+    chunk = None
+    dry_run = False
+    pattern = None
+    source = None
+    target = None
+    table = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-b' == o:
+            batchno = a
+        elif '-c' == o:
+            chunk = a
+        elif '-f' == o:
+            source = a
+        elif o in ('-n', '--dry-run'):
+            dry_run = True
+        elif '-p' == o:
+            pattern = a
+        elif '-s' == o:
+            target = a
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if not target or (batchno is None and not table):
+        print(usage)
+        print('A state and a batch, a table or both are needed.')
+        sys.exit(1)
+    if table and not table in tables:
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    try:
+        if batchno is not None:
+            batchno = int(batchno)
+        if chunk is not None:
+            chunk = int(chunk)
+            if chunk < 1:
+                raise ValueError(chunk)
+    except ValueError:
+        print(usage)
+        print('The batch and the chunk size must be (positive) numbers.')
+        sys.exit(1)
+
+    try:
+        counts = states.set_state( target, source
+                                 , [table] if table else None
+                                 , batchno, pattern, chunk, dry_run )
+    except states.TransitionError as e:
+        print('ERROR:', e)
+        print('Available states:', ', '.join(models.ROW_STATES.keys()))
+        sys.exit(1)
+    verb = 'would move' if dry_run else 'moved'
+    total = 0
+    for name, moved in counts.items():
+        for state, rows in moved.items():
+            print( '%s: %s %i rows from %s to %s'
+                 % (name, verb, rows, state, target) )
+            total += rows
+    print('Total: [ %i ]' % total)
+
+def process_batch():
+    '''
+    Process a batch: check the rows that are pending or in error against the
+    rules and the references of their tables, mark them processed or in
+    error, and mark the batch processed if no table has pending rows left
+    (see the `processing` module).  The progress goes to the standard error.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import models, loader, processing
+
+    tables = loader.TABLES
+
+    usage = 'hqs-process-batch [-h] [-t <table>] [-c <chunk>] -b <batch>'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hb:c:t:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    batchno = None
+    chunk = None
+    table = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-b' == o:
+            batchno = a
+        elif '-c' == o:
+            chunk = a
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if batchno is None:
+        print(usage)
+        sys.exit(1)
+    if table and not table in tables:
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    try:
+        batchno = int(batchno)
+        if chunk is not None:
+            chunk = int(chunk)
+            if chunk < 1:
+                raise ValueError(chunk)
+    except ValueError:
+        print(usage)
+        print('The batch and the chunk size must be (positive) numbers.')
+        sys.exit(1)
+    batch = models.Batch.objects.filter(id=batchno).first()
+    if not batch:
+        print('No such batch: %i' % batchno)
+        sys.exit(1)
+    if batch.processed:
+        print('Batch %i was processed already, processing its rows ' % batchno
+              + 'in error again')
+
+    counts = processing.process_batch( batch, [table] if table else None
+                                     , chunk, processing.Progress() )
+    for name, (good, bad) in counts.items():
+        print('%s: %i rows processed, %i in error' % (name, good, bad))
+    if not batch.processed:
+        print( 'Batch %i has pending rows in other tables, ' % batch.id
+             + 'it is not marked processed' )
+    print('Batch: [ %i ]' % batch.id)
+
+def check_references():
+    '''
+    Check that the offers and exchange rates of a batch point at currencies
+    of the batch, and move the orphans in error (see the `references`
+    module).  The progress goes to the standard error.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import models, processing, references
+
+    tables = references.REFERENCES
+
+    usage = ( 'hqs-check-references [-h] [-t <table>] [-m <method>] '
+            + '[-c <chunk>] -b <batch>' )
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hb:c:m:t:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    batchno = None
+    chunk = None
+    method = 'auto'
+    table = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-b' == o:
+            batchno = a
+        elif '-c' == o:
+            chunk = a
+        elif '-m' == o:
+            method = a
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if batchno is None:
+        print(usage)
+        sys.exit(1)
+    if table and not table in tables:
+        print(usage)
+        print('No references in this table.  Tables with references:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    if not method in references.METHODS:
+        print(usage)
+        print('No such method.  Available methods:')
+        print(', '.join(references.METHODS))
+        sys.exit(1)
+    try:
+        batchno = int(batchno)
+        if chunk is not None:
+            chunk = int(chunk)
+            if chunk < 1:
+                raise ValueError(chunk)
+    except ValueError:
+        print(usage)
+        print('The batch and the chunk size must be (positive) numbers.')
+        sys.exit(1)
+    if not models.Batch.objects.filter(id=batchno).exists():
+        print('No such batch: %i' % batchno)
+        sys.exit(1)
+
+    counts = references.check_batch( batchno, [table] if table else None
+                                   , method, chunk, processing.Progress() )
+    for name, (used, checked, bad) in counts.items():
+        print( '%s: %i rows checked (%s), %i orphans'
+             % (name, checked, used, bad) )
+    print('Batch: [ %i ]' % batchno)
+
+def archive():
+    '''
+    Move the processed and ignored rows of the old processed batches out of
+    the staging tables, into the archive table, into files or nowhere (see
+    the `archive` module).  The progress goes to the standard error.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import loader, processing, archive
+
+    tables = loader.TABLES
+
+    usage = ( 'hqs-archive [-h] [-n] [-m <mode>] [-o <directory>] '
+            + '[-d <days>] [-b <batch>]\n'
+            + '            [-t <table>] [-c <chunk>] [-s <pause>]' )
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hnb:c:d:m:o:s:t:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    dry_run = False
+    mode = 'table'
+    directory = None
+    days = None
+    batchno = None
+    table = None
+    chunk = None
+    pause = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-n' == o:
+            dry_run = True
+        elif '-b' == o:
+            batchno = a
+        elif '-c' == o:
+            chunk = a
+        elif '-d' == o:
+            days = a
+        elif '-m' == o:
+            mode = a
+        elif '-o' == o:
+            directory = a
+        elif '-s' == o:
+            pause = a
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if not mode in archive.MODES:
+        print(usage)
+        print('No such mode.  Available modes:')
+        print(', '.join(archive.MODES))
+        sys.exit(1)
+    if table and not table in tables:
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    try:
+        if batchno is not None:
+            batchno = int(batchno)
+        if days is not None:
+            days = int(days)
+            if days < 0:
+                raise ValueError(days)
+        if chunk is not None:
+            chunk = int(chunk)
+            if chunk < 1:
+                raise ValueError(chunk)
+        if pause is not None:
+            pause = float(pause)
+            if pause < 0:
+                raise ValueError(pause)
+    except ValueError:
+        print(usage)
+        print('The batch, the days, the chunk size and the pause must be '
+              + '(positive) numbers.')
+        sys.exit(1)
+
+    try:
+        counts = archive.archive( mode, days, batchno
+                                , [table] if table else None, chunk
+                                , directory, dry_run, pause
+                                , processing.Progress() )
+    except ValueError as e:
+        print('ERROR:', e)
+        sys.exit(1)
+    verb = 'would archive' if dry_run else 'archived'
+    total = 0
+    for (batch, name), moved in counts.items():
+        if moved is None:
+            print( 'Batch %i %s: skipped, not all its rows are processed'
+                 % (batch, name) )
+            continue
+        processed, ignored = moved
+        print( 'Batch %i %s: %s %i processed and %i ignored rows'
+             % (batch, name, verb, processed, ignored) )
+        total += processed + ignored
+    print('Total: [ %i ]' % total)
+
+def drop_batch():
+    '''
+    Invalidate a batch: delete all its rows, or drop its partitions if the
+    tables are partitioned, and mark it processed (see the `archive`
+    module).  The progress goes to the standard error.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import models, loader, processing, archive
+
+    tables = loader.TABLES
+
+    usage = 'hqs-drop-batch [-h] [-n] [-t <table>] [-c <chunk>] -b <batch>'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hnb:c:t:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    dry_run = False
+    batchno = None
+    table = None
+    chunk = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-n' == o:
+            dry_run = True
+        elif '-b' == o:
+            batchno = a
+        elif '-c' == o:
+            chunk = a
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if batchno is None:
+        print(usage)
+        sys.exit(1)
+    if table and not table in tables:
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    try:
+        batchno = int(batchno)
+        if chunk is not None:
+            chunk = int(chunk)
+            if chunk < 1:
+                raise ValueError(chunk)
+    except ValueError:
+        print(usage)
+        print('The batch and the chunk size must be (positive) numbers.')
+        sys.exit(1)
+    if not models.Batch.objects.filter(id=batchno).exists():
+        print('No such batch: %i' % batchno)
+        sys.exit(1)
+
+    counts = archive.drop_batch( batchno, [table] if table else None, chunk
+                               , dry_run, progress=processing.Progress() )
+    verb = 'would delete' if dry_run else 'deleted'
+    for name, rows in counts.items():
+        print('%s: %s %i rows' % (name, verb, rows))
+    print('Total: [ %i ]' % sum(counts.values()))
+
+def partition():
+    '''
+    Convert the staging tables into tables partitioned by batch, PostgreSQL
+    only (see the `partitions` module).
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import loader, partitions
+
+    tables = loader.TABLES
+
+    usage = 'hqs-partition [-h] [-n] [-t <table>]'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hnt:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    dry_run = False
+    table = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-n' == o:
+            dry_run = True
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if table and not table in tables:
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+
+    for name in [table] if table else sorted(tables.keys()):
+        model = tables[name].model
+        if partitions.partitioned(model):
+            print('%s: partitioned' % name)
+            continue
+        if dry_run:
+            print('%s: flat' % name)
+            continue
+        try:
+            partitions.partition(model)
+        except partitions.PartitionError as e:
+            print('ERROR:', e)
+            sys.exit(1)
+        print('%s: partitioned now' % name)
+
+def loadd():
+    '''
+    Run the daemon that keeps django set up and the connections to the
+    database open, and runs the jobs of `hqs-loadc` (see the `loadd` module).
+    The number of workers given with -j overrides `HQ_DW_LOADD_JOBS`, the
+    socket given with -s overrides `HQ_DW_LOADD_SOCKET`.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import loadd
+
+    usage = 'hqs-loadd [-h] [-j <workers>] [-s <socket>]'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hj:s:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    jobs = None
+    path = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-j' == o:
+            jobs = a
+        elif '-s' == o:
+            path = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if jobs is not None:
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            print(usage)
+            print('The number of workers must be a positive integer')
+            sys.exit(1)
+
+    try:
+        loadd.daemon(path, jobs)
+    except OSError as e:
+        print('ERROR:', e)
+        sys.exit(1)
+
+def loadc():
+    '''
+    Run `hqs-load-table` or `hqs-print-errors` in `hqs-loadd`, with the same
+    options and the same exit code.  If the daemon is not running, or is not
+    of our user, the tool runs here, as it would on its own.
+    '''
+    from hq_stage import loadd
+
+    usage = ( 'hqs-loadc [-h] [-s <socket>] <tool> [<options of the tool>]\n'
+            + '  tools: ' + ', '.join(sorted(loadd.TOOLS.keys())) )
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    path = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-s' == o:
+            path = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if not args or not args[0] in loadd.TOOLS:
+        print(usage)
+        sys.exit(2)
+
+    tool = args[0]
+    try:
+        code = loadd.client(tool, args[1:], path)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    except loadd.Untrusted as e:
+        sys.stderr.write('hqs-loadc: %s, running hqs-%s here\n' % (e, tool))
+        code = None
+    else:
+        if code is None:
+            sys.stderr.write( 'hqs-loadc: hqs-loadd is not running, '
+                            + 'running hqs-%s here\n' % tool )
+    if code is None:
+        sys.argv = [ 'hqs-' + tool ] + args[1:]
+        globals()[loadd.TOOLS[tool]]()
+        sys.exit(0)
+    sys.exit(code)
+
+def watch():
+    '''
+    Watch a landing directory and load the files dropped into it, see the
+    `landing` module.  The directory given with -d overrides
+    `HQ_DW_WATCH_DIR`, the number of workers given with -j overrides
+    `HQ_DW_WATCH_JOBS` and the interval given with -i overrides
+    `HQ_DW_WATCH_INTERVAL`.  The engine, commit size and validation are the
+    ones of `hqs-load-table`.
+
+    With -1 we exit once the files there are loaded, with an error if any of
+    them failed, for whoever ran the loads from cron.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from django.conf import settings
+    from hq_stage import sizing, landing
+
+    engines = [ 'orm' , 'copy' ]
+
+    usage = ( 'hqs-watch [-h] [-1] [-p] [-j <workers>] [-i <interval>] '
+            + '[-e <engine>] [-c <commit size>] [-V | --no-validate] '
+            + '[--prometheus <file>] -d <directory>' )
+    try:
+        opts, args = getopt.getopt( sys.argv[1:], 'h1pVc:d:e:i:j:'
+                                  , [ 'once', 'poll', 'validate'
+                                    , 'no-validate', 'prometheus=' ] )
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    once = False
+    poll = False
+    jobs = None
+    interval = None
+    engine = 'orm'
+    commit_size = None
+    validate = getattr(settings, 'HQ_DW_VALIDATE', False)
+    prometheus = None
+    directory = getattr(settings, 'HQ_DW_WATCH_DIR', None)
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif o in ('-1', '--once'):
+            once = True
+        elif o in ('-p', '--poll'):
+            poll = True
+        elif '-j' == o:
+            jobs = a
+        elif '-i' == o:
+            interval = a
+        elif '-e' == o:
+            engine = a
+        elif '-c' == o:
+            commit_size = a
+        elif o in ('-V', '--validate'):
+            validate = True
+        elif '--no-validate' == o:
+            validate = False
+        elif '--prometheus' == o:
+            prometheus = a
+        elif '-d' == o:
+            directory = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if not directory:
+        print(usage)
+        sys.exit(1)
+    if not os.path.isdir(directory):
+        print(usage)
+        print('%s: No such directory' % directory)
+        sys.exit(1)
+    if jobs is not None:
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            print(usage)
+            print('The number of workers must be a positive integer')
+            sys.exit(1)
+    if interval is not None:
+        try:
+            interval = float(interval)
+        except ValueError:
+            interval = 0
+        if interval <= 0:
+            print(usage)
+            print('The interval must be a positive number of seconds')
+            sys.exit(1)
+    try:
+        if commit_size is not None:
+            commit_size = sizing.parse(commit_size)
+    except ValueError:
+        print(usage)
+        print('The commit size must be a positive integer or auto')
+        sys.exit(1)
+    if not engine in engines:
+        print(usage)
+        print('No such engine.  Available engines:')
+        print(', '.join(engines))
+        sys.exit(1)
+
+    options = { 'engine' : engine
+              , 'commit_size' : commit_size
+              , 'validate' : validate
+              }
+    try:
+        service = landing.Service( directory, jobs, interval, poll, options
+                                 , prometheus )
+    except ValueError as e:
+        print('ERROR:', e)
+        sys.exit(1)
+    service.run(once)
+    if once and service.files['failed']:
+        sys.exit(1)
+
+def bench_queries():
+    '''
+    Seed a test database with a large staging table and time the queries of
+    the loader, the views and `hqs-print-errors` on it, see the
+    `benchmark.queries` module.  The configured database is not touched, but
+    the database user must be allowed to create the test database.
+
+    With --check we exit with an error if the plan of any query reads a whole
+    table, so it can be run after changes to the queries or the indexes.
+    Mind that on small tables a full scan may well be the best plan.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import loader
+    from hq_stage.benchmark import queries as benchmark
+
+    tables = loader.TABLES
+    formats = [ 'text' , 'json' ]
+
+    usage = ( 'hqs-bench-queries [-h] [--check] [-r <rows>] [-n <batches>] '
+            + '[-i <repeat>] [-o <format>] [-t <table>]' )
+    try:
+        opts, args = getopt.getopt( sys.argv[1:], 'hr:n:i:o:t:'
+                                  , ['check', 'format='] )
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    batches = 100
+    check = False
+    fmt = 'text'
+    repeat = 5
+    rows = 100000
+    table = 'offer'
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '--check' == o:
+            check = True
+        elif '-i' == o:
+            repeat = a
+        elif '-n' == o:
+            batches = a
+        elif o in ('-o', '--format'):
+            fmt = a
+        elif '-r' == o:
+            rows = a
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
     if not table in tables:
         print(usage)
         print('No such table.  Available tables:')
         print(', '.join(sorted(tables.keys())))
         sys.exit(1)
+    if not fmt in formats:
+        print(usage)
+        print('No such format.  Available formats:')
+        print(', '.join(formats))
+        sys.exit(1)
+    try:
+        rows, batches, repeat = int(rows), int(batches), int(repeat)
+        if rows < 1 or batches < 1 or repeat < 1:
+            raise ValueError(rows)
+    except ValueError:
+        print(usage)
+        print('Rows, batches and repeat must be positive numbers.')
+        sys.exit(1)
 
-    q = tables[table].filter(in_error=True).exclude(ignore=True)
-    # This is horrible code, but there is no time to make proper views
-    domain = (settings.ALLOWED_HOSTS[0:1] or 'localhost')
-    if settings.DEBUG:
-        domain += ':8000'
-    for obj in q:
-        print('http://%s%s' % (domain, obj.get_absolute_url()))
+    with benchmark.test_database():
+        results = benchmark.run(table, rows, batches, repeat)
+    if 'json' == fmt:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            print( '%-45s %10.3f ms %10.3f ms %s'
+                 % ( r['query'], r['min_ms'], r['median_ms']
+                   , 'FULL SCAN' if r['full_scan'] else '' ) )
+            for line in r['plan']:
+                print('    ' + line)
+    if check and any(r['full_scan'] for r in results):
+        sys.exit(1)
+
+def reconcile_summary():
+    '''
+    Count the rows of the staging tables again and rebuild the `BatchSummary`,
+    of a batch or of all batches.  Needed after rows were changed behind the
+    back of the application, or to fill the summary for the first time.  The
+    counts of a batch that is being loaded while we count may be off, run it
+    again once the load is done.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    from hq_stage import models, loader
+
+    tables = loader.TABLES
+
+    usage = 'hqs-reconcile-summary [-h] [-b <batch>] [-t <table>]'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hb:t:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    batchno = None
+    table = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-b' == o:
+            batchno = a
+        elif '-t' == o:
+            table = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if table and not table in tables:
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    if batchno is not None:
+        try:
+            batchno = int(batchno)
+        except ValueError:
+            print(usage)
+            print('The batch must be a number.')
+            sys.exit(1)
+
+    for name in [table] if table else sorted(tables.keys()):
+        summaries = models.BatchSummary.reconcile(tables[name].model, batchno)
+        print( '%s: %i batches, %i rows'
+             % (name, len(summaries), sum(x.total for x in summaries)) )
+
+def bench_load():
+    '''
+    Generate CSV files and time the loader on them, see the `benchmark.load`
+    module.  The lists of tables, sizes, engines and commit sizes are comma
+    separated and every combination is run.  The report goes to the standard
+    output as JSON, the progress to the standard error.
+
+    The generated files are kept in the directory given with -d (and reused
+    by the next run), otherwise they go into a temporary directory.  With -g
+    we only generate a file and exit.
+    '''
+    settings_path()
+    import django
+    django.setup()
+    import tempfile, shutil
+    from django.conf import settings
+    from hq_stage import loader, sizing
+    from hq_stage.benchmark import generate, load
+
+    tables = loader.TABLES
+    engines = [ 'orm' , 'copy' ]
 
+    usage = ( 'hqs-bench-load [-h] [-t <tables>] [-r <rows>] [-e <engines>] '
+            + '[-c <commit sizes>] [-s <seed>] [-d <dir> | -g <csv file>]' )
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ht:r:e:c:s:d:g:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    commit_sizes = str(settings.HQ_DW_COMMIT_SIZE)
+    gen_file = None
+    seed = '0'
+    sizes = '10000'
+    use_engines = ','.join(engines)
+    use_tables = ','.join(sorted(tables.keys()))
+    work_dir = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-c' == o:
+            commit_sizes = a
+        elif '-d' == o:
+            work_dir = a
+        elif '-e' == o:
+            use_engines = a
+        elif '-g' == o:
+            gen_file = a
+        elif '-r' == o:
+            sizes = a
+        elif '-s' == o:
+            seed = a
+        elif '-t' == o:
+            use_tables = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    use_tables = use_tables.split(',')
+    use_engines = use_engines.split(',')
+    if set(use_tables) - set(tables):
+        print(usage)
+        print('No such table.  Available tables:')
+        print(', '.join(sorted(tables.keys())))
+        sys.exit(1)
+    if set(use_engines) - set(engines):
+        print(usage)
+        print('No such engine.  Available engines:')
+        print(', '.join(engines))
+        sys.exit(1)
+    try:
+        sizes = [ int(x) for x in sizes.split(',') ]
+        commit_sizes = [ sizing.parse(x) for x in commit_sizes.split(',') ]
+        seed = int(seed)
+        if min(sizes) < 1:
+            raise ValueError(sizes)
+    except ValueError:
+        print(usage)
+        print( 'Rows, commit sizes and the seed must be (positive) numbers, '
+             + 'a commit size may also be auto.' )
+        sys.exit(1)
+
+    if gen_file:
+        if len(use_tables) != 1 or len(sizes) != 1:
+            print(usage)
+            print('Generate a file for a single table and size.')
+            sys.exit(1)
+        written = generate.generate(use_tables[0], gen_file, sizes[0], seed)
+        print('Wrote [ %i ] characters to %s' % (written, gen_file))
+        return
+
+    def progress(result):
+        sys.stderr.write( '%(table)s %(rows)i rows %(engine)s commit '
+                          '%(commit_size)s: %(rows_per_s).0f rows/s\n'
+                        % result )
+    temporary = work_dir is None
+    if temporary:
+        work_dir = tempfile.mkdtemp(prefix='hqs-bench-')
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+    try:
+        report = load.run( use_tables, sizes, use_engines, commit_sizes
+                         , work_dir, seed, progress )
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,304 @@
+'''
+Reading of the CSV input files.
+
+Do not import django (or models) here, these procedures are used from command
+line scripts before django is set up and from worker processes.
+'''
+
+import os, sys, io, csv, gzip, bz2, lzma, locale, hashlib, contextlib
+
+
+# Signatures of the compressed formats we know to decompress on the fly.
+COMPRESSORS = [
+      ( b'\x1f\x8b' , gzip.open )
+    , ( b'BZh' , bz2.open )
+    , ( b'\xfd7zXZ\x00' , lzma.open )
+    ]
+MAGIC_LEN = max(map(lambda x: len(x[0]), COMPRESSORS))
+
+
+class RangeReader(io.RawIOBase):
+    '''
+    Raw binary stream over the bytes of a file between two offsets.  Wrapped in
+    a `TextIOWrapper` it looks like a normal file that ends at `end`.
+    '''
+    def __init__(self, fobj, start, end):
+        self.fobj = fobj
+        self.fobj.seek(start)
+        self.left = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.left <= 0:
+            return 0
+        n = self.fobj.readinto(memoryview(b)[:min(len(b), self.left)])
+        self.left -= n
+        return n
+
+
+class PrefixReader(io.RawIOBase):
+    '''
+    Raw binary stream that returns a few bytes already read from a stream
+    before the rest of the stream.  Needed to sniff the start of a pipe, which
+    cannot be rewound.
+    '''
+    def __init__(self, prefix, fobj):
+        self.prefix = prefix
+        self.fobj = fobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.fobj.read1(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class HashingReader(io.RawIOBase):
+    '''
+    Raw binary stream that feeds everything read through it into a hash.
+    '''
+    def __init__(self, fobj, digest):
+        self.fobj = fobj
+        self.digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fobj.read1(len(b))
+        b[:len(data)] = data
+        self.digest.update(data)
+        return len(data)
+
+
+def compressor(head):
+    '''
+    The function able to decompress a stream starting with `head`, or None if
+    the stream does not look compressed.
+    '''
+    for magic, decompress in COMPRESSORS:
+        if head.startswith(magic):
+            return decompress
+    return None
+
+def is_plain_file(csv_file):
+    '''
+    Whether the input is a regular, uncompressed, file.  Only such a file can
+    be split or seeked into.
+    '''
+    if '-' == csv_file or not os.path.isfile(csv_file):
+        return False
+    with open(csv_file, 'rb') as f:
+        return compressor(f.read(MAGIC_LEN)) is None
+
+@contextlib.contextmanager
+def open_input(csv_file):
+    '''
+    Open the input as a binary stream.  `-` is the standard input, and
+    compressed input (gzip, bzip2 or xz) is decompressed as it is read.
+    Everything is streamed, the memory used does not depend on the file size.
+    '''
+    if '-' == csv_file:
+        rawf = sys.stdin.buffer
+    else:
+        rawf = open(csv_file, 'rb')
+    try:
+        head = rawf.read(MAGIC_LEN)
+        stream = io.BufferedReader(PrefixReader(head, rawf))
+        decompress = compressor(head)
+        if decompress:
+            stream = decompress(stream)
+        yield stream
+    finally:
+        if rawf is not sys.stdin.buffer:
+            rawf.close()
+
+class UnixCsvReader(object):
+    '''
+    Iterator over CSV files in the dialect commonly found on UNIX systems:
+    delimited by commas (,) and quoted in double quotes (").  This simplifies
+    the handling of such a CSV file.
+
+    The file may be `-` for the standard input and may be compressed, see
+    `open_input`.  If a `span` (start and end byte offsets, as returned by
+    `split_csv`) is given only the records in that part of the file are read,
+    which only works on plain files.  Reading can also start at an `offset`,
+    plain files are seeked into, compressed ones are read up to it.  If a
+    `digest` (a hashlib object) is given the whole uncompressed content is fed
+    into it as it is read, from the start even if we start at an offset.
+
+    The reader keeps track of `offset`, the position in the (uncompressed)
+    input just after the last record returned.  The CSV parser only reads
+    the lines it needs for the next record so we can count the bytes of the
+    lines it consumed.
+    '''
+    def __init__(self, csv_file, span=None, offset=0, digest=None):
+        self.stack = contextlib.ExitStack()
+        if span:
+            rawf = self.stack.enter_context(open(csv_file, 'rb'))
+            stream = io.BufferedReader(RangeReader(rawf, *span))
+            offset = span[0]
+        elif offset and not digest and is_plain_file(csv_file):
+            stream = self.stack.enter_context(open(csv_file, 'rb'))
+            stream.seek(offset)
+        else:
+            stream = self.stack.enter_context(open_input(csv_file))
+            if digest:
+                stream = io.BufferedReader(HashingReader(stream, digest))
+            left = offset
+            while left > 0:
+                data = stream.read(min(left, 1 << 20))
+                if not data:
+                    self.close()
+                    raise ValueError('%s is shorter than %i bytes'
+                                     % (csv_file, offset))
+                left -= len(data)
+        self.offset = offset
+        self.consumed = offset
+        self.encoding = locale.getpreferredencoding(False)
+        self.reader = csv.reader( self.lines(stream)
+                                , delimiter=',', quotechar='"' )
+
+    def lines(self, stream):
+        encoding = self.encoding
+        for line in stream:
+            self.consumed += len(line)
+            yield line.decode(encoding)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            row = next(self.reader)
+        except StopIteration:
+            self.close()
+            raise
+        self.offset = self.consumed
+        return row
+
+    def close(self):
+        self.stack.close()
+
+
+def read_unix_csv(csv_file, span=None, offset=0, digest=None):
+    '''
+    Iterate over the rows of a CSV file, see `UnixCsvReader`.
+    '''
+    return UnixCsvReader(csv_file, span, offset, digest)
+
+def fingerprint(csv_file, head=1 << 20):
+    '''
+    Identify a file by its size and a hash of its start.  Cheap enough to be
+    computed for every load and good enough to tell apart two files that
+    happen to have the same name.
+    '''
+    with open(csv_file, 'rb') as f:
+        digest = hashlib.sha1(f.read(head)).hexdigest()
+    return '%i:%s' % (os.path.getsize(csv_file), digest)
+
+def record_ends(data):
+    '''
+    The offsets just after the records of `data`, which starts at a record
+    boundary, as found by counting quotes and as found by the CSV parser.
+    The last record may be cut, it is left out of both.
+    '''
+    data = data[:data.rfind(b'\n') + 1]
+    counted = []
+    quotes = 0
+    last = 0
+    nl = data.find(b'\n')
+    while -1 != nl:
+        quotes += data.count(b'"', last, nl)
+        last = nl
+        if 0 == quotes % 2:
+            counted.append(nl + 1)
+        nl = data.find(b'\n', nl + 1)
+    parsed = []
+    consumed = [0]
+    encoding = locale.getpreferredencoding(False)
+
+    def lines():
+        for line in io.BytesIO(data):
+            consumed[0] += len(line)
+            yield line.decode(encoding, 'replace')
+
+    try:
+        for row in csv.reader(lines(), delimiter=',', quotechar='"'):
+            parsed.append(consumed[0])
+    except csv.Error:
+        pass
+    if parsed and not parsed[-1] in counted:  # cut inside quotes
+        parsed.pop()
+    return counted, parsed
+
+def split_csv(csv_file, parts, block=1 << 20, digest=None, check=1 << 16):
+    '''
+    Split a CSV file into (at most) `parts` spans of similar size, each ending
+    at a record boundary.  A newline is a record boundary only if it is not
+    inside a quoted field, i.e. if an even number of quotes precede it.  An
+    escaped quote in the UNIX dialect is doubled ("") and keeps the count even.
+
+    The whole file is scanned once but only quotes and newlines are looked at,
+    which is a lot quicker than parsing it.  Returns a list of (start, end)
+    byte offsets.  If a `digest` is given the whole file is fed into it, the
+    scan then continues to the end of the file.
+
+    That only holds if every quote opens, closes or escapes (doubled) in a
+    quoted field.  A stray quote inside an unquoted field (ab"c) is just a
+    character to the parser but throws the count off, from there on the
+    boundaries would be wrong.  So the first `check` bytes of every span are
+    parsed as well, and if the parser does not end the records where the
+    count does the whole file is a single span.
+    '''
+    size = os.path.getsize(csv_file)
+    targets = [ size * i // parts for i in range(1, parts) ]
+    bounds = [0]
+    quotes = 0  # quotes before the current block
+    pos = 0     # offset of the current block
+    with open(csv_file, 'rb') as csvf:
+        while targets or digest:
+            data = csvf.read(block)
+            if not data:
+                break
+            if digest:
+                digest.update(data)
+            last = 0  # quotes counted in data[:last]
+            count = 0
+            while targets and targets[0] - pos < len(data):
+                nl = data.find(b'\n', max(targets[0] - pos, last))
+                while -1 != nl:
+                    count += data.count(b'"', last, nl)
+                    last = nl
+                    if 0 == (quotes + count) % 2:
+                        break
+                    nl = data.find(b'\n', nl + 1)
+                if -1 == nl:
+                    # no boundary in this block, continue in the next one
+                    targets[0] = pos + len(data)
+                    break
+                bound = pos + nl + 1
+                bounds.append(bound)
+                targets = [ x for x in targets if x >= bound ]
+            quotes += data.count(b'"')
+            pos += len(data)
+    bounds.append(size)
+    spans = [ (s, e) for s, e in zip(bounds[:-1], bounds[1:]) if e > s ]
+    if 1 < len(spans):
+        with open(csv_file, 'rb') as csvf:
+            for start, end in spans:
+                csvf.seek(start)
+                data = csvf.read(min(check, end - start))
+                counted, parsed = record_ends(data)
+                if counted != parsed:
+                    return [ (0, size) ]
+    return spans
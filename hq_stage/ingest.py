@@ -0,0 +1,204 @@
+'''
+Buffered ingest for the upload API.
+
+Inserting every uploaded record in its own transaction does not scale to
+thousands of requests a second.  When `HQ_DW_UPLOAD_BUFFER` is set to the
+maximum number of queued records, the upload API only validates a record and
+puts it in an in memory queue.  A background thread drains the queue and
+writes the records grouped per table and per batch with a bulk insert, either
+once `HQ_DW_UPLOAD_FLUSH_SIZE` records are waiting or once the oldest record
+has waited `HQ_DW_UPLOAD_FLUSH_INTERVAL` seconds.
+
+The queue is bounded, when it is full the API answers 503 and the client must
+retry later.  The queue is flushed when the process exits.  Records that are
+queued but not flushed are lost if the process is killed, a client that cannot
+afford that must not use a server with the buffer enabled.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import time, atexit, logging, threading, collections
+
+from django.conf import settings
+from django.db import transaction, connection
+
+from . import models, loader, sizing
+
+
+log = logging.getLogger(__name__)
+
+
+class Full(Exception):
+    '''
+    The queue has reached its maximum size.
+    '''
+    pass
+
+
+class Closed(Exception):
+    '''
+    The queue is not accepting records any more, write them synchronously.
+    '''
+    pass
+
+
+class IngestQueue(object):
+    '''
+    Bounded queue of validated records and the thread flushing it.
+
+    Records are kept as (table, batch id, row of input values, attempts), the
+    rows are the same as the ones built by `TableSpec.from_record`.  A group
+    that fails to be inserted is put back and retried on the next flush, up to
+    `MAX_ATTEMPTS` times.
+    '''
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, maxsize, flush_size, interval):
+        self.maxsize = maxsize
+        self.flush_size = flush_size
+        self.interval = interval
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closing = False
+        self.oldest = None  # arrival time of the oldest queued record
+        self.counters = {
+              'queued' : 0
+            , 'flushed' : 0
+            , 'dropped' : 0
+            , 'refused' : 0
+            , 'flushes' : 0
+            , 'last_flush_latency' : 0.0
+            , 'max_flush_latency' : 0.0
+            , 'last_flush_wait' : 0.0
+            }
+        self.thread = threading.Thread( target=self.run
+                                      , name='hq_stage-ingest'
+                                      , daemon=True )
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, table, batch_id, row):
+        with self.cond:
+            if self.closing or not self.thread.is_alive():
+                raise Closed()
+            if len(self.items) >= self.maxsize:
+                self.counters['refused'] += 1
+                raise Full()
+            if not self.items:
+                # the flusher sleeps until something arrives, wake it up to
+                # start the interval of the oldest record
+                self.oldest = time.time()
+                self.cond.notify()
+            self.items.append((table, batch_id, row, 0))
+            self.counters['queued'] += 1
+            if len(self.items) >= self.flush_size:
+                self.cond.notify()
+
+    def take(self):
+        '''
+        Wait until there is something to flush and take it off the queue.
+        '''
+        with self.cond:
+            while not self.closing and len(self.items) < self.flush_size:
+                if self.items:
+                    left = self.oldest + self.interval - time.time()
+                    if left <= 0:
+                        break
+                else:
+                    left = None
+                self.cond.wait(left)
+            items = list(self.items)
+            self.items.clear()
+            if items:
+                self.counters['last_flush_wait'] = time.time() - self.oldest
+            return items
+
+    def run(self):
+        while True:
+            items = self.take()
+            if items:
+                self.flush(items)
+            elif self.closing:
+                break
+        connection.close()
+
+    def flush(self, items):
+        '''
+        Insert the records grouped by table and batch, one transaction per
+        group.  Failed groups go back to the queue.
+        '''
+        start = time.time()
+        groups = collections.OrderedDict()
+        for item in items:
+            groups.setdefault((item[0], item[1]), []).append(item)
+        failed = []
+        for (table, batch_id), group in groups.items():
+            build, insert = loader.TABLES[table].compile(
+                models.Batch(id=batch_id), loader.now() )
+            try:
+                with transaction.atomic():
+                    insert(build([ x[2] for x in group ]))
+                self.counters['flushed'] += len(group)
+            except Exception:
+                log.exception( 'cannot flush %i %s records of batch %i'
+                             , len(group), table, batch_id )
+                for x in group:
+                    if x[3] + 1 < self.MAX_ATTEMPTS and not self.closing:
+                        failed.append(x[:3] + (x[3] + 1,))
+                    else:
+                        self.counters['dropped'] += 1
+        connection.close_if_unusable_or_obsolete()
+        latency = time.time() - start
+        with self.cond:
+            if failed:
+                self.items.extendleft(reversed(failed))
+                self.oldest = time.time()
+            self.counters['flushes'] += 1
+            self.counters['last_flush_latency'] = latency
+            self.counters['max_flush_latency'] = max(
+                latency, self.counters['max_flush_latency'] )
+        if failed:
+            time.sleep(self.interval)  # do not hammer a failing database
+
+    def close(self, timeout=30):
+        '''
+        Stop accepting records, flush what is queued and stop the thread.
+        '''
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats['depth'] = len(self.items)
+            stats['maxsize'] = self.maxsize
+            stats['running'] = self.thread.is_alive() and not self.closing
+        return stats
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+    '''
+    The ingest queue of this process, started on first use.  Returns None if
+    the buffer is not enabled in the settings.
+    '''
+    global _queue
+    maxsize = getattr(settings, 'HQ_DW_UPLOAD_BUFFER', 0)
+    if not maxsize:
+        return None
+    with _queue_lock:
+        if _queue is None:
+            _queue = IngestQueue(
+                  maxsize
+                , getattr( settings, 'HQ_DW_UPLOAD_FLUSH_SIZE'
+                         , sizing.fixed_size() )
+                , getattr(settings, 'HQ_DW_UPLOAD_FLUSH_INTERVAL', 1.0)
+                )
+            _queue.start()
+    return _queue
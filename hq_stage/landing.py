@@ -0,0 +1,506 @@
+'''
+Ingest of the files dropped into a landing directory.
+
+The providers drop their CSV files into a directory and `hqs-watch` loads them
+as they arrive, instead of a cron script calling `hqs-load-table` on each in
+turn.  The directory is watched with inotify where there is one, and scanned
+every `interval` seconds in any case (or only, with `poll`).  A file is taken
+once it is complete: closed after writing or moved into the directory (per
+inotify), or not changed for `interval` seconds.  Names starting with a dot
+are left alone, write the files under such a name and rename them when done.
+
+The table of a file comes from its name, the first of `RULES` (or of
+`HQ_DW_WATCH_RULES`, a list of the same pairs) whose regular expression
+matches a word of the name wins.  The rest of the name, without the
+extensions, is the key of the group of the file: files with the same key go
+into the same `Batch`, e.g. `hq-currency-20161018.csv`,
+`hq-fx-20161018.csv.gz` and `hq-offer-20161018.csv` all go into the batch of
+`hq-20161018`, until it is processed.
+
+The files are loaded in order of arrival by at most `jobs` worker processes
+at once, each loads one file.  A file is moved into `work/` while it is
+loaded, with the output of the load in a `.log` file next to it, and then
+into `done/` (loaded, or loaded before, see `loader.find_loaded`) or
+`failed/`, together with its log.  Files that match no rule go straight into
+`failed/`.  A load that was killed leaves its file in `work/`, the next start
+of the service resumes it after its last committed chunk.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import os, re, sys, time, json, signal, struct, traceback, contextlib
+import collections, multiprocessing
+from multiprocessing.connection import wait
+
+from django.conf import settings
+from django.db import connections
+
+from . import models, loader, util
+from .csvio import is_plain_file
+from .loadstats import LoadStats
+
+
+RULES = [
+      ( r'exchange[-_]?rates?|forex|fx' , 'exchange-rate' )
+    , ( r'currenc(y|ies)' , 'currency' )
+    , ( r'offers?' , 'offer' )
+    ]
+JOBS = 2
+INTERVAL = 5  # seconds between scans
+EXTENSIONS = re.compile(r'(\.(csv|txt))?(\.(gz|bz2|xz))?$', re.I)
+SEPARATORS = re.compile(r'[-_. ]+')
+
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, length of the name
+
+
+Item = collections.namedtuple('Item', 'name path table key recovered')
+
+
+def rules():
+    '''
+    The compiled rules of `HQ_DW_WATCH_RULES` (or `RULES`), raises ValueError
+    if one names no table.
+    '''
+    compiled = []
+    for regex, table in getattr(settings, 'HQ_DW_WATCH_RULES', RULES):
+        if not table in loader.TABLES:
+            raise ValueError('no such table in the rules: %s' % table)
+        compiled.append(( re.compile( r'(?<![a-z0-9])(%s)(?![a-z0-9])'
+                                    % regex, re.I )
+                        , table ))
+    return compiled
+
+def classify(name, compiled):
+    '''
+    The table and the group key of the file name, or None and None.
+    '''
+    for regex, table in compiled:
+        match = regex.search(name)
+        if match:
+            rest = name[:match.start()] + '-' + name[match.end():]
+            rest = EXTENSIONS.sub('', rest)
+            return table, SEPARATORS.sub('-', rest).strip('-').lower()
+    return None, None
+
+def move(path, directory):
+    '''
+    Move the file into the directory without replacing anything there, a
+    number is added to the name if needed.  Returns the new path.
+    '''
+    name = os.path.basename(path)
+    target = os.path.join(directory, name)
+    n = 0
+    while os.path.exists(target):
+        n += 1
+        target = os.path.join(directory, '%s.%i' % (name, n))
+    os.rename(path, target)
+    return target
+
+def inotify(directory):
+    '''
+    A descriptor that reads the events of the files closed after writing or
+    moved into the directory, or None if there is no inotify here.
+    '''
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL( ctypes.util.find_library('c') or 'libc.so.6'
+                          , use_errno=True )
+        init, add = libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    if add(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def events(fd):
+    '''
+    The names of the files in the events waiting on the inotify descriptor.
+    A lost event (e.g. on an overflow) is not a problem, the scan finds the
+    file all the same.
+    '''
+    names = set()
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return names
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos+length].rstrip(b'\0')
+            pos += length
+            if name:
+                names.add(os.fsdecode(name))
+
+
+class Watcher(object):
+    '''
+    Tells which files of the directory are complete.
+    '''
+    def __init__(self, directory, interval, poll=False):
+        self.directory = directory
+        self.interval = interval
+        self.fd = None if poll else inotify(directory)
+        self.seen = {}  # name to size and modification time at the last scan
+        self.fresh = set()  # names closed after writing or moved in
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout, others):
+        '''
+        Wait until something happens in the directory or on one of the
+        `others` (descriptors or sentinels of processes), at most `timeout`
+        seconds.  Returns the `others` that are ready.
+        '''
+        fds = list(others)
+        if self.fd is not None:
+            fds.append(self.fd)
+        ready = wait(fds, timeout)
+        if self.fd in ready:
+            self.fresh.update(events(self.fd))
+        return [ x for x in ready if x != self.fd ]
+
+    def ready(self, everything=False):
+        '''
+        The names of the files that are complete, oldest first: the ones
+        inotify told about and the ones that did not change since the last
+        scan nor for `interval` seconds.  With `everything` all of them are.
+        '''
+        now = time.time()
+        found = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') \
+                    or not entry.is_file(follow_symlinks=False):
+                continue
+            info = entry.stat(follow_symlinks=False)
+            found[entry.name] = (info.st_size, info.st_mtime)
+        names = [ x for x, state in found.items()
+                  if everything or x in self.fresh
+                  or ( self.seen.get(x) == state
+                       and now - state[1] >= self.interval ) ]
+        self.seen = found
+        self.fresh.difference_update(names)
+        self.fresh.intersection_update(found)
+        return sorted(names, key=lambda x: (found[x][1], x))
+
+
+class Groups(object):
+    '''
+    The batches of the groups of files.  A group keeps its batch until the
+    batch is processed, a restart of the service picks the groups up from
+    the `LoadManifest` of the batches that are not processed.
+    '''
+    def __init__(self, compiled):
+        self.batches = {}
+        manifests = models.LoadManifest.objects.filter(batch__processed=False)
+        for name, batch in manifests.order_by('id') \
+                                    .values_list('file_name', 'batch_id'):
+            table, key = classify(os.path.basename(name), compiled)
+            if table:
+                self.batches[key] = batch
+
+    def batch(self, key):
+        '''
+        The id of the batch of the group, a new batch if needed.
+        '''
+        batch = util.get_new_model(models.Batch, self.batches.get(key))
+        if batch.pk is None:
+            batch.save()
+        self.batches[key] = batch.id
+        return batch.id
+
+
+def load_file(job, result):
+    '''
+    Worker of the service, runs in a process forked after django has been
+    set up.  Loads a file into a batch with its output into a log file, and
+    sends a dictionary down the `result` connection: the stats of the load,
+    or the batch the file was loaded into before, or the error.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the service decides
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    path, log, table, batch, resume, options = job
+    spec = loader.TABLES[table]
+    with open(log, 'a') as out, contextlib.redirect_stdout(out):
+        try:
+            loaded = loader.find_loaded(spec, path)
+            if loaded:
+                print( '%s was already loaded into batch %i (%i rows), '
+                       'skipping it.'
+                     % (path, loaded.batch_id, loaded.row_count) )
+                answer = { 'skipped' : loaded.batch_id }
+            else:
+                print('Using batch [%i]' % batch)
+                size = os.path.getsize(path) if is_plain_file(path) else None
+                stats = LoadStats(table, size)
+                rows = loader.load( spec, path
+                                  , models.Batch.objects.get(id=batch)
+                                  , resume=resume, manifest=True
+                                  , stats=stats, **options )
+                print('Rows: [ %i ]' % rows)
+                print('Batch: [ %i ]' % batch)
+                answer = { 'stats' : stats.as_dict() }
+                print(json.dumps(answer['stats'], sort_keys=True))
+        except Exception as e:
+            traceback.print_exc(file=out)
+            answer = { 'error' : str(e) or e.__class__.__name__ }
+    connections.close_all()
+    result.send(answer)
+    result.close()
+
+
+class Service(object):
+    '''
+    Watches the landing `directory` and loads the files dropped into it, with
+    at most `jobs` (default `HQ_DW_WATCH_JOBS`, or 2) loads at once and a
+    scan every `interval` seconds (default `HQ_DW_WATCH_INTERVAL`, or 5).
+    The `options` are passed on to the loader (engine, commit size...).
+
+    A line is written to `out` for every file queued and every file done or
+    failed, with the rate of the load and the depth of the queue.  With
+    `prometheus` the numbers are also written to that file, for the textfile
+    collector of the node exporter.
+    '''
+    def __init__( self, directory, jobs=None, interval=None, poll=False
+                , options=None, prometheus=None, out=sys.stdout ):
+        self.directory = os.path.abspath(directory)
+        self.work = os.path.join(self.directory, 'work')
+        self.done = os.path.join(self.directory, 'done')
+        self.failed = os.path.join(self.directory, 'failed')
+        self.jobs = jobs or getattr(settings, 'HQ_DW_WATCH_JOBS', JOBS)
+        if interval is None:
+            interval = getattr(settings, 'HQ_DW_WATCH_INTERVAL', INTERVAL)
+        self.interval = interval
+        self.poll = poll
+        self.options = options or {}
+        self.prometheus = prometheus
+        self.out = out
+        self.rules = rules()
+        self.groups = None
+        self.queue = collections.OrderedDict()  # name to item, by arrival
+        self.running = {}  # sentinel to item, process, connection and batch
+        self.files = collections.Counter()  # done, skipped, failed...
+        self.rows = 0
+        self.rates = {}  # table to rows per second of its last file
+        self.stopping = 0
+        self.ctx = multiprocessing.get_context('fork')
+
+    def say(self, line):
+        self.out.write( '%s; %i queued, %i running\n'
+                      % (line, len(self.queue), len(self.running)) )
+        self.out.flush()
+
+    def recover(self):
+        '''
+        Queue the files left in `work/` by a service that was killed, before
+        anything else.
+        '''
+        for name in sorted(os.listdir(self.work)):
+            path = os.path.join(self.work, name)
+            if name.endswith('.log') or not os.path.isfile(path):
+                continue
+            table, key = classify(name, self.rules)
+            if not table:
+                continue
+            self.queue[name] = Item(name, path, table, key, True)
+            self.say('queued %s %s again, group %s' % (table, name, key))
+
+    def scan(self, watcher, everything=False):
+        '''
+        Queue the files that are complete, the ones matching no rule fail.
+        '''
+        for name in watcher.ready(everything):
+            if name in self.queue:
+                continue
+            path = os.path.join(self.directory, name)
+            table, key = classify(name, self.rules)
+            if not table:
+                move(path, self.failed)
+                self.files['failed'] += 1
+                self.say('failed %s: no rule for its name' % name)
+                continue
+            self.queue[name] = Item(name, path, table, key, False)
+            self.say('queued %s %s, group %s' % (table, name, key))
+
+    def resume_point(self, path, table):
+        '''
+        The batch of the interrupted load of the file, or None.
+        '''
+        checkpoint = models.LoadCheckpoint.objects.filter(
+              file_name=loader.file_key(path), table=table
+            , batch__processed=False
+            , offset__gt=0 ).order_by('-id').first()
+        return checkpoint and checkpoint.batch_id
+
+    def start(self, item):
+        '''
+        Move the file into `work/` and fork a worker to load it.
+        '''
+        path = os.path.join(self.work, item.name)
+        if item.path != path:
+            try:
+                os.rename(item.path, path)
+            except FileNotFoundError:
+                self.say('%s is gone, forgetting it' % item.name)
+                return
+        batch = item.recovered and self.resume_point(path, item.table)
+        resume = bool(batch)
+        if not batch:
+            batch = self.groups.batch(item.key)
+        job = (path, path + '.log', item.table, batch, resume, self.options)
+        reader, writer = self.ctx.Pipe(duplex=False)
+        # the worker must open its own connection, a forked one is not usable
+        connections.close_all()
+        process = self.ctx.Process(target=load_file, args=(job, writer))
+        process.start()
+        writer.close()
+        self.running[process.sentinel] = (item, process, reader, batch)
+
+    def dispatch(self):
+        '''
+        Start the files of the queue while there are free workers.  A file
+        whose name is still in `work/` waits.
+        '''
+        for name, item in list(self.queue.items()):
+            if len(self.running) >= self.jobs:
+                return
+            if not item.recovered \
+                    and os.path.exists(os.path.join(self.work, name)):
+                continue
+            del self.queue[name]
+            self.start(item)
+
+    def finish(self, sentinel):
+        '''
+        Move the file of a worker that ended into `done/` or `failed/`.
+        '''
+        item, process, reader, batch = self.running.pop(sentinel)
+        process.join()
+        try:
+            answer = reader.recv() if reader.poll() else None
+        except EOFError:  # it died before answering
+            answer = None
+        reader.close()
+        path = os.path.join(self.work, item.name)
+        if answer is None and process.exitcode < 0:
+            self.files['interrupted'] += 1
+            self.say( 'interrupted %s %s, left in work/ to resume it'
+                    % (item.table, item.name) )
+            return
+        if answer is None:
+            answer = { 'error' : 'the worker died with exit code %s'
+                                 % process.exitcode }
+        target = self.failed if 'error' in answer else self.done
+        moved = move(path, target)
+        if os.path.exists(path + '.log'):
+            os.rename(path + '.log', moved + '.log')
+        name = os.path.basename(moved)
+        if 'error' in answer:
+            self.files['failed'] += 1
+            self.say( 'failed %s %s: %s, see failed/%s.log'
+                    % (item.table, name, answer['error'], name) )
+        elif 'skipped' in answer:
+            self.files['skipped'] += 1
+            self.say( 'done %s %s: loaded into batch %i before, skipped'
+                    % (item.table, name, answer['skipped']) )
+        else:
+            stats = answer['stats']
+            self.files['done'] += 1
+            self.rows += stats['rows']
+            self.rates[item.table] = stats['rows_per_s']
+            self.say( 'done %s %s: %i rows in %.1f s, %.0f rows/s, batch %i'
+                    % ( item.table, name, stats['rows'], stats['seconds']
+                      , stats['rows_per_s'], batch ) )
+
+    def write_prometheus(self):
+        '''
+        Write the numbers of the service in the Prometheus text format,
+        replacing the file atomically.
+        '''
+        lines = []
+        def metric(name, kind, doc, values):
+            name = 'hq_stage_watch_' + name
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for label, value in values:
+                lines.append('%s%s %s' % (name, label, value))
+        metric( 'queued_files', 'gauge', 'Files waiting for a worker.'
+              , [ ('', len(self.queue)) ] )
+        metric( 'running_loads', 'gauge', 'Files being loaded.'
+              , [ ('', len(self.running)) ] )
+        metric( 'files_total', 'counter', 'Files handled, by result.'
+              , [ ('{result="%s"}' % x, self.files[x])
+                  for x in [ 'done' , 'skipped' , 'failed' , 'interrupted' ]
+                ] )
+        metric( 'rows_total', 'counter', 'Rows loaded.', [ ('', self.rows) ] )
+        metric( 'rows_per_second', 'gauge'
+              , 'Rate of the last file loaded into the table.'
+              , [ ('{table="%s"}' % x, self.rates[x])
+                  for x in sorted(self.rates) ] )
+        tmp = '%s.%i.tmp' % (self.prometheus, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prometheus)
+
+    def run(self, once=False):
+        '''
+        Watch and load until SIGTERM or SIGINT, then wait for the running
+        loads, a second signal interrupts them (they are resumed at the next
+        start).  With `once` every file there is loaded, complete or not, and
+        we stop once there is nothing left to do.
+        '''
+        for directory in (self.work, self.done, self.failed):
+            os.makedirs(directory, exist_ok=True)
+        self.groups = Groups(self.rules)
+        watcher = Watcher(self.directory, self.interval, self.poll)
+        self.say( 'watching %s with %i workers, %s'
+                % ( self.directory, self.jobs
+                  , 'polling' if watcher.fd is None else 'inotify' ) )
+        self.recover()
+        wake, alarm = os.pipe()
+
+        def stop(signum, frame):
+            self.stopping += 1
+            if self.stopping > 1:
+                for item, process, reader, batch in self.running.values():
+                    process.terminate()
+            os.write(alarm, b'.')
+
+        handlers = [ (x, signal.signal(x, stop))
+                     for x in (signal.SIGTERM, signal.SIGINT) ]
+        try:
+            while True:
+                if not self.stopping:
+                    self.scan(watcher, once)
+                    self.dispatch()
+                if self.prometheus:
+                    self.write_prometheus()
+                if not self.running \
+                        and (self.stopping or once and not self.queue):
+                    break
+                ready = watcher.wait( self.interval
+                                    , list(self.running) + [ wake ] )
+                if wake in ready:
+                    os.read(wake, 64)
+                    if 1 == self.stopping:
+                        self.say( 'stopping, waiting for the running loads '
+                                  '(again to interrupt them)' )
+                for sentinel in ready:
+                    if sentinel in self.running:
+                        self.finish(sentinel)
+        finally:
+            for number, handler in handlers:
+                signal.signal(number, handler)
+            watcher.close()
+            os.close(wake)
+            os.close(alarm)
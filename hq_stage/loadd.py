@@ -0,0 +1,389 @@
+'''
+A warm daemon for the loads.
+
+Every `hqs-load-table` and `hqs-print-errors` sets django up, imports the
+project and connects to the database, and for a small file that costs more
+than the load itself.  `hqs-loadd` does it once: it sets django up and forks
+a number of workers (`-j`, default `HQ_DW_LOADD_JOBS`, or 4), each keeps its
+connection to the database open from one job to the next and runs one job at
+a time.  `hqs-loadc` is the thin client: `hqs-loadc load-table <options>` is
+`hqs-load-table <options>` run by a worker, same options, same output and
+same exit code.
+
+The client and the daemon talk over a Unix socket (`HQ_DW_LOADD_SOCKET`, by
+default `hqs-loadd.sock` in `$XDG_RUNTIME_DIR`, or in a directory of our own,
+`hqs-loadd-<uid>`, in the temporary directory) that only the user running the
+daemon can connect to, the jobs run with the access of the daemon to the
+database.  The client sends its arguments, its working directory and its
+standard input, output and error, the file descriptors themselves, but only
+to a daemon of its own user (the other end of the socket is checked first,
+anybody could be listening on a path given in the settings).  The
+worker runs the tool on them, so `-f -` and the progress on the terminal work
+as they always did, and answers with the exit code.  If the client goes away
+(e.g. on ^C) the job is interrupted.
+
+If no daemon is running the client runs the tool itself.
+
+The settings are read once by the daemon, restart it after changing them.
+
+Do not import django here, the client must start fast.
+'''
+
+import os, sys, json, stat, time, array, struct, select, signal, socket
+import tempfile, threading, traceback
+
+
+TOOLS = { 'load-table' : 'load_table' , 'print-errors' : 'print_errors' }
+JOBS = 4
+FDS = 3  # standard input, output and error
+
+_state = { 'busy' : False , 'running' : False , 'stop' : False }  # a worker
+
+
+class Stop(Exception):
+    '''
+    The daemon was told to stop.
+    '''
+    pass
+
+
+class Untrusted(OSError):
+    '''
+    The socket, or its directory, is not of our user, the message says why.
+    '''
+    pass
+
+
+def socket_directory():
+    '''
+    A directory only our user can get into: `$XDG_RUNTIME_DIR`, or
+    `hqs-loadd-<uid>` in the temporary directory, created if needed.  Raises
+    `Untrusted` if the latter is somebody else's or open to others.
+    '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return runtime
+    path = os.path.join(tempfile.gettempdir(), 'hqs-loadd-%i' % os.getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if ( not stat.S_ISDIR(info.st_mode) or not os.getuid() == info.st_uid
+         or info.st_mode & 0o077 ):
+        raise Untrusted('%s is not a private directory of ours' % path)
+    return path
+
+def socket_path():
+    return os.environ.get('HQ_DW_LOADD_SOCKET') or os.path.join(
+        socket_directory(), 'hqs-loadd.sock' )
+
+def peer_uid(sock, path=None):
+    '''
+    The user at the other end of the connected socket.  Where the system
+    cannot tell (no SO_PEERCRED) it is the owner of the socket at `path`.
+    '''
+    if hasattr(socket, 'SO_PEERCRED'):
+        size = struct.calcsize('3i')
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size)
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid
+    return os.stat(path).st_uid if path else None
+
+def send_request(sock, request, fds):
+    '''
+    Send the request, a dictionary, and the file descriptors.
+    '''
+    data = (json.dumps(request) + '\n').encode('utf-8')
+    # the descriptors go with the first byte, the rest is a plain stream
+    sock.sendmsg( [ data[:1] ]
+                , [ ( socket.SOL_SOCKET, socket.SCM_RIGHTS
+                    , array.array('i', fds) ) ] )
+    sock.sendall(data[1:])
+
+def receive_request(conn):
+    '''
+    Receive a request and its file descriptors.  Raises EOFError if the
+    client hangs up before the request is complete.
+    '''
+    fds = array.array('i')
+    space = socket.CMSG_SPACE(FDS * fds.itemsize)
+    data, ancdata, flags, addr = conn.recvmsg(1, space)
+    for level, kind, payload in ancdata:
+        if socket.SOL_SOCKET == level and socket.SCM_RIGHTS == kind:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    while not data.endswith(b'\n'):
+        more = conn.recv(65536)
+        if not more:
+            for fd in fds:
+                os.close(fd)
+            raise EOFError()
+        data += more
+    return json.loads(data.decode('utf-8')), list(fds)
+
+def client(tool, argv, path=None):
+    '''
+    Run the tool with the arguments in the daemon listening on `path` (see
+    `socket_path`), on our standard streams.  Returns the exit code of the
+    job, or None if there is no daemon.  Raises `Untrusted`, before sending
+    anything, if the daemon is not of our user.
+    '''
+    path = path or socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        if not os.getuid() == peer_uid(sock, path):
+            raise Untrusted('%s is served by another user' % path)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        send_request( sock
+                    , { 'tool' : tool , 'argv' : argv , 'cwd' : os.getcwd() }
+                    , list(range(FDS)) )
+        answer = b''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            answer += data
+    try:
+        return int(json.loads(answer.decode('utf-8'))['exit'])
+    except (ValueError, KeyError, TypeError):
+        sys.stderr.write('hqs-loadc: the daemon went away\n')
+        return 1
+
+def exit_code(e):
+    '''
+    The exit code of a SystemExit, as the interpreter would make it.
+    '''
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    sys.stderr.write('%s\n' % e.code)
+    return 1
+
+def run(tool, argv, cwd, fds):
+    '''
+    Run the tool, with the arguments, in the working directory, with the file
+    descriptors as the standard streams, here in the worker.  Returns the
+    exit code.
+    '''
+    from django import db
+    from hq_stage import command_line, partitions
+    main = getattr(command_line, TOOLS[tool])
+    for connection in db.connections.all():
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+    partitions.forget()  # somebody may have partitioned the tables
+    streams = (sys.stdin, sys.stdout, sys.stderr)
+    for stream in streams[1:]:
+        stream.flush()
+    saved = [ os.dup(x) for x in range(FDS) ]
+    home = os.getcwd()
+    args = sys.argv
+    code = 0
+    try:
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+        # fresh streams, nothing buffered by an earlier job leaks into this
+        # one, and whatever holds on to the old ones writes to the same
+        # descriptors anyway
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+        os.chdir(cwd)
+        sys.argv = [ 'hqs-' + tool ] + list(argv)
+        try:
+            # a cancel only interrupts the tool itself, never the cleanup
+            _state['running'] = True
+            try:
+                main()
+            finally:
+                _state['running'] = False
+        except SystemExit as e:
+            code = exit_code(e)
+        except KeyboardInterrupt:
+            code = 130
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        if code:  # do not trust whatever the job left behind
+            db.connections.close_all()
+    finally:
+        for stream in (sys.stdout, sys.stderr) + streams[1:]:
+            try:
+                stream.flush()
+            except OSError:  # the client is gone
+                pass
+        sys.stdin, sys.stdout, sys.stderr = streams
+        sys.argv = args
+        os.chdir(home)
+        for i, fd in enumerate(saved):
+            os.dup2(fd, i)
+            os.close(fd)
+        for fd in fds:
+            os.close(fd)
+    return code
+
+def watch(conn, done):
+    '''
+    Interrupt the job of the worker if the client hangs up before it is
+    done, i.e. before anything arrives on `done`.
+    '''
+    ready, _, _ = select.select([ conn , done ], [], [])
+    if not done in ready and not conn.recv(1, socket.MSG_PEEK):
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+def handle(conn):
+    '''
+    Run the job of a client and send back its exit code.
+    '''
+    uid = peer_uid(conn)
+    if not uid is None and not os.getuid() == uid:  # the socket is not ours
+        return
+    try:
+        request, fds = receive_request(conn)
+    except (EOFError, ValueError, OSError):
+        return
+    tool = request.get('tool')
+    if not tool in TOOLS or not FDS == len(fds):
+        for fd in fds:
+            os.close(fd)
+        code = 2
+    else:
+        # the watcher must be gone before we answer, while it waits on the
+        # connection the client would not see it closed
+        done, finish = socket.socketpair()
+        watcher = threading.Thread(target=watch, args=(conn, done))
+        watcher.daemon = True
+        watcher.start()
+        try:
+            code = run( tool, request.get('argv', []), request.get('cwd', '/')
+                      , fds )
+        finally:
+            finish.send(b'.')
+            watcher.join()
+            done.close()
+            finish.close()
+    try:
+        conn.sendall(json.dumps({ 'exit' : code }).encode('utf-8') + b'\n')
+    except OSError:
+        pass
+
+def serve(listener):
+    '''
+    The loop of a worker: one job at a time until it is told to stop.  A
+    stop in the middle of a job waits for the job.
+    '''
+    from django import db
+
+    def stop(signum, frame):
+        _state['stop'] = True
+        if not _state['busy']:
+            raise Stop()
+
+    def cancel(signum, frame):
+        if _state['running']:
+            raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGUSR1, cancel)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ^C is for the daemon
+    try:
+        while not _state['stop']:
+            conn, addr = listener.accept()
+            _state['busy'] = True
+            try:
+                with conn:
+                    handle(conn)
+            finally:
+                _state['busy'] = False
+    except Stop:
+        pass
+    finally:
+        db.connections.close_all()
+
+def spawn(listener):
+    '''
+    Fork a worker, returns its pid.
+    '''
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        serve(listener)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
+
+def bind(path, backlog=128):
+    '''
+    Listen on the socket, only for our user.  A socket left behind by a dead
+    daemon is removed, raises OSError if a daemon is running on it.
+    '''
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise OSError('hqs-loadd is running on %s already' % path)
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(backlog)
+    return listener
+
+def daemon(path=None, jobs=None):
+    '''
+    Run the daemon until SIGTERM or SIGINT, with `jobs` workers (default
+    `HQ_DW_LOADD_JOBS`, or 4) listening on `path` (see `socket_path`).  Call
+    it after django.setup().  The workers that die are replaced.
+    '''
+    from django import db
+    from django.conf import settings
+    path = path or socket_path()
+    jobs = jobs or getattr(settings, 'HQ_DW_LOADD_JOBS', JOBS)
+    listener = bind(path)
+    db.connections.close_all()  # every worker connects on its own
+
+    def stop(signum, frame):
+        raise Stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    workers = set()
+    sys.stderr.write('hqs-loadd: %i workers on %s\n' % (jobs, path))
+    try:
+        while True:
+            while len(workers) < jobs:
+                workers.add(spawn(listener))
+            pid, status = os.wait()
+            workers.discard(pid)
+            sys.stderr.write( 'hqs-loadd: worker %i died (%i), replacing it\n'
+                            % (pid, status) )
+            time.sleep(1)  # do not spin if they die at once
+    except Stop:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
+        listener.close()
+        os.unlink(path)
@@ -0,0 +1,427 @@
+'''
+Table driven loading of CSV files into the staging tables.
+
+The input files are not consistent, every table has its own quirks:
+
+*   currency has a header and a dummy row
+*   exchange rate has a header only
+*   and offer has a dummy row only
+
+These are described once per table in a `TableSpec`, together with the column
+layout of the table.  The layout is worked out once per load and each CSV row
+is then mapped onto a plain tuple of column values, there is no per row
+dictionary or keyword argument expansion.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import os, time, datetime, hashlib
+from itertools import islice
+from pytz import timezone
+
+from django.conf import settings
+from django.db import transaction, connection, connections, DEFAULT_DB_ALIAS
+
+from . import models, bulk, sizing, pipeline, validation, partitions
+from .csvio import read_unix_csv, fingerprint
+from .loadstats import NULL_STATS
+
+
+class TableSpec(object):
+    '''
+    Describes how a CSV file maps onto a staging table.
+
+    The input fields are the concrete fields of the model that are not part of
+    `DataRow` (nor the primary key), in the order they are declared, which is
+    also the order of the columns in the file.  Short rows are padded with a
+    single space and long rows are cut at the number of input fields, on the
+    offer table the last input field (`dummy_field`) catches the first extra
+    column.
+    '''
+    def __init__(self, table, model, skip, name):
+        self.table = table
+        self.model = model
+        self.skip = skip  # rows to ignore at the start of the file
+        self.name = name  # plural used in the progress messages
+        abstract = set(f.name for f in models.DataRow._meta.get_fields())
+        fields = model._meta.concrete_fields
+        self.infields = [ f.name for f in fields
+                          if not f.primary_key and not f.name in abstract ]
+        # the model constructor takes the values in the order of the concrete
+        # fields, and a row is built as prefix + input fields
+        self.width = len(self.infields)
+        assert self.infields == [ f.name for f in fields[-self.width:] ]
+        self.pad = (' ',) * self.width
+        self.columns = [ model._meta.get_field(x) for x in self.infields ]
+        self.fieldset = set(self.infields)
+
+    def from_record(self, data):
+        '''
+        Map a record, a dictionary from field names to values as sent to the
+        upload API, onto a row of input values.  Missing fields get their
+        default.  Raises `ValueError` with the reason if the record does not
+        fit in the table.
+        '''
+        if not dict == type(data):
+            raise ValueError('not an object')
+        unknown = set(data) - self.fieldset
+        if unknown:
+            raise ValueError('unknown fields: ' + ', '.join(sorted(unknown)))
+        row = []
+        for f in self.columns:
+            value = data.get(f.name, f.get_default())
+            if not str == type(value):
+                raise ValueError('%s is not a string' % f.name)
+            if len(value) > f.max_length:
+                raise ValueError( '%s is longer than %i characters'
+                                % (f.name, f.max_length) )
+            row.append(value)
+        return row
+
+    def compile(self, batch, insert_date, engine='orm', validate=False):
+        '''
+        Precompute what is needed to turn CSV rows into tuples and insert them
+        for a single load.  Returns a function that builds the tuples from a
+        list of CSV rows and a function that inserts a list of such tuples.
+
+        The inserted rows are pending, the insert adds them to the summary of
+        the batch in the same transaction.  With `validate` the built rows
+        that break the rules of the table (see `validation`) are in error
+        instead.
+        '''
+        values = { 'batch' : batch.id , 'insert_date' : insert_date }
+        model = self.model
+        width = self.width
+        pad = self.pad
+        fields, prefix = bulk.fixed_values(model, self.infields, values)
+        fields = [ f.name for f in fields ]
+        if 'copy' == engine:
+            columns, prefix = bulk.prepare_layout(model, self.infields, values)
+            # straight into the partition of the batch, if there is one
+            target = partitions.table(model, batch.id)
+            insert_rows = lambda rows: bulk.insert_rows( model, columns, rows
+                                                       , table=target )
+        else:
+            prefix = (None,) + tuple(prefix)  # the primary key
+            fields = [ None ] + fields
+            insert_rows = lambda rows: model.objects.bulk_create(
+                [ model(*x) for x in rows ] )
+        # positions of the fields in the built rows
+        positions = dict( (x, i) for i, x in
+                          enumerate(fields + self.infields) )
+        in_error = positions['in_error']
+        if validate:
+            validator = validation.Validator(self.table, positions)
+            error_flags = [ (positions[x], True)
+                            for x in ('processed', 'in_error') ]
+            if 'copy' == engine:  # the prefix is ready for the database
+                db = connections[DEFAULT_DB_ALIAS]
+                field = model._meta.get_field('in_error')
+                error_flags = [ (i, field.get_db_prep_save(v, db))
+                                for i, v in error_flags ]
+            error_text = positions['fields_in_error']
+
+        def build(chunk):
+            rows = [ prefix + tuple(row[:width]) + pad[len(row):]
+                     for row in chunk ]
+            if validate:
+                for i, names in validator.errors(rows).items():
+                    row = list(rows[i])
+                    for pos, value in error_flags:
+                        row[pos] = value
+                    row[error_text] = ','.join(names)
+                    rows[i] = tuple(row)
+            return rows
+
+        def insert(rows, ready=None):
+            # `ready` is called between inserting the rows and updating the
+            # summary, a pipelined load waits there for its turn
+            if not rows:
+                if ready:
+                    ready()
+                return
+            errors = sum(1 for x in rows if x[in_error])
+            with transaction.atomic():
+                insert_rows(rows)
+                if ready:
+                    ready()
+                models.BatchSummary.add( model, batch.id
+                                       , { 'pending' : len(rows) - errors
+                                         , 'in_error' : errors } )
+        return build, insert
+
+
+def now():
+    '''
+    The insert date for rows inserted in bulk, `bulk_create` and friends do
+    not call save() so we need to add the date ourselves.
+    '''
+    tz = timezone(settings.TIME_ZONE)
+    return tz.localize(datetime.datetime.now())
+
+
+class LoadError(Exception):
+    '''
+    The load cannot be done, the message says why.
+    '''
+    pass
+
+
+TABLES = dict( (x.table, x) for x in [
+      TableSpec('currency', models.Currency, 2, 'currencies')
+    , TableSpec('exchange-rate', models.ExchangeRate, 1, 'exchange rates')
+    , TableSpec('offer', models.Offer, 1, 'offers')
+    ] )
+FILE_NAME = 255  # the length of `file_name` in checkpoints and manifests
+
+
+def file_key(csv_file):
+    '''
+    The absolute path of the file as we record it in the `file_name` of the
+    checkpoints and the manifest, at most FILE_NAME characters.  A longer path
+    keeps its end (the name of the file) behind a hash of the whole path, so
+    that two of them never get the same key.
+    '''
+    path = os.path.abspath(csv_file)
+    if len(path) <= FILE_NAME:
+        return path
+    digest = hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+    return digest + ':' + path[len(path) - FILE_NAME + len(digest) + 1:]
+
+def get_checkpoint(spec, csv_file, batch, resume=False):
+    '''
+    The checkpoint of the load of the file into the table of the batch.  If we
+    are not resuming the load starts afresh from the start of the file.
+    '''
+    finger = fingerprint(csv_file)
+    checkpoint, created = models.LoadCheckpoint.objects.get_or_create(
+          batch=batch
+        , file_name=file_key(csv_file)
+        , table=spec.table
+        , defaults={ 'fingerprint' : finger }
+        )
+    if resume and finger != checkpoint.fingerprint:
+        raise LoadError( '%s is not the file that was loaded into batch %i'
+                       % (csv_file, batch.id) )
+    if not resume:
+        checkpoint.fingerprint = finger
+        checkpoint.offset = 0
+        checkpoint.row_number = 0
+        checkpoint.save()
+    return checkpoint
+
+
+def find_loaded(spec, csv_file):
+    '''
+    The manifest of a previous load of the same file into the same table, or
+    None.  We trust the fingerprint (the size and the start of the file), the
+    whole content is not read twice for every load.  A file that only differs
+    from a loaded one past its first MiB is skipped too, load it with --force
+    if you ever have such files.  The standard input cannot be checked in
+    advance.
+    '''
+    if '-' == csv_file:
+        return None
+    return models.LoadManifest.objects.filter(
+          table=spec.table
+        , fingerprint=fingerprint(csv_file)
+        ).order_by('id').first()
+
+def record_manifest(spec, csv_file, batch, digest, size, rows, started):
+    '''
+    Record a completed load in the manifest.  Content that was not caught by
+    `find_loaded` (e.g. from the standard input) is recorded all the same, but
+    we tell about it.
+    '''
+    finger = ''
+    if '-' != csv_file:
+        finger = fingerprint(csv_file)
+        csv_file = file_key(csv_file)
+    hexdigest = digest.hexdigest()
+    previous = models.LoadManifest.objects.filter(
+        table=spec.table, content_hash=hexdigest ).first()
+    if previous:
+        print( 'WARNING: the same content was loaded into batch %i already'
+             % previous.batch_id )
+    return models.LoadManifest.objects.create(
+          batch=batch
+        , file_name=csv_file
+        , table=spec.table
+        , fingerprint=finger
+        , content_hash=hexdigest
+        , size=size
+        , row_count=rows
+        , date_started=started
+        , date_finished=now()
+        )
+
+def load( spec, csv_file, batch, engine='orm', span=None, resume=False
+        , manifest=False, stats=None, commit_size=None, writers=0
+        , validate=False ):
+    '''
+    Bulk insert of the CSV file into the table described by `spec`.
+
+    Since we may have a lot of records being inserted firing an insert for each
+    would not be quick enough in most warehouses.  Instead we use a bulk insert
+    every a certain number of records.
+
+    With the `copy` engine we do not even build the model instances, the rows
+    are streamed straight into the table (see the `bulk` module).  If a `span`
+    of the file is given, the rows to skip are only skipped when the span is
+    the start of the file.  Returns the number of rows loaded.
+
+    Loads of a whole file (not the standard input, nor a span) record a
+    `LoadCheckpoint` in the same transaction as each chunk.  With `resume` the
+    load restarts just after the last committed chunk of a previous load of
+    the same file into the same batch.
+
+    With `manifest` the content is hashed as it is read and the completed load
+    is recorded in the `LoadManifest`.
+
+    A `loadstats.LoadStats` given as `stats` is told about every phase of
+    every chunk.
+
+    The rows are committed `commit_size` (default `HQ_DW_COMMIT_SIZE`) at a
+    time, with `auto` the size is adapted as we go (see `sizing`) and the
+    sizes used are printed at the end.
+
+    With `writers` the load is pipelined (see `pipeline`): the file is read
+    while that many threads insert the chunks read before.
+
+    With `validate` the rows that break the rules of the table are loaded in
+    error (see `validation`).
+    '''
+    if stats is None:
+        stats = NULL_STATS
+    sizer = sizing.sizer(spec.model, engine, commit_size)
+    started = now()
+    digest = None
+    if manifest:
+        digest = hashlib.sha256()
+    checkpoint = None
+    offset = 0
+    if not span and '-' != csv_file:
+        checkpoint = get_checkpoint(spec, csv_file, batch, resume)
+        offset = checkpoint.offset
+        if offset:
+            print( 'resuming after row %i (byte %i)'
+                 % (checkpoint.row_number, offset) )
+    elif resume:
+        raise LoadError('only a whole file can be resumed')
+    try:
+        reader = read_unix_csv(csv_file, span, offset, digest)
+    except ValueError as e:
+        raise LoadError(str(e))
+    stats.begin(reader.consumed)
+    if not offset and (not span or 0 == span[0]):
+        for i in range(spec.skip):
+            next(reader, None)
+    build, insert = spec.compile(batch, now(), engine, validate)
+    rows = 0
+    if writers:
+        rows = load_pipelined( spec, reader, build, insert, checkpoint, sizer
+                             , stats, writers )
+    else:
+        with stats.counting():
+            while True:
+                stats.start_chunk()
+                size = sizer.size
+                chunk = list(islice(reader, size))
+                stats.lap('read')
+                built = build(chunk)
+                stats.lap('build')
+                start = time.perf_counter()
+                with transaction.atomic():
+                    insert(built)
+                    if checkpoint:
+                        checkpoint.offset = reader.offset
+                        checkpoint.row_number += len(chunk)
+                        checkpoint.save()
+                    stats.lap('insert')
+                stats.lap('commit')
+                sizer.observe(len(chunk), time.perf_counter() - start)
+                stats.end_chunk(len(chunk), reader.consumed)
+                rows += len(chunk)
+                if len(chunk) < size:
+                    break
+                print('commit', size, spec.name)
+    print('final commit, and we are done')
+    sizes = sizer.report()
+    stats.sized(sizes)
+    if sizing.AUTO == sizes['mode']:
+        print( 'commit sizes of %s: first %i, last %i, min %i, max %i'
+             % ( spec.name, sizes['first'], sizes['last'], sizes['min']
+               , sizes['max'] ) )
+    if manifest:
+        total = checkpoint.row_number if checkpoint else rows
+        record_manifest( spec, csv_file, batch, digest, reader.consumed
+                       , total, started )
+    return rows
+
+def load_pipelined( spec, reader, build, insert, checkpoint, sizer, stats
+                  , writers ):
+    '''
+    The chunk loop of `load`, with the reading and building done here while
+    `writers` threads insert and commit the chunks, in the order they were
+    read.  The time spent in each phase is added up over the threads, the
+    phases overlap and add up to more than the duration of the load.
+
+    SQLite locks the whole database from the first insert of a transaction
+    until the commit, a writer waiting for its turn with the lock would stop
+    the writer of the chunk before it for good.  There is a single writer
+    on SQLite.
+    '''
+    if writers > 1 and 'sqlite' == connection.vendor:
+        print('SQLite takes a single writer, using one')
+        writers = 1
+
+    def chunks():
+        while True:
+            start = time.perf_counter()
+            size = sizer.size
+            chunk = list(islice(reader, size))
+            read = time.perf_counter()
+            built = build(chunk)
+            yield ( built, len(chunk), size, reader.offset, reader.consumed
+                  , read - start, time.perf_counter() - read )
+            if len(chunk) < size:
+                return
+
+    rows = [0]
+
+    def write(seq, item, turn):
+        built, count, size, offset, consumed, read, build_time = item
+        waited = [0]
+
+        def ready():
+            start = time.perf_counter()
+            turn.wait(seq)
+            waited[0] = time.perf_counter() - start
+        start = time.perf_counter()
+        with transaction.atomic():
+            insert(built, ready)
+            if checkpoint:
+                checkpoint.offset = offset
+                checkpoint.row_number += count
+                checkpoint.save()
+            inserted = time.perf_counter()
+        # our turn, nobody else gets here until we call turn.done()
+        committed = time.perf_counter()
+        seconds = committed - start - waited[0]
+        stats.add('read', read)
+        stats.add('build', build_time)
+        stats.add('insert', inserted - start - waited[0])
+        stats.add('commit', committed - inserted)
+        stats.end_chunk(count, consumed, read + build_time + seconds)
+        sizer.observe(count, seconds)
+        rows[0] += count
+        if count == size:
+            print('commit', size, spec.name)
+        turn.done(seq)
+
+    pipe = pipeline.Pipeline( write, writers
+                            , getattr(settings, 'HQ_DW_PIPELINE_DEPTH', None)
+                            , stats.counting )
+    with stats.counting():
+        pipe.run(chunks())
+    return rows[0]
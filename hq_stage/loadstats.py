@@ -0,0 +1,287 @@
+'''
+Instrumentation of the loads.
+
+A `LoadStats` is passed to `loader.load`, which marks the end of every phase
+of every chunk: reading (and parsing) the CSV, building the rows, inserting
+them and committing.  The time spent in each phase is added up, together with
+the rows, bytes, chunks and database statements, and the best rate of a
+single chunk.  The numbers can be printed as progress lines while the load
+runs, returned as a dictionary or written as a Prometheus text file for the
+textfile collector of the node exporter.
+
+When nothing is asked for the loader gets `NULL_STATS`, whose methods do
+nothing, the cost is a handful of empty calls per chunk.
+
+Do not import models here.
+'''
+
+import os, sys, time, datetime, threading, contextlib
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+PHASES = [ 'read' , 'build' , 'insert' , 'commit' ]
+MAKERS = [ 'make_cursor' , 'make_debug_cursor' ]
+
+
+class CountingCursor(object):
+    '''
+    A cursor of Django (plain, or logging the queries under DEBUG) that
+    counts the statements sent through it, COPY included.
+    '''
+    def __init__(self, cursor, counter):
+        self.wrapped = cursor
+        self.counter = counter
+
+    def __getattr__(self, attr):
+        return getattr(self.wrapped, attr)
+
+    def __iter__(self):
+        return iter(self.wrapped)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return self.wrapped.__exit__(*exc)
+
+    def execute(self, sql, params=None):
+        self.counter[0] += 1
+        return self.wrapped.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter[0] += 1
+        return self.wrapped.executemany(sql, param_list)
+
+    def copy_expert(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.wrapped.copy_expert(*args, **kwargs)
+
+    def copy_from(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.wrapped.copy_from(*args, **kwargs)
+
+
+@contextlib.contextmanager
+def count_queries(using=DEFAULT_DB_ALIAS):
+    '''
+    Count the statements executed through the Django cursors of the
+    connection of this thread, yields a list holding the count.
+    '''
+    counter = [0]
+    # the wrapper itself, the `connection` proxy has none of its attributes
+    wrapper = connections[using]
+    saved = dict( (x, wrapper.__dict__[x]) for x in MAKERS
+                  if x in wrapper.__dict__ )
+    # wrap the cursor django would make, so DEBUG still logs the queries
+    for name in MAKERS:
+        make = getattr(wrapper, name)
+        counting = lambda cursor, make=make: CountingCursor( make(cursor)
+                                                           , counter )
+        setattr(wrapper, name, counting)
+    try:
+        yield counter
+    finally:
+        for name in MAKERS:
+            if name in saved:
+                setattr(wrapper, name, saved[name])
+            else:
+                delattr(wrapper, name)
+
+
+class NullStats(object):
+    '''
+    Does nothing, for loads that are not instrumented.
+    '''
+    def begin(self, consumed):
+        pass
+
+    def start_chunk(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def add(self, phase, seconds):
+        pass
+
+    def end_chunk(self, rows, consumed, seconds=None):
+        pass
+
+    def sized(self, report):
+        pass
+
+    def counting(self):
+        return contextlib.ExitStack()
+
+NULL_STATS = NullStats()
+
+
+class LoadStats(NullStats):
+    '''
+    Counters and timers of a load.  `end` is the byte offset at which the
+    input ends (the size of a whole file), if known, for the ETA.  With a
+    `progress` interval (in seconds) a progress line is written to `out` at
+    most that often.
+    '''
+    def __init__(self, table, end=None, progress=None, out=sys.stderr):
+        self.table = table
+        self.end = end
+        self.progress = progress
+        self.out = out
+        self.rows = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.queries = 0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.peak_rate = 0.0
+        self.commit_sizes = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.first_byte = 0
+        self.last = self.start
+        self.chunk_start = self.start
+        self.next_report = self.start + (progress or 0)
+
+    def begin(self, consumed):
+        '''
+        The reader starts at `consumed` bytes (e.g. when resuming).
+        '''
+        self.first_byte = consumed
+
+    def start_chunk(self):
+        self.last = self.chunk_start = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] += now - self.last
+        self.last = now
+
+    def add(self, phase, seconds):
+        '''
+        Time spent in a phase, for loads that time the phases themselves.
+        '''
+        self.phases[phase] += seconds
+        self.last = time.perf_counter()
+
+    def end_chunk(self, rows, consumed, seconds=None):
+        '''
+        A chunk of `rows` was committed, the reader is at byte `consumed`.
+        The chunk took `seconds`, or the time since `start_chunk()`.
+        '''
+        self.chunks += 1
+        self.rows += rows
+        self.bytes = consumed - self.first_byte
+        elapsed = seconds
+        if elapsed is None:
+            elapsed = self.last - self.chunk_start
+        if rows and elapsed > 0:
+            self.peak_rate = max(self.peak_rate, rows / elapsed)
+        if self.progress and self.last >= self.next_report:
+            self.report()
+            self.next_report = self.last + self.progress
+
+    def sized(self, report):
+        '''
+        The commit sizes used by the load, see `sizing`.
+        '''
+        self.commit_sizes.append(report)
+
+    @contextlib.contextmanager
+    def counting(self):
+        with count_queries() as counter:
+            try:
+                yield
+            finally:
+                with self.lock:  # pipelined loads count in every thread
+                    self.queries += counter[0]
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def report(self):
+        '''
+        Write a progress line, with an ETA if we know the size of the input.
+        '''
+        elapsed = self.elapsed()
+        line = '%s: %i rows, %.0f rows/s, %.1f MiB' % (
+              self.table
+            , self.rows
+            , self.rows / elapsed if elapsed else 0
+            , self.bytes / 1048576.0 )
+        left = (self.end or 0) - self.first_byte - self.bytes
+        if self.end and self.bytes and left >= 0:
+            eta = datetime.timedelta(
+                seconds=int(left * elapsed / self.bytes) )
+            done = 100.0 * self.bytes / (self.end - self.first_byte)
+            line += ', %.0f%%, ETA %s' % (done, eta)
+        self.out.write(line + '\n')
+        self.out.flush()
+
+    def as_dict(self):
+        seconds = self.elapsed()
+        return {
+              'table' : self.table
+            , 'rows' : self.rows
+            , 'bytes' : self.bytes
+            , 'chunks' : self.chunks
+            , 'queries' : self.queries
+            , 'seconds' : round(seconds, 3)
+            , 'phases' : dict( (k, round(v, 3))
+                               for k, v in self.phases.items() )
+            , 'rows_per_s' : round(self.rows / seconds, 1) if seconds else 0
+            , 'peak_rows_per_s' : round(self.peak_rate, 1)
+            , 'commit_sizes' : self.commit_sizes
+            }
+
+    def merge(self, other):
+        '''
+        Add up the counters of another load (as returned by `as_dict`), e.g.
+        of a worker of a parallel load.  The peak rate is the best chunk of
+        any of them.
+        '''
+        self.rows += other['rows']
+        self.bytes += other['bytes']
+        self.chunks += other['chunks']
+        self.queries += other['queries']
+        for phase in PHASES:
+            self.phases[phase] += other['phases'][phase]
+        self.peak_rate = max(self.peak_rate, other['peak_rows_per_s'])
+        self.commit_sizes.extend(other['commit_sizes'])
+
+    def write_prometheus(self, path, success=True):
+        '''
+        Write the numbers of the load in the Prometheus text format.  The file
+        is replaced atomically, the collector never reads half a file.
+        '''
+        stats = self.as_dict()
+        label = 'table="%s"' % self.table
+        metrics = [
+              ( 'rows', 'Rows loaded.', stats['rows'] )
+            , ( 'bytes', 'Bytes of input read.', stats['bytes'] )
+            , ( 'chunks', 'Chunks committed.', stats['chunks'] )
+            , ( 'queries', 'Database statements.', stats['queries'] )
+            , ( 'duration_seconds', 'Duration of the load.'
+              , stats['seconds'] )
+            , ( 'peak_rows_per_second', 'Best rate of a single chunk.'
+              , stats['peak_rows_per_s'] )
+            , ( 'success', 'Whether the load succeeded.', int(success) )
+            , ( 'finish_time_seconds', 'Unix time the load finished.'
+              , round(time.time(), 3) )
+            ]
+        lines = []
+        for name, doc, value in metrics:
+            name = 'hq_stage_load_' + name
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s{%s} %s' % (name, label, value))
+        name = 'hq_stage_load_phase_seconds'
+        lines.append('# HELP %s Time spent in each phase.' % name)
+        lines.append('# TYPE %s gauge' % name)
+        for phase in PHASES:
+            lines.append( '%s{%s,phase="%s"} %s'
+                        % (name, label, phase, stats['phases'][phase]) )
+        tmp = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 08:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_stage', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoadCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(help_text='absolute path of the loaded file', max_length=255, verbose_name='file name')),
+                ('table', models.CharField(help_text='the table the file is loaded into', max_length=32, verbose_name='table')),
+                ('fingerprint', models.CharField(help_text='size and hash of the start of the file', max_length=64, verbose_name='fingerprint')),
+                ('offset', models.BigIntegerField(default=0, help_text='byte offset after the last committed row', verbose_name='offset')),
+                ('row_number', models.BigIntegerField(default=0, help_text='number of rows committed', verbose_name='row number')),
+                ('date_updated', models.DateTimeField(blank=True, editable=False, help_text='last time a chunk was committed', null=True, verbose_name='date updated')),
+                ('batch', models.ForeignKey(help_text='the batch the file is loaded into', on_delete=django.db.models.deletion.CASCADE, related_name='checkpoint_set', to='hq_stage.Batch', verbose_name='batch')),
+            ],
+            options={
+                'verbose_name': 'load checkpoint',
+                'verbose_name_plural': 'load checkpoints',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='loadcheckpoint',
+            unique_together=set([('batch', 'file_name', 'table')]),
+        ),
+    ]
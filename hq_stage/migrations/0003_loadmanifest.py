@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 08:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_stage', '0002_loadcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoadManifest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(help_text='path of the loaded file', max_length=255, verbose_name='file name')),
+                ('table', models.CharField(help_text='the table the file was loaded into', max_length=32, verbose_name='table')),
+                ('fingerprint', models.CharField(blank=True, db_index=True, help_text='size and hash of the start of the file', max_length=64, verbose_name='fingerprint')),
+                ('content_hash', models.CharField(db_index=True, help_text='sha256 of the uncompressed content', max_length=64, verbose_name='content hash')),
+                ('size', models.BigIntegerField(help_text='bytes of uncompressed content', verbose_name='size')),
+                ('row_count', models.BigIntegerField(help_text='number of rows loaded', verbose_name='row count')),
+                ('date_started', models.DateTimeField(help_text='start of the load', verbose_name='date started')),
+                ('date_finished', models.DateTimeField(help_text='end of the load', verbose_name='date finished')),
+                ('batch', models.ForeignKey(help_text='the batch the file was loaded into', on_delete=django.db.models.deletion.CASCADE, related_name='manifest_set', to='hq_stage.Batch', verbose_name='batch')),
+            ],
+            options={
+                'verbose_name': 'load manifest',
+                'verbose_name_plural': 'load manifests',
+            },
+        ),
+    ]
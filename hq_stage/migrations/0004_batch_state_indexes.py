@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 08:19
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+TABLES = [ 'hq_stage_currency' , 'hq_stage_exchangerate' , 'hq_stage_offer' ]
+
+
+def create_error_indexes(apps, schema_editor):
+    """
+    The unignored errors of a batch.  PostgreSQL and SQLite can index only
+    the rows that are not ignored, elsewhere the ignore flag is indexed too.
+    """
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    for table in TABLES:
+        name = qn(table + '_batch_errors')
+        if 'postgresql' == connection.vendor:
+            where = 'WHERE NOT %s' % qn('ignore')
+        elif 'sqlite' == connection.vendor:
+            where = 'WHERE %s = 0' % qn('ignore')
+        else:
+            where = None
+        if where:
+            sql = 'CREATE INDEX %s ON %s (batch_id, in_error) %s' % (
+                name, qn(table), where )
+        else:
+            sql = 'CREATE INDEX %s ON %s (batch_id, in_error, %s)' % (
+                name, qn(table), qn('ignore') )
+        schema_editor.execute(sql)
+
+
+def drop_error_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    for table in TABLES:
+        if 'mysql' == connection.vendor:
+            sql = 'DROP INDEX %s ON %s' % (
+                qn(table + '_batch_errors'), qn(table) )
+        else:
+            sql = 'DROP INDEX %s' % qn(table + '_batch_errors')
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_stage', '0003_loadmanifest'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='currency',
+            index_together=set([('in_error', 'ignore'), ('batch', 'processed')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='exchangerate',
+            index_together=set([('in_error', 'ignore'), ('batch', 'processed')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='offer',
+            index_together=set([('in_error', 'ignore'), ('batch', 'processed')]),
+        ),
+        migrations.RunPython(create_error_indexes, drop_error_indexes),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 08:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+STATES = [
+      ( 'pending' , ( False , False , False ) )
+    , ( 'processed' , ( True , False , False ) )
+    , ( 'in_error' , ( True , True , False ) )
+    , ( 'ignored' , ( True , True , True ) )
+    ]
+
+
+def fill_summaries(apps, schema_editor):
+    """
+    Count the rows already in the staging tables, the same as
+    `BatchSummary.reconcile` (which we cannot call from a migration).
+    """
+    BatchSummary = apps.get_model('hq_stage', 'BatchSummary')
+    states = dict( (flags, name) for name, flags in STATES )
+    for model_name in [ 'currency' , 'exchangerate' , 'offer' ]:
+        model = apps.get_model('hq_stage', model_name)
+        counts = {}
+        groups = ( model.objects
+                   .values('batch_id', 'processed', 'in_error', 'ignore')
+                   .annotate(n=models.Count('id')).order_by('batch_id') )
+        for group in groups:
+            summary = counts.setdefault( group['batch_id']
+                                       , dict.fromkeys(states.values(), 0) )
+            state = states.get(( group['processed'], group['in_error']
+                               , group['ignore'] ))
+            if state:
+                summary[state] += group['n']
+        BatchSummary.objects.bulk_create([
+            BatchSummary(batch_id=b, table=model_name, **summary)
+            for b, summary in sorted(counts.items()) ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_stage', '0004_batch_state_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(help_text='name of the model of the rows', max_length=32, verbose_name='table')),
+                ('pending', models.BigIntegerField(default=0, help_text='rows not yet uploaded to the warehouse', verbose_name='pending')),
+                ('processed', models.BigIntegerField(default=0, help_text='rows uploaded to the warehouse', verbose_name='processed')),
+                ('in_error', models.BigIntegerField(default=0, help_text='rows that failed the upload', verbose_name='in error')),
+                ('ignored', models.BigIntegerField(default=0, help_text='rows in error that are ignored', verbose_name='ignored')),
+                ('date_updated', models.DateTimeField(blank=True, editable=False, help_text='last change of the counts', null=True, verbose_name='date updated')),
+                ('batch', models.ForeignKey(help_text='the batch the rows belong to', on_delete=django.db.models.deletion.CASCADE, related_name='summary_set', to='hq_stage.Batch', verbose_name='batch')),
+            ],
+            options={
+                'verbose_name': 'batch summary',
+                'verbose_name_plural': 'batch summaries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='batchsummary',
+            unique_together=set([('batch', 'table')]),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
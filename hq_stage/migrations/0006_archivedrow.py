@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 08:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_stage', '0005_batchsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedRow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(help_text='the table the row was archived from', max_length=32, verbose_name='table')),
+                ('row_id', models.IntegerField(help_text='primary key of the row in the staging table', verbose_name='row id')),
+                ('batch_id', models.IntegerField(help_text='the batch of the row', verbose_name='batch id')),
+                ('insert_date', models.DateTimeField(help_text='insertion in the stage database', verbose_name='insert date')),
+                ('ignore', models.BooleanField(default=False, help_text='set if the row was an ignored error', verbose_name='ignore')),
+                ('fields_in_error', models.TextField(blank=True, help_text='fields in error of an ignored row', null=True, verbose_name='fields in error')),
+                ('data', models.TextField(help_text='the input fields as a CSV line', verbose_name='data')),
+                ('date_archived', models.DateTimeField(help_text='when the row was archived', verbose_name='date archived')),
+            ],
+            options={
+                'verbose_name': 'archived row',
+                'verbose_name_plural': 'archived rows',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='archivedrow',
+            unique_together=set([('table', 'row_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedrow',
+            index_together=set([('table', 'batch_id')]),
+        ),
+    ]
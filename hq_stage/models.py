@@ -1,11 +1,13 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
-import datetime
+import datetime, collections
 from pytz import timezone
 
+from . import caching, partitions
+
 
 class Batch(models.Model):
     '''
@@ -14,7 +16,8 @@ class Batch(models.Model):
     procedures:
 
     *   If an entire file was wrongly loaded the entire batch can be used to
-    invalidate all relevant rows.
+    invalidate all relevant rows (see `hqs-drop-batch`, on tables partitioned
+    by batch that drops the partitions of the batch).
     *   Data can be loaded from several sources into the same batch and then
     processed together.
 
@@ -41,10 +44,15 @@ class Batch(models.Model):
         return reverse('hq_stage:batch', kwargs={ 'pk' : self.id })
 
     def save(self, *args, **kwargs):
-        if self.pk is None:  # this is an insert
+        insert = self.pk is None
+        if insert:
             tz = timezone(settings.TIME_ZONE)
             self.date_created = tz.localize(datetime.datetime.now())
-        super(Batch, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(Batch, self).save(*args, **kwargs)
+            if insert:  # no-op unless the tables are partitioned
+                partitions.create(self.id)
+        caching.bump(self.id)
 
     class Meta:
         verbose_name = _('batch')
@@ -80,6 +88,14 @@ class DataRow(models.Model):
        The row is complete garbage and no amount of editing by an operator can
        save this data.  The row has been marked as an ignored error by an
        operator.
+
+    Rows only move between these states in the following ways (see
+    `ROW_TRANSITIONS`):
+
+    *   1 -> 2 or 1 -> 3: the upload to the warehouse was attempted.
+    *   2 -> 1 or 3 -> 1: the row is reset to be uploaded again.
+    *   3 -> 2: the error has been fixed in the warehouse by other means.
+    *   3 -> 4 and 4 -> 3: an operator ignores the error, or takes that back.
     '''
     insert_date = models.DateTimeField(
           _('insert date')
@@ -121,18 +137,77 @@ class DataRow(models.Model):
         return '[' + str(self.insert_date) + '] ' + str(self.batch.id)
 
     def save(self, *args, **kwargs):
+        old = None
         if self.pk is None:  # this is an insert
             tz = timezone(settings.TIME_ZONE)
             self.insert_date = tz.localize(datetime.datetime.now())
             if self.batch is None:
                 # create a new batch if needed
                 self.batch = Batch()
-        super(DataRow, self).save(*args, **kwargs)
+        with transaction.atomic():
+            if self.pk is not None:
+                # the row stays locked until the summary is changed, a save
+                # of the same row elsewhere waits and then sees our state
+                old = type(self).objects.select_for_update() \
+                                        .filter(pk=self.pk) \
+                                        .values_list( 'batch_id', 'processed'
+                                                    , 'in_error', 'ignore' ) \
+                                        .first()
+            super(DataRow, self).save(*args, **kwargs)
+            caching.bump(self.batch_id, old[0] if old else None)
+            state = row_state(self.processed, self.in_error, self.ignore)
+            if old:
+                if (old[0], row_state(*old[1:])) == (self.batch_id, state):
+                    return
+                BatchSummary.add( type(self), old[0]
+                                , { row_state(*old[1:]) : -1 } )
+            BatchSummary.add(type(self), self.batch_id, { state : 1 })
+
+    def delete(self, *args, **kwargs):
+        state = row_state(self.processed, self.in_error, self.ignore)
+        with transaction.atomic():
+            BatchSummary.add(type(self), self.batch_id, { state : -1 })
+            caching.bump(self.batch_id)
+            return super(DataRow, self).delete(*args, **kwargs)
 
     class Meta:
         abstract = True
 
 
+# The states described in DataRow, by name, as the values of the flags.
+ROW_STATES = collections.OrderedDict([
+      ( 'pending'
+      , { 'processed' : False , 'in_error' : False , 'ignore' : False } )
+    , ( 'processed'
+      , { 'processed' : True , 'in_error' : False , 'ignore' : False } )
+    , ( 'in_error'
+      , { 'processed' : True , 'in_error' : True , 'ignore' : False } )
+    , ( 'ignored'
+      , { 'processed' : True , 'in_error' : True , 'ignore' : True } )
+    ])
+
+def row_state(processed, in_error, ignore):
+    '''
+    The name of the state of a row with these flags, None if the flags do not
+    make up any of the states.
+    '''
+    flags = { 'processed' : processed , 'in_error' : in_error
+            , 'ignore' : ignore }
+    for name, state in ROW_STATES.items():
+        if state == flags:
+            return name
+    return None
+
+
+# The allowed moves between the states, from a state to the listed states.
+ROW_TRANSITIONS = collections.OrderedDict([
+      ( 'pending' , [ 'processed' , 'in_error' ] )
+    , ( 'processed' , [ 'pending' ] )
+    , ( 'in_error' , [ 'pending' , 'processed' , 'ignored' ] )
+    , ( 'ignored' , [ 'in_error' ] )
+    ])
+
+
 class Offer(DataRow):
     external_id = models.CharField(
           _('external id')
@@ -250,7 +325,10 @@ class Offer(DataRow):
         return reverse('hq_stage:offer', kwargs={ 'pk' : self.id })
 
     class Meta:
-        index_together = [ ( 'in_error' , 'ignore' ) ]
+        index_together = [
+              ( 'in_error' , 'ignore' )
+            , ( 'batch' , 'processed' )
+            ]
         verbose_name = _('offer')
         verbose_name_plural = _('offers')
 
@@ -286,7 +364,10 @@ class Currency(DataRow):
         return reverse('hq_stage:currency', kwargs={ 'pk' : self.id })
 
     class Meta:
-        index_together = [ ( 'in_error' , 'ignore' ) ]
+        index_together = [
+              ( 'in_error' , 'ignore' )
+            , ( 'batch' , 'processed' )
+            ]
         verbose_name = _('currency')
         verbose_name_plural = _('currencies')
 
@@ -338,7 +419,334 @@ class ExchangeRate(DataRow):
         return reverse('hq_stage:exchange', kwargs={ 'pk' : self.id })
 
     class Meta:
-        index_together = [ ( 'in_error' , 'ignore' ) ]
+        index_together = [
+              ( 'in_error' , 'ignore' )
+            , ( 'batch' , 'processed' )
+            ]
         verbose_name = _('exchange rate')
         verbose_name_plural = _('exchange rates')
 
+
+
+class LoadCheckpoint(models.Model):
+    '''
+    Progress of the load of a file into a table of a batch.  It is updated in
+    the same transaction as every chunk of rows inserted by the loader, so it
+    always points just past the last committed row.  A load that died half way
+    through can be resumed from `offset` instead of being repeated.
+
+    The fingerprint is there to make sure that we are resuming the same file
+    and not a different file that happens to have the same name.
+    '''
+    batch = models.ForeignKey(
+          Batch
+        , verbose_name=_('batch')
+        , related_name='checkpoint_set'
+        , help_text=_('the batch the file is loaded into')
+        )
+    file_name = models.CharField(
+          _('file name')
+        , max_length=255
+        , help_text=_('absolute path of the loaded file')
+        )
+    table = models.CharField(
+          _('table')
+        , max_length=32
+        , help_text=_('the table the file is loaded into')
+        )
+    fingerprint = models.CharField(
+          _('fingerprint')
+        , max_length=64
+        , help_text=_('size and hash of the start of the file')
+        )
+    offset = models.BigIntegerField(
+          _('offset')
+        , default=0
+        , help_text=_('byte offset after the last committed row')
+        )
+    row_number = models.BigIntegerField(
+          _('row number')
+        , default=0
+        , help_text=_('number of rows committed')
+        )
+    date_updated = models.DateTimeField(
+          _('date updated')
+        , blank=True
+        , null=True
+        , editable=False
+        , help_text=_('last time a chunk was committed')
+        )
+
+    def __str__(self):
+        return ( 'Checkpoint [' + self.table + '] ' + self.file_name
+               + ' ' + str(self.row_number) )
+
+    def save(self, *args, **kwargs):
+        tz = timezone(settings.TIME_ZONE)
+        self.date_updated = tz.localize(datetime.datetime.now())
+        super(LoadCheckpoint, self).save(*args, **kwargs)
+
+    class Meta:
+        unique_together = [ ( 'batch' , 'file_name' , 'table' ) ]
+        verbose_name = _('load checkpoint')
+        verbose_name_plural = _('load checkpoints')
+
+
+class LoadManifest(models.Model):
+    '''
+    Record of a file that was loaded completely into a table.  The loader
+    consults it before loading a file so that the same content is not loaded
+    twice (e.g. by a retried cron job).
+
+    The fingerprint (size and hash of the start of the file as it is on disk)
+    is cheap to compute and is what identifies a loaded file.  The hash of the
+    whole (uncompressed) content is computed as the file is loaded, a load of
+    content that is already in the manifest under another fingerprint (e.g.
+    compressed differently) is told about.
+    '''
+    batch = models.ForeignKey(
+          Batch
+        , verbose_name=_('batch')
+        , related_name='manifest_set'
+        , help_text=_('the batch the file was loaded into')
+        )
+    file_name = models.CharField(
+          _('file name')
+        , max_length=255
+        , help_text=_('path of the loaded file')
+        )
+    table = models.CharField(
+          _('table')
+        , max_length=32
+        , help_text=_('the table the file was loaded into')
+        )
+    fingerprint = models.CharField(
+          _('fingerprint')
+        , max_length=64
+        , blank=True
+        , db_index=True
+        , help_text=_('size and hash of the start of the file')
+        )
+    content_hash = models.CharField(
+          _('content hash')
+        , max_length=64
+        , db_index=True
+        , help_text=_('sha256 of the uncompressed content')
+        )
+    size = models.BigIntegerField(
+          _('size')
+        , help_text=_('bytes of uncompressed content')
+        )
+    row_count = models.BigIntegerField(
+          _('row count')
+        , help_text=_('number of rows loaded')
+        )
+    date_started = models.DateTimeField(
+          _('date started')
+        , help_text=_('start of the load')
+        )
+    date_finished = models.DateTimeField(
+          _('date finished')
+        , help_text=_('end of the load')
+        )
+
+    def __str__(self):
+        return ( 'Manifest [' + self.table + '] ' + self.file_name
+               + ' ' + self.content_hash )
+
+    class Meta:
+        verbose_name = _('load manifest')
+        verbose_name_plural = _('load manifests')
+
+
+class BatchSummary(models.Model):
+    '''
+    Number of rows of a table in every state, per batch, so that we can tell
+    how a batch is doing without counting rows.
+
+    The counts are kept up to date by whoever changes the rows: the bulk
+    inserts of the loader and of the upload API (see `TableSpec.compile`),
+    the bulk state changes (see the `states` module) and `DataRow` itself when
+    a single row is saved or deleted.  The change of the counts happens in
+    the same transaction as the change of the rows, the summary row is locked
+    until that transaction commits.
+
+    Rows changed behind our back (e.g. a plain `update()` in the shell) make
+    the counts drift, `reconcile` counts the rows again.
+    '''
+    batch = models.ForeignKey(
+          Batch
+        , verbose_name=_('batch')
+        , related_name='summary_set'
+        , help_text=_('the batch the rows belong to')
+        )
+    table = models.CharField(
+          _('table')
+        , max_length=32
+        , help_text=_('name of the model of the rows')
+        )
+    pending = models.BigIntegerField(
+          _('pending')
+        , default=0
+        , help_text=_('rows not yet uploaded to the warehouse')
+        )
+    processed = models.BigIntegerField(
+          _('processed')
+        , default=0
+        , help_text=_('rows uploaded to the warehouse')
+        )
+    in_error = models.BigIntegerField(
+          _('in error')
+        , default=0
+        , help_text=_('rows that failed the upload')
+        )
+    ignored = models.BigIntegerField(
+          _('ignored')
+        , default=0
+        , help_text=_('rows in error that are ignored')
+        )
+    date_updated = models.DateTimeField(
+          _('date updated')
+        , blank=True
+        , null=True
+        , editable=False
+        , help_text=_('last change of the counts')
+        )
+
+    def __str__(self):
+        return 'Summary [' + self.table + '] ' + str(self.batch_id)
+
+    def save(self, *args, **kwargs):
+        tz = timezone(settings.TIME_ZONE)
+        self.date_updated = tz.localize(datetime.datetime.now())
+        super(BatchSummary, self).save(*args, **kwargs)
+
+    @property
+    def total(self):
+        return self.pending + self.processed + self.in_error + self.ignored
+
+    @classmethod
+    def add(cls, model, batch_id, deltas):
+        '''
+        Add the deltas, a dictionary from state name to a number of rows, to
+        the counts of the rows of the model in the batch.  Call it inside the
+        transaction that changes the rows.
+        '''
+        deltas = dict( (k, v) for k, v in deltas.items() if k and v )
+        if not deltas:
+            return
+        caching.bump(batch_id)
+        table = model._meta.model_name
+        tz = timezone(settings.TIME_ZONE)
+        changes = dict( (k, models.F(k) + v) for k, v in deltas.items() )
+        changes['date_updated'] = tz.localize(datetime.datetime.now())
+        summary = cls.objects.filter(batch_id=batch_id, table=table)
+        if summary.update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls(batch_id=batch_id, table=table, **deltas).save()
+        except IntegrityError:  # someone else created it in the meantime
+            summary.update(**changes)
+
+    @classmethod
+    def count_rows(cls, model, state, batch_id=None):
+        '''
+        Number of rows of the model in a state, in a batch or in all batches.
+        '''
+        summary = cls.objects.filter(table=model._meta.model_name)
+        if batch_id is not None:
+            summary = summary.filter(batch_id=batch_id)
+        return summary.aggregate(n=models.Sum(state))['n'] or 0
+
+    @classmethod
+    def reconcile(cls, model, batch_id=None):
+        '''
+        Count the rows of the model again, in a batch or in all batches, and
+        replace the summaries.  Returns the summaries.
+        '''
+        table = model._meta.model_name
+        rows = model.objects.all()
+        summaries = cls.objects.filter(table=table)
+        if batch_id is not None:
+            rows = rows.filter(batch_id=batch_id)
+            summaries = summaries.filter(batch_id=batch_id)
+        counts = collections.OrderedDict()
+        groups = ( rows.values('batch_id', 'processed', 'in_error', 'ignore')
+                   .annotate(n=models.Count('id')).order_by('batch_id') )
+        for group in groups:
+            state = row_state( group['processed'], group['in_error']
+                             , group['ignore'] )
+            summary = counts.setdefault( group['batch_id']
+                                       , dict.fromkeys(ROW_STATES, 0) )
+            if state:
+                summary[state] += group['n']
+        tz = timezone(settings.TIME_ZONE)
+        updated = tz.localize(datetime.datetime.now())
+        created = [ cls( batch_id=b, table=table, date_updated=updated
+                       , **summary )
+                    for b, summary in counts.items() ]
+        with transaction.atomic():
+            summaries.delete()
+            cls.objects.bulk_create(created)
+            caching.bump(batch_id, *counts.keys())
+        return created
+
+    class Meta:
+        unique_together = [ ( 'batch' , 'table' ) ]
+        verbose_name = _('batch summary')
+        verbose_name_plural = _('batch summaries')
+
+
+class ArchivedRow(models.Model):
+    '''
+    A row of a staging table that was done with (processed, or an ignored
+    error) and moved out of the way by `hqs-archive`, see the `archive`
+    module.  The input fields of the row are kept as a single CSV line, in
+    the order of the columns of the input files.
+    '''
+    table = models.CharField(
+          _('table')
+        , max_length=32
+        , help_text=_('the table the row was archived from')
+        )
+    row_id = models.IntegerField(
+          _('row id')
+        , help_text=_('primary key of the row in the staging table')
+        )
+    batch_id = models.IntegerField(
+          _('batch id')
+        , help_text=_('the batch of the row')
+        )
+    insert_date = models.DateTimeField(
+          _('insert date')
+        , help_text=_('insertion in the stage database')
+        )
+    ignore = models.BooleanField(
+          _('ignore')
+        , default=False
+        , help_text=_('set if the row was an ignored error')
+        )
+    fields_in_error = models.TextField(
+          _('fields in error')
+        , blank=True
+        , null=True
+        , help_text=_('fields in error of an ignored row')
+        )
+    data = models.TextField(
+          _('data')
+        , help_text=_('the input fields as a CSV line')
+        )
+    date_archived = models.DateTimeField(
+          _('date archived')
+        , help_text=_('when the row was archived')
+        )
+
+    def __str__(self):
+        return 'Archived [' + self.table + '] ' + str(self.row_id)
+
+    class Meta:
+        unique_together = [ ( 'table' , 'row_id' ) ]
+        index_together = [ ( 'table' , 'batch_id' ) ]
+        verbose_name = _('archived row')
+        verbose_name_plural = _('archived rows')
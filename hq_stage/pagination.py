@@ -0,0 +1,159 @@
+'''
+Keyset pagination for the staging tables.
+
+Django's paginator counts the whole queryset and then skips to the page with
+OFFSET, both get slower the bigger the table and the deeper the page.  Here a
+page is found by its position in the primary key instead: the token of the
+next page is the last id of the current page and the page is fetched with
+`id > token ORDER BY id LIMIT n`, which is an index range scan whatever the
+page.
+
+The paginator and page objects quack like Django's ones, the page "numbers"
+are the tokens so `?page={{ page_obj.next_page_number }}` links still work.
+Counting is optional and can be an estimate from the planner statistics.
+'''
+
+import json, math
+
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def estimate_count(queryset):
+    '''
+    Estimated number of rows in a queryset, from the planner statistics of
+    the database.  On PostgreSQL the row count of the whole table comes from
+    `pg_class.reltuples` and of a filtered queryset from the plan.  MySQL has
+    similar estimates in the information schema and in EXPLAIN.  Other
+    databases do not keep such statistics and we count.
+    '''
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    filtered = queryset.query.where
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if 'postgresql' == connection.vendor:
+            if not filtered:
+                cursor.execute( 'SELECT reltuples FROM pg_class '
+                              + 'WHERE oid = %s::regclass', [table] )
+                return max(0, int(cursor.fetchone()[0]))
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+            if str == type(plan):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+        if 'mysql' == connection.vendor:
+            if not filtered:
+                cursor.execute( 'SELECT table_rows '
+                              + 'FROM information_schema.tables '
+                              + 'WHERE table_schema = DATABASE() '
+                              + 'AND table_name = %s', [table] )
+                return int(cursor.fetchone()[0] or 0)
+            cursor.execute('EXPLAIN ' + sql, params)
+            names = [ x[0] for x in cursor.description ]
+            return int(cursor.fetchone()[names.index('rows')] or 0)
+    return queryset.count()
+
+
+def count_rows(queryset, count_mode='approx'):
+    '''
+    Number of rows in a queryset, `count_mode` is `exact` for a COUNT(*),
+    `approx` for `estimate_count` or None to not count at all.
+    '''
+    if 'exact' == count_mode:
+        return queryset.count()
+    if 'approx' == count_mode:
+        return estimate_count(queryset)
+    return None
+
+
+class KeysetPaginator(object):
+    '''
+    Paginates a queryset by its primary key.  `count_mode` is as in
+    `count_rows`, or a function that counts the rows of the queryset.
+    '''
+    def __init__(self, queryset, per_page, count_mode='approx'):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.count_mode = count_mode
+
+    @cached_property
+    def count(self):
+        if callable(self.count_mode):
+            return self.count_mode(self.queryset)
+        return count_rows(self.queryset, self.count_mode)
+
+    @property
+    def num_pages(self):
+        if not self.count:
+            return 1
+        return int(math.ceil(self.count / float(self.per_page)))
+
+    def page(self, token=None):
+        '''
+        The page after (`a<id>`) or before (`b<id>`) a primary key, or the
+        first page if there is no token.
+        '''
+        qs = self.queryset.order_by('pk')
+        n = self.per_page
+        if not token or '1' == token:
+            rows = list(qs[:n+1])
+            return KeysetPage(rows[:n], self, False, len(rows) > n)
+        try:
+            direction, pk = token[0], int(token[1:])
+        except (IndexError, ValueError):
+            raise InvalidToken(token)
+        if 'a' == direction:
+            rows = list(qs.filter(pk__gt=pk)[:n+1])
+            return KeysetPage(rows[:n], self, True, len(rows) > n)
+        if 'b' == direction:
+            rows = list(qs.filter(pk__lt=pk).reverse()[:n+1])
+            page = rows[:n]
+            page.reverse()
+            return KeysetPage(page, self, len(rows) > n, True)
+        raise InvalidToken(token)
+
+
+class KeysetPage(object):
+    '''
+    A page of rows, with the tokens of the neighbouring pages.
+    '''
+    def __init__(self, object_list, paginator, previous, next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.previous = previous and bool(object_list)
+        self.next = next and bool(object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next
+
+    def has_previous(self):
+        return self.previous
+
+    def has_other_pages(self):
+        return self.next or self.previous
+
+    def next_page_number(self):
+        return 'a%i' % self.object_list[-1].pk
+
+    def previous_page_number(self):
+        return 'b%i' % self.object_list[0].pk
+
+    @property
+    def number(self):
+        if not self.object_list:
+            return ''
+        return 'a%i' % (self.object_list[0].pk - 1)
@@ -0,0 +1,189 @@
+'''
+Staging tables partitioned by batch, on PostgreSQL.
+
+A batch is the unit of everything here: it is loaded, processed, invalidated
+and archived as a whole.  On flat tables invalidating or archiving a batch of
+ten million offers is ten million rows deleted.  With the tables of the rows
+(`Currency`, `ExchangeRate` and `Offer`) partitioned by list of `batch_id`
+every batch has a partition of its own in each table: the partition is
+detached or dropped instead, in constant time, and the loads and the queries
+of a batch touch only its partition.
+
+The layout is optional.  `hqs-partition` converts the flat tables of an
+existing database (PostgreSQL 11 or later), from then on a partition of each
+table is created whenever a `Batch` is created.  The primary keys become
+(id, batch_id), as PostgreSQL wants the partition key in them, the ids still
+come from the same sequence and stay unique.  Everything else, and every
+other database, works with the flat tables as always: the procedures here
+check whether a table is partitioned and do nothing otherwise.
+
+Creating, detaching and dropping a partition lock the whole table for an
+instant, wait for the running statements on it.
+
+The conversion happens behind the back of the migrations, their state still
+describes flat tables with `id` as the primary key.  See the README for what
+that means for later migrations.
+
+Do not import models here.
+'''
+
+from django.apps import apps
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+
+MODELS = [ 'currency' , 'exchangerate' , 'offer' ]
+MIN_VERSION = 110000  # primary keys and foreign keys on partitioned tables
+
+_partitioned = {}  # (database, table) to whether it is partitioned
+
+
+class PartitionError(Exception):
+    '''
+    The tables cannot be partitioned, the message says why.
+    '''
+    pass
+
+
+def data_models():
+    return [ apps.get_model('hq_stage', x) for x in MODELS ]
+
+def partitioned(model, using=DEFAULT_DB_ALIAS):
+    '''
+    Whether the table of the model is partitioned, asked once per process.
+    '''
+    key = (using, model._meta.db_table)
+    if not key in _partitioned:
+        connection = connections[using]
+        found = False
+        if 'postgresql' == connection.vendor:
+            with connection.cursor() as cursor:
+                cursor.execute( 'SELECT relkind FROM pg_class '
+                                'WHERE oid = to_regclass(%s)'
+                              , [ model._meta.db_table ] )
+                row = cursor.fetchone()
+                found = bool(row) and 'p' == row[0]
+        _partitioned[key] = found
+    return _partitioned[key]
+
+def forget():
+    '''
+    Ask again whether the tables are partitioned, for processes that live
+    longer than a conversion.
+    '''
+    _partitioned.clear()
+
+def name(model, batch):
+    return '%s_%i' % (model._meta.db_table, batch)
+
+def table(model, batch, using=DEFAULT_DB_ALIAS):
+    '''
+    The table the rows of the model in the batch go into: its partition, or
+    the table of the model if it is not partitioned.
+    '''
+    if partitioned(model, using):
+        return name(model, batch)
+    return model._meta.db_table
+
+def execute(using, *statements):
+    with connections[using].cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+def create(batch, using=DEFAULT_DB_ALIAS):
+    '''
+    Create the partitions of the batch in the partitioned tables.
+    '''
+    qn = connections[using].ops.quote_name
+    for model in data_models():
+        if not partitioned(model, using):
+            continue
+        execute( using
+               , 'CREATE TABLE IF NOT EXISTS %s PARTITION OF %s '
+                 'FOR VALUES IN (%i)'
+                 % (qn(name(model, batch)), qn(model._meta.db_table), batch) )
+
+def drop(model, batch, using=DEFAULT_DB_ALIAS):
+    '''
+    Drop the partition of the table of the model of the batch, rows and all.
+    '''
+    qn = connections[using].ops.quote_name
+    execute(using, 'DROP TABLE IF EXISTS %s' % qn(name(model, batch)))
+
+def detach(model, batch, using=DEFAULT_DB_ALIAS):
+    '''
+    Detach the partition of the table of the model of the batch and keep it
+    as a table of its own, `<table>_archived_<batch>`.  Returns its name, or
+    None if the batch has no partition (anymore).
+    '''
+    qn = connections[using].ops.quote_name
+    archived = '%s_archived_%i' % (model._meta.db_table, batch)
+    with transaction.atomic(using=using), \
+         connections[using].cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [ name(model, batch) ])
+        if cursor.fetchone()[0] is None:
+            return None
+        cursor.execute( 'ALTER TABLE %s DETACH PARTITION %s'
+                      % (qn(model._meta.db_table), qn(name(model, batch))) )
+        cursor.execute( 'ALTER TABLE %s RENAME TO %s'
+                      % (qn(name(model, batch)), qn(archived)) )
+    return archived
+
+def partition(model, using=DEFAULT_DB_ALIAS):
+    '''
+    Convert the flat table of the model into a table partitioned by batch,
+    with a partition for every batch, in a single transaction.  The rows are
+    copied, which takes as long as a load of all of them, run it when
+    nothing else is.  Raises `PartitionError` if the database cannot do it.
+    '''
+    connection = connections[using]
+    if not 'postgresql' == connection.vendor:
+        raise PartitionError('only PostgreSQL tables can be partitioned')
+    if connection.pg_version < MIN_VERSION:
+        raise PartitionError('PostgreSQL 11 or later is needed')
+    if partitioned(model, using):
+        return
+    qn = connection.ops.quote_name
+    parent = model._meta.db_table
+    flat = parent + '_flat'
+    batch = apps.get_model('hq_stage', 'batch')
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # the foreign keys of django are deferred, the checks of rows written
+        # earlier in the transaction must run before their table goes
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        # the indexes and foreign keys go with the flat table, we create
+        # them again (as they were defined, on the name of the table) on the
+        # partitioned one once the rows are in
+        cursor.execute( 'SELECT pg_get_indexdef(indexrelid) FROM pg_index '
+                        'WHERE indrelid = to_regclass(%s) '
+                        'AND NOT indisprimary'
+                      , [ parent ] )
+        indexes = [ x[0] for x in cursor.fetchall() ]
+        cursor.execute( 'SELECT conname, pg_get_constraintdef(oid) '
+                        'FROM pg_constraint '
+                        "WHERE conrelid = to_regclass(%s) AND contype = 'f'"
+                      , [ parent ] )
+        foreign = cursor.fetchall()
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(parent), qn(flat)))
+        cursor.execute( 'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) '
+                        'PARTITION BY LIST (batch_id)'
+                      % (qn(parent), qn(flat)) )
+        cursor.execute( 'SELECT id FROM %s ORDER BY id'
+                      % qn(batch._meta.db_table) )
+        for (batch_id,) in cursor.fetchall():
+            cursor.execute( 'CREATE TABLE %s PARTITION OF %s '
+                            'FOR VALUES IN (%i)'
+                          % (qn(name(model, batch_id)), qn(parent), batch_id) )
+        cursor.execute( 'INSERT INTO %s SELECT * FROM %s'
+                      % (qn(parent), qn(flat)) )
+        cursor.execute( 'ALTER SEQUENCE %s OWNED BY %s.id'
+                      % (qn(parent + '_id_seq'), qn(parent)) )
+        cursor.execute('DROP TABLE %s' % qn(flat))
+        cursor.execute( 'ALTER TABLE %s ADD CONSTRAINT %s '
+                        'PRIMARY KEY (id, batch_id)'
+                      % (qn(parent), qn(parent + '_pkey')) )
+        for conname, definition in foreign:
+            cursor.execute( 'ALTER TABLE %s ADD CONSTRAINT %s %s'
+                          % (qn(parent), qn(conname), definition) )
+        for sql in indexes:
+            cursor.execute(sql)
+    _partitioned[(using, parent)] = True
@@ -0,0 +1,146 @@
+'''
+Pipelined loads.
+
+A plain load reads and parses a chunk, then waits for the database to insert
+it, then reads the next chunk, the CPU and the database take turns.  Here the
+caller reads and builds the chunks into a bounded queue and writer threads,
+each with its own database connection, insert them meanwhile.
+
+The chunks are numbered as they are read and committed strictly in that
+order.  A writer inserts the rows of its chunk straight away, but waits for
+the previous chunk to be committed before it touches the rows shared by all
+chunks (the batch summary and the checkpoint) and commits.  A load that
+stops half way has committed the start of the file, exactly as a plain load,
+and can be resumed.
+
+If anything fails, in the reader or in a writer, everybody stops, the chunks
+that are not committed yet are rolled back and the first error is raised
+again in the caller.
+
+Do not import models here.
+'''
+
+import queue, threading, contextlib
+
+from django import db
+
+
+POLL = 0.1  # seconds between checks whether the others stopped
+
+
+class Stopped(Exception):
+    '''
+    The pipeline stopped because of an error somewhere else.
+    '''
+    pass
+
+
+class Turnstile(object):
+    '''
+    Lets the holders of consecutive numbers through one at a time, in order.
+    '''
+    def __init__(self):
+        self.next = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def wait(self, seq):
+        with self.cond:
+            while self.next != seq and not self.stopped:
+                self.cond.wait()
+            if self.stopped:
+                raise Stopped()
+
+    def done(self, seq):
+        with self.cond:
+            self.next = seq + 1
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+class Pipeline(object):
+    '''
+    Feeds items to `writers` threads through a queue of `depth` items.  Each
+    thread calls `write(seq, item, turn)` for the items it gets, where `seq`
+    is the position of the item and `turn` the `Turnstile` the writer must
+    wait on (and pass on, once it committed).  Each thread runs inside a
+    `context()`, if one is given.
+    '''
+    def __init__(self, write, writers=1, depth=None, context=None):
+        self.write = write
+        self.context = context or contextlib.ExitStack
+        self.queue = queue.Queue(depth or 2 * writers)
+        self.turn = Turnstile()
+        self.errors = []
+        self.threads = [ threading.Thread( target=self.writer
+                                         , name='hqs-writer-%i' % i
+                                         , daemon=True )
+                         for i in range(writers) ]
+
+    def fail(self, error):
+        self.errors.append(error)
+        self.turn.stop()
+
+    def put(self, item):
+        while True:
+            if self.turn.stopped:
+                raise Stopped()
+            try:
+                return self.queue.put(item, timeout=POLL)
+            except queue.Full:
+                pass
+
+    def get(self):
+        while True:
+            if self.turn.stopped:
+                raise Stopped()
+            try:
+                return self.queue.get(timeout=POLL)
+            except queue.Empty:
+                pass
+
+    def writer(self):
+        try:
+            with self.context():
+                while True:
+                    job = self.get()
+                    if job is None:
+                        return
+                    self.write(job[0], job[1], self.turn)
+        except Stopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            # the connections of a thread are not closed by anybody else
+            db.connections.close_all()
+
+    def run(self, items):
+        '''
+        Feed the items to the writers and wait for them to finish.  Returns
+        the number of items written.
+        '''
+        for t in self.threads:
+            t.start()
+        seq = 0
+        try:
+            for item in items:
+                self.put((seq, item))
+                seq += 1
+            for t in self.threads:
+                self.put(None)
+        except Stopped:
+            pass
+        except BaseException:
+            self.turn.stop()
+            raise
+        finally:
+            for t in self.threads:
+                t.join()
+        if self.errors:
+            raise self.errors[0]
+        return seq
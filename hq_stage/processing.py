@@ -0,0 +1,200 @@
+'''
+Processing of whole batches.
+
+Processing a batch is the attempt to take its rows into the warehouse: the
+rows that are pending or in error (states 1 and 3 of `DataRow`) are checked
+against the rules of their table (see `validation`) and for their references
+to the other tables of the batch (see `references`), the good ones become
+processed and the bad ones in error, with the broken fields in
+`fields_in_error`.  Then the batch itself is marked processed, no more rows
+can be loaded into it.
+
+The rows are never loaded a table at a time.  They are read in chunks of
+consecutive primary keys, only the columns the rules need, and every chunk is
+written back in its own short transaction, together with the change of the
+`BatchSummary`, with a couple of UPDATE statements: one that marks the whole
+chunk processed and one per distinct set of broken fields for the rows in
+error.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import sys, time, collections
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import models, loader, sizing, validation
+
+
+ID_BATCH = 500  # primary keys per IN (...), SQLite takes at most 999
+
+
+def eligible(model, batch):
+    '''
+    The rows of the batch that are pending or in error (and not ignored).
+    '''
+    return model.objects.filter( Q(processed=False, in_error=False)
+                               | Q(processed=True, in_error=True)
+                               , batch_id=batch, ignore=False )
+
+class Checks(object):
+    '''
+    The checks of the rows of a table: the rules of `validation` and the
+    references to the other tables of the batch (see `references`, the sets
+    of keys referenced are built once and kept in `indexes`).  The rows are
+    read as tuples of id, in_error, fields_in_error and then `fields`.
+
+    A row can be in error for a field we do not check here (e.g. flagged by
+    hand through the state API), such a field stays in `fields_in_error` and
+    keeps the row in error, whatever our checks say.
+    '''
+    def __init__(self, table, batch, indexes=None):
+        from . import references  # it imports this module
+        if indexes is None:
+            indexes = {}
+        self.fields = [ name for name, check
+                        in validation.RULES.get(table, []) ]
+        declared = references.REFERENCES.get(table, [])
+        for field, other, key in declared:
+            if not (other, key) in indexes:
+                indexes[(other, key)] = set(
+                    references.referenced(other, key, batch).iterator() )
+            if not field in self.fields:
+                self.fields.append(field)
+        self.checked = set(self.fields)
+        positions = dict( (x, i + 3) for i, x in enumerate(self.fields) )
+        self.validator = validation.Validator(table, positions)
+        self.references = [ (field, positions[field], indexes[(other, key)])
+                            for field, other, key in declared ]
+
+    def errors(self, rows):
+        '''
+        A dictionary from the position of every bad row to the list of its
+        bad fields.
+        '''
+        errors = self.validator.errors(rows)
+        for field, pos, keys in self.references:
+            for i, row in enumerate(rows):
+                if not row[pos] in keys:
+                    names = errors.setdefault(i, [])
+                    if not field in names:
+                        names.append(field)
+        for i, row in enumerate(rows):
+            for field in (row[2] or '').split(','):
+                if field and not field in self.checked:
+                    names = errors.setdefault(i, [])
+                    if not field in names:
+                        names.append(field)
+        return errors
+
+
+def update(model, ids, **values):
+    '''
+    Update the rows with the ids, `ID_BATCH` at a time.
+    '''
+    for start in range(0, len(ids), ID_BATCH):
+        model.objects.filter(id__in=ids[start:start+ID_BATCH]).update(**values)
+
+def process_chunk(model, batch, checks, rows):
+    '''
+    Check a chunk of rows (see `Checks`) and write the results back, to these
+    rows only.  Call it in the transaction that read (and locked) the rows.
+    Returns the numbers of rows processed and in error.
+    '''
+    errors = checks.errors(rows)
+    good = []
+    broken = collections.defaultdict(list)
+    deltas = collections.Counter()
+    for i, row in enumerate(rows):
+        source = 'in_error' if row[1] else 'pending'
+        target = 'in_error' if i in errors else 'processed'
+        deltas[source] -= 1
+        deltas[target] += 1
+        if i in errors:
+            broken[','.join(errors[i])].append(row[0])
+        else:
+            good.append(row[0])
+    update(model, good, processed=True, in_error=False, fields_in_error=None)
+    for fields, ids in broken.items():
+        update( model, ids, processed=True, in_error=True
+              , fields_in_error=fields )
+    models.BatchSummary.add(model, batch, deltas)
+    bad = len(errors)
+    return len(rows) - bad, bad
+
+def process_table(spec, batch, chunk, progress=None, indexes=None):
+    '''
+    Process the eligible rows of the table in the batch, `chunk` rows at a
+    time.  `progress`, if given, is called with the table, the rows done and
+    the rows to do.  `indexes` are the sets of referenced keys built so far
+    (see `Checks`).  Returns the numbers of rows processed and in error.
+
+    The rows of a chunk are locked while they are checked, whoever changes
+    them in the meantime (`hqs-set-state`, the upload API) waits.
+    '''
+    model = spec.model
+    checks = Checks(spec.table, batch, indexes)
+    queryset = eligible(model, batch)
+    todo = models.BatchSummary.count_rows(model, 'pending', batch) \
+         + models.BatchSummary.count_rows(model, 'in_error', batch)
+    values = queryset.select_for_update().order_by('id').values_list(
+        'id', 'in_error', 'fields_in_error', *checks.fields )
+    last = 0
+    done = [0, 0]
+    while True:
+        with transaction.atomic():
+            rows = list(values.filter(id__gt=last)[:chunk])
+            if not rows:
+                return tuple(done)
+            good, bad = process_chunk(model, batch, checks, rows)
+        done[0] += good
+        done[1] += bad
+        last = rows[-1][0]
+        if progress:
+            progress(spec.table, done[0] + done[1], todo)
+
+def process_batch(batch, tables=None, chunk=None, progress=None):
+    '''
+    Process the rows of the batch in the `tables` (all tables by default).
+    The batch is marked processed once no table has pending rows, i.e. when
+    the other tables were processed before, or are empty.  Returns an
+    ordered dictionary from table to the numbers of rows processed and in
+    error.
+    '''
+    if tables is None:
+        tables = sorted(loader.TABLES.keys())
+    chunk = chunk or sizing.fixed_size()
+    indexes = {}  # built once, shared by the tables
+    counts = collections.OrderedDict()
+    for table in tables:
+        counts[table] = process_table( loader.TABLES[table], batch.id, chunk
+                                     , progress, indexes )
+    pending = models.ROW_STATES['pending']
+    if not any( x.model.objects.filter(batch_id=batch.id, **pending).exists()
+                for x in loader.TABLES.values() ):
+        batch.processed = True
+        batch.save()
+    return counts
+
+
+class Progress(object):
+    '''
+    Prints the progress of the tables to `out` at most every `interval`
+    seconds (default `HQ_DW_PROGRESS_INTERVAL`, or 5).
+    '''
+    def __init__(self, interval=None, out=sys.stderr):
+        if interval is None:
+            interval = getattr(settings, 'HQ_DW_PROGRESS_INTERVAL', 5)
+        self.interval = interval
+        self.out = out
+        self.next = time.time() + interval
+
+    def __call__(self, table, done, todo):
+        now = time.time()
+        if now < self.next and done < todo:
+            return
+        self.next = now + self.interval
+        self.out.write('%s: %i of %i rows\n' % (table, done, todo))
+        self.out.flush()
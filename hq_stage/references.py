@@ -0,0 +1,223 @@
+'''
+Referential checks between the tables of a batch.
+
+An offer names its currency by `currency_id`, an exchange rate names two
+currencies, and these must be the `external_id` of currencies loaded in the
+same batch.  Nothing in the staging tables enforces that (every column is
+text), the warehouse would reject the orphans one by one.
+
+The references are declared in `REFERENCES`.  The rows checked are the ones
+that are pending or in error (see `processing.eligible`), the orphans are
+moved in error with the referencing field added to their `fields_in_error`.
+The rows referenced count if they are not ignored, even if they are in error
+themselves (they may still be fixed).
+
+There are two methods, both work in chunks of consecutive primary keys, every
+chunk in its own transaction together with the change of the `BatchSummary`:
+
+*   `hash`: the keys of every referenced table of the batch are read once
+    into a set, the referencing rows are streamed through them, only the
+    columns needed, and the orphans of a chunk are flagged with an UPDATE per
+    distinct set of fields in error.
+
+*   `sql`: the join is left to the database, the orphans of a chunk are
+    flagged with UPDATEs filtered by NOT IN (subquery).  Only possible when
+    both tables live in the same database, which is what `auto` looks at.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import operator, functools, collections
+
+from django.db import transaction, router
+from django.db.models import Q, Value
+from django.db.models.functions import Concat
+
+from . import models, loader, sizing, processing
+
+
+METHODS = [ 'auto' , 'hash' , 'sql' ]
+
+REFERENCES = {
+      'offer' : [
+          ( 'currency_id' , 'currency' , 'external_id' )
+        ]
+    , 'exchange-rate' : [
+          ( 'primary_currency_id' , 'currency' , 'external_id' )
+        , ( 'secondary_currency_id' , 'currency' , 'external_id' )
+        ]
+    }
+
+
+def referenced(table, key, batch):
+    '''
+    The keys of the rows of the table in the batch that can be referenced.
+    '''
+    model = loader.TABLES[table].model
+    return model.objects.filter(batch_id=batch, ignore=False) \
+                        .values_list(key, flat=True)
+
+def same_database(table, references):
+    '''
+    Whether the table and all the tables it references are read from the
+    same database.
+    '''
+    using = router.db_for_read(loader.TABLES[table].model)
+    return all( router.db_for_read(loader.TABLES[x].model) == using
+                for field, x, key in references )
+
+def add_field(fields, field):
+    '''
+    The `fields_in_error` (a comma separated list, or None) with the field.
+    '''
+    names = [ x for x in (fields or '').split(',') if x ]
+    if not field in names:
+        names.append(field)
+    return ','.join(names)
+
+def listing(field):
+    '''
+    Rows whose `fields_in_error` lists the field.
+    '''
+    return ( Q(fields_in_error=field)
+           | Q(fields_in_error__startswith=field + ',')
+           | Q(fields_in_error__endswith=',' + field)
+           | Q(fields_in_error__contains=',%s,' % field) )
+
+def flag_sql(step, field, keys):
+    '''
+    Move the rows of the step whose field is not among the keys (a queryset)
+    in error, with the field in error.  Returns the number of rows that were
+    pending.
+    '''
+    orphans = step.exclude(**{ field + '__in' : keys })
+    pending = orphans.filter(processed=False).count()
+    state = { 'processed' : True , 'in_error' : True }
+    blank = Q(fields_in_error__isnull=True) | Q(fields_in_error='')
+    orphans.filter(blank).update(fields_in_error=field, **state)
+    orphans.exclude(blank).exclude(listing(field)).update(
+        fields_in_error=Concat('fields_in_error', Value(',' + field))
+      , **state )
+    orphans.filter(listing(field)).update(**state)
+    return pending
+
+def check_sql(table, batch, references, chunk, progress=None):
+    '''
+    Check the references of the table in the batch in the database.  Returns
+    the numbers of rows checked and of orphans flagged.
+    '''
+    model = loader.TABLES[table].model
+    queryset = processing.eligible(model, batch)
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    subqueries = [ (field, referenced(x, key, batch))
+                   for field, x, key in references ]
+    orphan = functools.reduce( operator.or_
+                             , [ ~Q(**{ field + '__in' : keys })
+                                 for field, keys in subqueries ] )
+    todo = queryset.count()
+    last = 0
+    done = [0, 0]
+    while True:
+        bound = list(ids.filter(id__gt=last)[chunk-1:chunk])
+        step = queryset.filter(id__gt=last)
+        if bound:
+            step = step.filter(id__lte=bound[0])
+        with transaction.atomic():
+            rows = step.count()
+            bad = step.filter(orphan).count()
+            pending = sum( flag_sql(step, field, keys)
+                           for field, keys in subqueries )
+            models.BatchSummary.add( model, batch
+                                   , { 'pending' : -pending
+                                     , 'in_error' : pending } )
+        done[0] += rows
+        done[1] += bad
+        if progress:
+            progress(table, min(done[0], todo), todo)
+        if not bound:
+            return tuple(done)
+        last = bound[0]
+
+def check_hash(table, batch, references, chunk, indexes, progress=None):
+    '''
+    Check the references of the table in the batch against the sets of keys
+    in `indexes`, a dictionary from referenced table and key to the keys.
+    The missing sets are built and added.  Returns the numbers of rows
+    checked and of orphans flagged.
+    '''
+    model = loader.TABLES[table].model
+    for field, x, key in references:
+        if not (x, key) in indexes:
+            indexes[(x, key)] = set(referenced(x, key, batch).iterator())
+    checks = [ (i + 3, field, indexes[(x, key)])
+               for i, (field, x, key) in enumerate(references) ]
+    queryset = processing.eligible(model, batch)
+    todo = queryset.count()
+    values = queryset.order_by('id').values_list(
+        'id', 'in_error', 'fields_in_error', *[ x[0] for x in references ] )
+    last = 0
+    done = [0, 0]
+    while True:
+        with transaction.atomic():
+            rows = list(values.filter(id__gt=last)[:chunk])
+            if not rows:
+                return tuple(done)
+            orphans = collections.defaultdict(list)
+            pending = 0
+            for row in rows:
+                missing = [ field for pos, field, keys in checks
+                            if not row[pos] in keys ]
+                if not missing:
+                    continue
+                fields = row[2]
+                for field in missing:
+                    fields = add_field(fields, field)
+                orphans[fields].append(row[0])
+                if not row[1]:
+                    pending += 1
+            for fields, ids in orphans.items():
+                for start in range(0, len(ids), processing.ID_BATCH):
+                    model.objects.filter(
+                        id__in=ids[start:start+processing.ID_BATCH] ) \
+                        .update( processed=True, in_error=True
+                               , fields_in_error=fields )
+            models.BatchSummary.add( model, batch
+                                   , { 'pending' : -pending
+                                     , 'in_error' : pending } )
+        done[0] += len(rows)
+        done[1] += sum(map(len, orphans.values()))
+        last = rows[-1][0]
+        if progress:
+            progress(table, done[0], todo)
+
+def check_batch( batch, tables=None, method='auto', chunk=None
+               , progress=None ):
+    '''
+    Check the references of the `tables` (all tables with references by
+    default) in the batch and flag the orphans.  Returns an ordered
+    dictionary from table to the method used and the numbers of rows checked
+    and of orphans flagged.
+    '''
+    if not method in METHODS:
+        raise ValueError('no such method: %s' % method)
+    if tables is None:
+        tables = sorted(REFERENCES.keys())
+    chunk = chunk or sizing.fixed_size()
+    indexes = {}  # built once, shared by the tables
+    counts = collections.OrderedDict()
+    for table in tables:
+        references = REFERENCES.get(table, [])
+        if not references:
+            counts[table] = (None, 0, 0)
+            continue
+        use = method
+        if 'auto' == use:
+            use = 'sql' if same_database(table, references) else 'hash'
+        if 'sql' == use:
+            checked, bad = check_sql( table, batch, references, chunk
+                                    , progress )
+        else:
+            checked, bad = check_hash( table, batch, references, chunk
+                                     , indexes, progress )
+        counts[table] = (use, checked, bad)
+    return counts
@@ -0,0 +1,152 @@
+'''
+Number of rows committed at a time by the loads.
+
+`HQ_DW_COMMIT_SIZE` is either a number of rows, used as it is for every table
+and every database, or `'auto'`.  No single number is right everywhere: an
+offer row is several times wider than a currency row, and on SQLite every
+INSERT statement built by `bulk_create` is limited to 999 values, a chunk that
+is not a multiple of the rows that fit in one statement ends with a short
+statement.
+
+In auto mode the first chunk of a table gets a fixed budget of values (rows
+times columns), rounded down to a whole number of INSERT statements of the
+backend.  After every chunk the size is corrected by the observed rate so
+that a commit takes about `HQ_DW_COMMIT_SECONDS` (default 1), the size at
+most doubles or halves from one chunk to the next and changes of less than a
+tenth are not worth it.
+
+Places that need a plain number (the updates of `states`, the upload API...)
+use `fixed_size()`, which is the default of 1000 rows in auto mode.
+
+Do not import models here.
+'''
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+AUTO = 'auto'
+DEFAULT_SIZE = 1000
+START_VALUES = 16384  # values (rows times columns) in the first chunk
+MIN_SIZE = 100
+MAX_SIZE = 100000
+
+
+def setting():
+    return getattr(settings, 'HQ_DW_COMMIT_SIZE', DEFAULT_SIZE)
+
+def parse(value):
+    '''
+    A commit size as given on the command line: `auto` or a positive number,
+    raises ValueError otherwise.
+    '''
+    if AUTO == value:
+        return AUTO
+    size = int(value)
+    if size < 1:
+        raise ValueError(value)
+    return size
+
+def fixed_size(size=None):
+    '''
+    The number of rows of a chunk for code that cannot adapt it, from the
+    setting unless a `size` is given.
+    '''
+    if size is None:
+        size = setting()
+    if AUTO == size:
+        return DEFAULT_SIZE
+    return int(size)
+
+def statement_rows(model, engine, using=DEFAULT_DB_ALIAS):
+    '''
+    The number of rows `bulk_create` puts into a single INSERT statement on
+    the backend, None if it is not limited.  The `copy` engine sends all
+    rows of a chunk at once and is never limited.
+    '''
+    if 'copy' == engine:
+        return None
+    fields = [ f for f in model._meta.concrete_fields if not f.primary_key ]
+    rows = connections[using].ops.bulk_batch_size(fields, [None] * MAX_SIZE)
+    if rows >= MAX_SIZE:
+        return None
+    return max(rows, 1)
+
+
+class FixedSizer(object):
+    '''
+    The same number of rows in every chunk.
+    '''
+    def __init__(self, size):
+        self.size = size
+
+    def observe(self, rows, seconds):
+        pass
+
+    def report(self):
+        return { 'mode' : 'fixed' , 'size' : self.size }
+
+
+class AutoSizer(object):
+    '''
+    Adapts the number of rows in a chunk of a load into the table of the
+    model so that each commit takes about `target` seconds.
+    '''
+    def __init__(self, model, engine, target=None, using=DEFAULT_DB_ALIAS):
+        if target is None:
+            target = getattr(settings, 'HQ_DW_COMMIT_SECONDS', 1.0)
+        self.target = target
+        self.step = statement_rows(model, engine, using) or 1
+        columns = len(model._meta.concrete_fields)
+        self.size = self.round(START_VALUES // columns)
+        self.first = self.smallest = self.largest = self.size
+        self.changes = 0
+
+    def round(self, rows):
+        '''
+        Clamp the rows and round them down to whole statements.
+        '''
+        rows = max(MIN_SIZE, min(MAX_SIZE, int(rows)))
+        return max(self.step, rows - rows % self.step)
+
+    def observe(self, rows, seconds):
+        '''
+        A chunk of `rows` took `seconds` to insert and commit.  The last
+        chunk of a load is short and tells us nothing.
+        '''
+        if rows < self.size or seconds <= 0:
+            return
+        wanted = rows * self.target / seconds
+        wanted = max(self.size / 2.0, min(self.size * 2.0, wanted))
+        if abs(wanted - self.size) < self.size / 10.0:
+            return
+        size = self.round(wanted)
+        if size != self.size:
+            self.size = size
+            self.changes += 1
+            self.smallest = min(self.smallest, size)
+            self.largest = max(self.largest, size)
+
+    def report(self):
+        return {
+              'mode' : AUTO
+            , 'target_seconds' : self.target
+            , 'rows_per_statement' : self.step
+            , 'first' : self.first
+            , 'last' : self.size
+            , 'min' : self.smallest
+            , 'max' : self.largest
+            , 'changes' : self.changes
+            }
+
+
+def sizer(model, engine, size=None):
+    '''
+    The sizer of a load into the table of the model, with the commit `size`
+    or the setting.
+    '''
+    if size is None:
+        size = setting()
+    if AUTO == size:
+        return AutoSizer(model, engine)
+    return FixedSizer(int(size))
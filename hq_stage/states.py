@@ -0,0 +1,127 @@
+'''
+Bulk transitions between the states of the staging rows.
+
+The update views change a single row at a time, which is useless when a whole
+batch needs to be reset or a few hundred thousand rows ignored.  Here a set of
+rows (by table, batch, state and fields in error) is moved to another state
+with plain UPDATE statements.  The transition is checked against the state
+machine of `DataRow` first.
+
+A single UPDATE over a large set of rows would hold its row locks (and keep
+the loaders and the update views waiting) until it is done.  Instead the rows
+are updated in chunks of consecutive primary keys, every chunk is one
+statement in its own short transaction, together with the change of the
+`BatchSummary` of its batch.
+
+This module imports the models, only import it after django.setup().
+'''
+
+import collections
+
+from django.db import transaction
+
+from . import models, loader, sizing
+
+
+class TransitionError(Exception):
+    '''
+    The transition is not allowed by the state machine, the message says why.
+    '''
+    pass
+
+
+def sources(target, source=None):
+    '''
+    The states from which rows can move into the `target` state.  If a
+    `source` is given it must be one of these.  Raises `TransitionError` if
+    no such move is allowed.
+    '''
+    if not target in models.ROW_STATES:
+        raise TransitionError('no such state: %s' % target)
+    allowed = [ x for x, targets in models.ROW_TRANSITIONS.items()
+                if target in targets ]
+    if source is None:
+        return allowed
+    if not source in models.ROW_STATES:
+        raise TransitionError('no such state: %s' % source)
+    if not source in allowed:
+        raise TransitionError( 'rows cannot move from %s to %s'
+                             % (source, target) )
+    return [source]
+
+def selection(model, state, batch=None, pattern=None):
+    '''
+    The rows of a table in a state, possibly only of a batch and with a field
+    in error containing `pattern`.
+    '''
+    q = model.objects.filter(**models.ROW_STATES[state])
+    if batch is not None:
+        q = q.filter(batch_id=batch)
+    if pattern:
+        q = q.filter(fields_in_error__contains=pattern)
+    return q
+
+def move(queryset, batch, source, target, chunk):
+    '''
+    Move the rows of the queryset, all of them in the `batch` and in the
+    `source` state, to the `target` state.  At most `chunk` rows are moved
+    per UPDATE.  The end of a chunk is found on the primary key index, and
+    the UPDATE repeats the conditions of the queryset, a row changed by
+    someone else in the meantime is not touched.  Every chunk updates the
+    summary of the batch.  Returns the number of rows moved.
+    '''
+    flags = dict(models.ROW_STATES[target])
+    if not flags['in_error']:
+        flags['fields_in_error'] = None  # the errors are not current any more
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    last = 0
+    rows = 0
+    while True:
+        bound = list(ids.filter(id__gt=last)[chunk-1:chunk])
+        step = queryset.filter(id__gt=last)
+        if bound:
+            step = step.filter(id__lte=bound[0])
+        with transaction.atomic():
+            moved = step.update(**flags)
+            models.BatchSummary.add( queryset.model, batch
+                                   , { source : -moved , target : moved } )
+        rows += moved
+        if not bound:
+            return rows
+        last = bound[0]
+
+def set_state( target, source=None, tables=None, batch=None, pattern=None
+             , chunk=None, dry_run=False ):
+    '''
+    Move the selected rows of the `tables` (all tables by default) into the
+    `target` state.  Without a `source` the rows in every state that can move
+    into `target` are moved.  With `dry_run` the rows are only counted.
+
+    Returns an ordered dictionary from table to an ordered dictionary from
+    source state to the number of rows moved (or that would be moved).
+    '''
+    states = sources(target, source)
+    if tables is None:
+        tables = sorted(loader.TABLES.keys())
+    chunk = chunk or sizing.fixed_size()
+    counts = collections.OrderedDict()
+    for table in tables:
+        model = loader.TABLES[table].model
+        counts[table] = collections.OrderedDict()
+        for state in states:
+            q = selection(model, state, batch, pattern)
+            if dry_run:
+                counts[table][state] = q.count()
+                continue
+            # one batch at a time, so we know which summaries to update
+            if batch is None:
+                batches = list( q.order_by('batch_id')
+                                .values_list('batch_id', flat=True)
+                                .distinct() )
+            else:
+                batches = [batch]
+            counts[table][state] = sum(
+                move( selection(model, state, x, pattern), x, state, target
+                    , chunk )
+                for x in batches )
+    return counts
@@ -1,2 +1,1215 @@
-from django.test import TestCase
+import io, os, csv, gzip, json, time, array, shutil, socket, tempfile
+import select, threading, contextlib
+from unittest import mock, skipUnless
 
+from django.conf.urls import url, include
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, SimpleTestCase
+from django.test import override_settings, RequestFactory
+from django.contrib.auth.models import User, Permission
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from hq_stage import models, loader, processing, references, validation
+from hq_stage import states, archive, partitions, ingest, loadstats, bulk
+from hq_stage import pagination, caching, command_line, sizing, loadd
+from hq_stage import landing, views
+from hq_stage.csvio import read_unix_csv, split_csv
+
+
+CURRENCIES = '''id,code,name
+0,XXX,dummy
+1,GBP,British Pound
+2,USD,US Dollar
+3,eur,Euro
+'''
+
+OFFER = ( '%i,33433,%s,EXT,14,4238.69,2016-03-09,2016-03-19,1,2016-11-29,'
+          '2016-07-13,0,2016-02-18 15:01:57' )
+
+
+def offers(currencies):
+    '''
+    A CSV file of offers, one per currency id.
+    '''
+    rows = [ '0,dummy,,,,,,,,,,,' ]
+    rows.extend(OFFER % (i + 1, x) for i, x in enumerate(currencies))
+    return '\n'.join(rows) + '\n'
+
+
+urlpatterns = [ url(r'^stage/', include('hq_stage.urls')) ]  # for the views
+
+LOCMEM = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+class Loading(object):
+    '''
+    Writes CSV files into a temporary directory and loads them, quietly.
+    '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.batch = models.Batch()
+        self.batch.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def load(self, table, text, batch=None, name=None, **options):
+        path = self.write(name or table + '.csv', text)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return loader.load( loader.TABLES[table], path
+                              , batch or self.batch, **options )
+
+    def states(self, table, batch=None):
+        '''
+        The state and the fields in error of the rows, in order of id.
+        '''
+        model = loader.TABLES[table].model
+        rows = model.objects.filter(batch=batch or self.batch).order_by('id')
+        return [ ( models.row_state(x.processed, x.in_error, x.ignore)
+                 , x.fields_in_error )
+                 for x in rows ]
+
+
+class LoadTestCase(Loading, TestCase):
+    pass
+
+
+def command(name, *args):
+    '''
+    Run a command line tool of ours, in the project the tests run in.
+    Returns its exit status and what it printed.
+    '''
+    out = io.StringIO()
+    status = 0
+    with mock.patch.object(command_line, 'settings_path'), \
+         mock.patch('sys.argv', [name] + list(args)), \
+         contextlib.redirect_stdout(out):
+        try:
+            getattr(command_line, name)()
+        except SystemExit as e:
+            status = e.code
+    return status, out.getvalue()
+
+
+class EngineTest(Loading, TransactionTestCase):
+    '''
+    The writers of a pipelined load have connections of their own, they do
+    not see the transaction of a TestCase.
+    '''
+    def rows(self, batch):
+        '''
+        The rows of the batch in order of external id, the writers insert
+        their chunks at once and the ids need not follow the file.
+        '''
+        spec = loader.TABLES['offer']
+        rows = spec.model.objects.filter(batch=batch).order_by('external_id')
+        return list(rows.values_list( 'processed', 'in_error'
+                                    , 'fields_in_error', *spec.infields ))
+
+    def test_same_rows(self):
+        text = offers(['1', '2', 'x', '"3"']) + '9,"a, b",,,,,,,,,,,\n'
+        expected = None
+        for engine, options in [ ('orm', {}), ('copy', {})
+                               , ('orm', { 'writers' : 2 })
+                               , ('copy', { 'writers' : 2 }) ]:
+            batch = models.Batch()
+            batch.save()
+            self.assertEqual( 5, self.load( 'offer', text, batch, engine=engine
+                                          , commit_size=2, validate=True
+                                          , **options ) )
+            if expected is None:
+                expected = self.rows(batch)
+            self.assertEqual(expected, self.rows(batch), (engine, options))
+        self.assertEqual( [ (False, False), (False, False), (True, True)
+                          , (False, False), (True, True) ]
+                        , [ x[:2] for x in expected ] )
+
+    def test_instrumented(self):
+        text = offers(['1', '2', '1', '2', '1'])
+        counts = []
+        for engine, options in [ ('orm', {}), ('copy', {})
+                               , ('copy', { 'writers' : 2 }) ]:
+            stats = loadstats.LoadStats('offer')
+            with CaptureQueriesContext(connection) as queries:
+                self.load( 'offer', text, models.Batch.objects.create()
+                         , engine=engine, commit_size=2, stats=stats
+                         , **options )
+            result = stats.as_dict()
+            self.assertEqual(5, result['rows'])
+            self.assertEqual(3, result['chunks'])
+            self.assertEqual(set(loadstats.PHASES), set(result['phases']))
+            self.assertGreater(result['seconds'], 0)
+            counts.append(result['queries'])
+            if engine == 'orm':  # the counted ones are still logged
+                self.assertGreaterEqual(len(queries), result['queries'])
+        # the writers count in their own threads
+        self.assertEqual(counts[1], counts[2])
+        self.assertGreaterEqual(counts[0], 3)
+        path = os.path.join(self.directory, 'load.prom')
+        stats.write_prometheus(path)
+        with open(path) as f:
+            metric = 'hq_stage_load_queries{table="offer"} %i' % counts[-1]
+            self.assertIn(metric, f.read())
+
+    def test_count_copy(self):
+        spec = loader.TABLES['currency']
+        values = { 'batch' : self.batch.id , 'insert_date' : timezone.now() }
+        columns, prefix = bulk.prepare_layout( spec.model, spec.infields
+                                             , values )
+        rows = [ tuple(prefix) + (str(x), 'XXX', 'dummy') for x in range(3) ]
+        with CaptureQueriesContext(connection) as queries:
+            with loadstats.count_queries() as counter:
+                bulk.insert_rows(spec.model, columns, rows)
+        # the COPY is not logged, but it is counted all the same
+        others = [ x for x in queries.captured_queries
+                   if 'INSERT' not in x['sql'] ]
+        self.assertEqual(len(others) + 1, counter[0])
+        loaded = spec.model.objects.filter(batch=self.batch)
+        self.assertEqual(3, loaded.count())
+
+    def test_compressed(self):
+        text = offers(['1', '2'])
+        path = self.write('offer.csv.gz', '')
+        with gzip.open(path, 'wt') as f:
+            f.write(text)
+        other = models.Batch()
+        other.save()
+        self.load('offer', text, other)
+        with contextlib.redirect_stdout(io.StringIO()):
+            loader.load(loader.TABLES['offer'], path, self.batch)
+        self.assertEqual(self.rows(other), self.rows(self.batch))
+
+
+class CsvReaderTest(SimpleTestCase):
+
+    TEXT = 'id,name\n1,"two\nlines"\n2,caf\u00e9\n3,last\n'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'rows.csv')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(self.TEXT)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_offsets(self):
+        data = self.TEXT.encode('utf-8')
+        ends = [ i + 1 for i, x in enumerate(data) if 10 == x ]
+        ends.remove(data.index(b'two') + 4)  # inside the quotes
+        reader = read_unix_csv(self.path)
+        offsets = []
+        for row in reader:
+            offsets.append(reader.offset)
+        self.assertEqual(ends, offsets)
+
+    def test_start_at_offset(self):
+        reader = read_unix_csv(self.path)
+        next(reader)
+        next(reader)
+        rest = list(read_unix_csv(self.path, offset=reader.offset))
+        reader.close()
+        self.assertEqual([ ['2', 'caf\u00e9'], ['3', 'last'] ], rest)
+
+
+class ValidationTest(LoadTestCase):
+
+    def test_checks(self):
+        cases = [
+              ( validation.integer, ['0', '0042', '9' * 18]
+              , ['', '-1', '1.5', '9' * 19, '\u0664', '1\n2'] )
+            , ( validation.decimal, ['1', '-0.5', '4238.69']
+              , ['1,000.00', '.5', '1e3', '1.1234567'] )
+            , ( validation.currency_code, ['GBP', 'USD']
+              , ['eur', 'GBPX', 'G P', 'GBP\nUSD'] )
+            , ( validation.date, ['2016-02-29', '2016-12-31']
+              , ['2015-02-29', '2016-13-01', '16-01-01', ''] )
+            , ( validation.timestamp, ['2016-02-18 15:01:57']
+              , ['2016-02-30 15:01:57', '2016-02-18 24:00:00'
+                , '2016-02-18T15:01:57'] )
+            , ( validation.flag, ['0', '1'], ['2', 'yes', ''] )
+            , ( validation.text, ['a'], ['', ' '] )
+            , ( validation.blank, ['', ' '], ['a'] )
+            ]
+        for check, good, bad in cases:
+            self.assertEqual(set(), check.bad(set(good)), good)
+            self.assertEqual(set(bad), check.bad(set(good + bad)), bad)
+
+    def test_validator(self):
+        fields = [ name for name, check in validation.RULES['offer'] ]
+        row = ( OFFER % (1, '3') ).split(',') + [ '' ]
+        broken = list(row)
+        broken[fields.index('selling_price')] = 'cheap'
+        broken[fields.index('checkin_date')] = '2016-02-30'
+        validator = validation.Validator(
+            'offer', dict( (x, i) for i, x in enumerate(fields) ) )
+        self.assertEqual( { 1 : [ 'selling_price', 'checkin_date' ] }
+                        , validator.errors([ row, broken, row ]) )
+
+    def test_validate_on_load(self):
+        self.load('currency', CURRENCIES + '4,,\n', validate=True)
+        self.assertEqual( [ ('pending', None), ('pending', None)
+                          , ('in_error', 'currency_code')
+                          , ('in_error', 'currency_code,currency_name') ]
+                        , self.states('currency') )
+        self.assertEqual( [ 2, 0, 2, 0 ]
+                        , [ models.BatchSummary.count_rows( models.Currency
+                                                          , x, self.batch.id )
+                            for x in models.ROW_STATES ] )
+
+
+class SplitTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, rows):
+        path = os.path.join(self.directory, 'rows.csv')
+        with open(path, 'w') as f:
+            f.writelines(rows)
+        return path
+
+    def rows(self, path, spans):
+        rows = []
+        for span in spans:
+            rows.extend(read_unix_csv(path, span))
+        return rows
+
+    def test_split(self):
+        path = self.write( '%i,"say ""%i""\nagain",x\n' % (i, i) if i % 3
+                           else '%i,plain,x\n' % i
+                           for i in range(500) )
+        spans = split_csv(path, 4, block=256)
+        self.assertEqual(4, len(spans))
+        self.assertEqual(0, spans[0][0])
+        self.assertEqual(os.path.getsize(path), spans[-1][1])
+        for (s, e), (t, f) in zip(spans[:-1], spans[1:]):
+            self.assertEqual(e, t)
+        rows = self.rows(path, spans)
+        self.assertEqual(list(read_unix_csv(path)), rows)
+        self.assertEqual('say "1"\nagain', rows[1][1])
+
+    def test_stray_quote(self):
+        rows = [ '%i,"two\nlines",x\n' % i for i in range(500) ]
+        rows[10] = '10,fifty"five,x\n'
+        path = self.write(rows)
+        self.assertEqual( [ (0, os.path.getsize(path)) ]
+                        , split_csv(path, 4, block=256) )
+
+
+class AutoSizerTest(SimpleTestCase):
+
+    def sizes(self, sizer, seconds, n=1):
+        '''
+        The sizes after `n` full chunks that take `seconds` each.
+        '''
+        result = []
+        for i in range(n):
+            sizer.observe(sizer.size, seconds)
+            result.append(sizer.size)
+        return result
+
+    def test_grow_shrink_clamp(self):
+        sizer = sizing.AutoSizer(models.Offer, 'copy', target=1.0)
+        start = sizing.START_VALUES // len(models.Offer._meta.concrete_fields)
+        self.assertEqual(start, sizer.size)
+        # quick commits grow the chunks, at most twice as big at a time
+        self.assertEqual([start * 2, start * 4], self.sizes(sizer, 0.25, 2))
+        self.assertEqual([start * 6], self.sizes(sizer, 2 / 3.0))
+        # close enough to the target, and the short last chunk of a load
+        self.assertEqual([start * 6], self.sizes(sizer, 1.05))
+        sizer.observe(sizer.size - 1, 100)
+        sizer.observe(sizer.size, 0)
+        self.assertEqual(start * 6, sizer.size)
+        # slow commits shrink them, at most to half at a time
+        self.assertEqual([start * 3, start * 3 // 2], self.sizes(sizer, 10, 2))
+        self.assertEqual( [sizing.MIN_SIZE] * 2
+                        , self.sizes(sizer, 100, 20)[-2:] )
+        self.assertEqual( [sizing.MAX_SIZE] * 2
+                        , self.sizes(sizer, 0.001, 20)[-2:] )
+        report = sizer.report()
+        self.assertEqual( ( start, sizing.MAX_SIZE, sizing.MIN_SIZE
+                          , sizing.MAX_SIZE )
+                        , ( report['first'], report['last'], report['min']
+                          , report['max'] ) )
+
+    def test_whole_statements(self):
+        sizer = sizing.AutoSizer(models.Offer, 'orm', target=1.0)
+        step = sizing.statement_rows(models.Offer, 'orm')
+        self.assertEqual(step or 1, sizer.step)
+        for seconds in [ 0.3, 0.7, 3, 0.9, 0.001, 100 ]:
+            sizer.observe(sizer.size, seconds)
+            self.assertEqual(0, sizer.size % sizer.step, seconds)
+            self.assertGreaterEqual(sizer.size, sizing.MIN_SIZE)
+
+
+class ResumeTest(LoadTestCase):
+
+    def ids(self):
+        rows = models.Offer.objects.filter(batch=self.batch).order_by('id')
+        return list(rows.values_list('external_id', flat=True))
+
+    def interrupt(self, text, chunks, **options):
+        '''
+        Load the offers, the chunk after the first `chunks` fails.
+        '''
+        add = models.BatchSummary.add
+        calls = []
+
+        def fail(*args):
+            calls.append(args)
+            if len(calls) > chunks:
+                raise RuntimeError('interrupted')
+            return add(*args)
+
+        with mock.patch.object(models.BatchSummary, 'add', side_effect=fail):
+            with self.assertRaises(RuntimeError):
+                self.load('offer', text, commit_size=2, **options)
+
+    def test_resume(self):
+        text = offers(['1'] * 7)
+        self.interrupt(text, 2)
+        self.assertEqual(['1', '2', '3', '4'], self.ids())
+        self.assertEqual( 3, self.load( 'offer', text, commit_size=2
+                                      , resume=True ) )
+        self.assertEqual([ str(x) for x in range(1, 8) ], self.ids())
+        checkpoint = models.LoadCheckpoint.objects.get(batch=self.batch)
+        self.assertEqual(7, checkpoint.row_number)
+        self.assertEqual(len(text.encode('utf-8')), checkpoint.offset)
+
+    def test_not_resumed_starts_afresh(self):
+        text = offers(['1'] * 3)
+        self.interrupt(text, 1)
+        models.Offer.objects.filter(batch=self.batch).delete()
+        self.assertEqual(3, self.load('offer', text, commit_size=2))
+        self.assertEqual(['1', '2', '3'], self.ids())
+
+    def test_resume_other_file(self):
+        self.interrupt(offers(['1'] * 3), 1)
+        with self.assertRaises(loader.LoadError):
+            self.load('offer', offers(['2'] * 3), resume=True)
+
+    def test_long_path(self):
+        parts = [ x * 100 for x in 'abc' ]
+        os.makedirs(os.path.join(self.directory, *parts))
+        name = os.path.join(*(parts + [ 'offer.csv' ]))
+        self.load('offer', offers(['1']), name=name)
+        key = models.LoadCheckpoint.objects.get(batch=self.batch).file_name
+        path = os.path.join(self.directory, name)
+        self.assertEqual(loader.file_key(path), key)
+        self.assertEqual(loader.FILE_NAME, len(key))
+        self.assertTrue(key.endswith(os.sep + 'offer.csv'))
+        other = os.path.join(self.directory, 'x' + name[1:])
+        self.assertNotEqual(key, loader.file_key(other))
+
+
+class ManifestTest(LoadTestCase):
+
+    def load_table(self, path, *args):
+        return command('load_table', '-f', path, '-t', 'currency', *args)
+
+    def test_loaded_file_is_skipped(self):
+        path = self.write('currency.csv', CURRENCIES)
+        spec = loader.TABLES['currency']
+        self.assertIsNone(loader.find_loaded(spec, path))
+        self.assertEqual(0, self.load_table(path)[0])
+        manifest = loader.find_loaded(spec, path)
+        self.assertEqual(3, manifest.row_count)
+        status, out = self.load_table(path)
+        self.assertEqual(0, status)
+        self.assertIn( 'already loaded into batch %i' % manifest.batch_id
+                     , out )
+        self.assertEqual(3, models.Currency.objects.count())
+        status, out = self.load_table(path, '--force')
+        self.assertEqual(0, status)
+        self.assertIn( 'the same content was loaded into batch %i'
+                       % manifest.batch_id, out )
+        self.assertEqual(6, models.Currency.objects.count())
+        # another file under the same name is not the one that was loaded
+        self.write('currency.csv', CURRENCIES.replace('Pound', 'pound'))
+        self.assertIsNone(loader.find_loaded(spec, path))
+
+
+@override_settings(ROOT_URLCONF=__name__, ALLOWED_HOSTS=['.example.com'])
+class PrintErrorsTest(LoadTestCase):
+    '''
+    A batch with a currency in error and another one with two.
+    '''
+    def setUp(self):
+        super(PrintErrorsTest, self).setUp()
+        self.other = models.Batch.objects.create()
+        self.load('currency', CURRENCIES, validate=True)
+        self.load( 'currency', CURRENCIES + '4,usd,Dollar\n', self.other
+                 , validate=True )
+        errors = models.Currency.objects.filter(in_error=True)
+        self.errors = [ ( 'currency', str(x.batch_id), str(x.id)
+                        , 'currency_code'
+                        , 'http://example.com/stage/currency/%i/' % x.id )
+                        for x in errors.order_by('id') ]
+        self.assertEqual(3, len(self.errors))
+
+    def print_errors(self, *args):
+        status, out = command('print_errors', *args)
+        self.assertEqual(0, status, out)
+        return out
+
+    def test_csv(self):
+        out = self.print_errors('-t', 'currency', '-o', 'csv')
+        rows = list(csv.reader(io.StringIO(out)))
+        self.assertEqual( ['table', 'batch', 'id', 'fields_in_error', 'url']
+                        , rows[0] )
+        self.assertEqual(self.errors, [ tuple(x) for x in rows[1:] ])
+
+    def test_ndjson(self):
+        out = self.print_errors('-o', 'ndjson', '-b', str(self.other.id))
+        records = [ json.loads(x) for x in out.splitlines() ]
+        self.assertEqual( self.errors[1:]
+                        , [ ( x['table'], str(x['batch']), str(x['id'])
+                            , x['fields_in_error'], x['url'] )
+                            for x in records ] )
+
+    def test_urls(self):
+        out = self.print_errors('-b', str(self.batch.id))
+        self.assertEqual([self.errors[0][-1]], out.splitlines())
+
+    def test_count_only(self):
+        out = self.print_errors('-c')
+        self.assertEqual( [ 'currency 3', 'exchange-rate 0', 'offer 0' ]
+                        , out.splitlines() )
+        out = self.print_errors( '-c', '-t', 'currency', '-o', 'ndjson'
+                               , '-b', str(self.other.id) )
+        self.assertEqual( { 'table' : 'currency' , 'batch' : self.other.id
+                          , 'count' : 2 }
+                        , json.loads(out) )
+        # the ignored errors are not counted
+        states.set_state('ignored', batch=self.batch.id)
+        out = self.print_errors('-c', '-x', '-t', 'currency', '-o', 'csv')
+        self.assertEqual( [ 'table,batch,count', 'currency,,2' ]
+                        , out.splitlines() )
+        self.assertEqual(1, command('print_errors', '-c', '-b', 'x')[0])
+
+
+class SummaryTest(LoadTestCase):
+
+    def counts(self, batch=None):
+        return [ models.BatchSummary.count_rows( models.Currency, x
+                                               , (batch or self.batch).id )
+                 for x in models.ROW_STATES ]
+
+    def test_save_moves_the_counts(self):
+        self.load('currency', CURRENCIES)
+        self.assertEqual([3, 0, 0, 0], self.counts())
+        row = models.Currency.objects.filter(batch=self.batch).first()
+        row.processed = True
+        with CaptureQueriesContext(connection) as queries:
+            row.save()
+        if connection.features.has_select_for_update:
+            self.assertTrue(any( 'FOR UPDATE' in x['sql']
+                                 for x in queries.captured_queries ))
+        self.assertEqual([2, 1, 0, 0], self.counts())
+        other = models.Batch()
+        other.save()
+        row.batch = other
+        row.save()
+        self.assertEqual([2, 0, 0, 0], self.counts())
+        self.assertEqual([0, 1, 0, 0], self.counts(other))
+
+    def test_reconcile(self):
+        self.load('currency', CURRENCIES, validate=True)
+        other = models.Batch()
+        other.save()
+        self.load('currency', CURRENCIES, batch=other, name='other.csv')
+        models.BatchSummary.objects.update(pending=7, ignored=1)
+        models.BatchSummary.reconcile(models.Currency, self.batch.id)
+        self.assertEqual([2, 0, 1, 0], self.counts())
+        self.assertEqual([7, 0, 0, 1], self.counts(other))
+        models.BatchSummary.reconcile(models.Currency)
+        self.assertEqual([3, 0, 0, 0], self.counts(other))
+
+
+class StatesTest(LoadTestCase):
+
+    def counts(self):
+        return [ models.BatchSummary.count_rows( models.Currency, x
+                                               , self.batch.id )
+                 for x in models.ROW_STATES ]
+
+    def test_sources(self):
+        self.assertEqual(['pending', 'ignored'], states.sources('in_error'))
+        self.assertEqual(['in_error'], states.sources('ignored', 'in_error'))
+        for target, source in [ ('ignored', 'pending'), ('pending', 'ignored')
+                              , ('lost', None), ('pending', 'lost') ]:
+            with self.assertRaises(states.TransitionError):
+                states.sources(target, source)
+
+    def test_set_state(self):
+        self.load('currency', CURRENCIES + '4,,\n', validate=True)
+        counts = states.set_state( 'ignored', tables=['currency']
+                                 , batch=self.batch.id, pattern='name'
+                                 , dry_run=True )
+        self.assertEqual({ 'in_error' : 1 }, dict(counts['currency']))
+        self.assertEqual([2, 0, 2, 0], self.counts())
+        states.set_state( 'ignored', tables=['currency'], batch=self.batch.id
+                        , pattern='name' )
+        self.assertEqual([2, 0, 1, 1], self.counts())
+        counts = states.set_state('processed', chunk=1)
+        self.assertEqual( { 'pending' : 2 , 'in_error' : 1 }
+                        , dict(counts['currency']) )
+        self.assertEqual([0, 3, 0, 1], self.counts())
+        self.assertEqual( [ ('processed', None) ] * 3
+                        + [ ('ignored', 'currency_code,currency_name') ]
+                        , self.states('currency') )
+
+
+class ArchiveTest(LoadTestCase):
+    '''
+    A processed batch with currencies in every state, and a batch that is
+    not processed yet.
+    '''
+    CURRENCIES = CURRENCIES + '4,JPY,Yen\n5,chf,Swiss Franc\n'
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.other = models.Batch.objects.create()
+        for batch in (self.batch, self.other):
+            self.load('currency', self.CURRENCIES, batch, validate=True)
+            rows = models.Currency.objects.filter(batch=batch)
+            rows.filter(external_id__in=['1', '4']).update(processed=True)
+            rows.filter(external_id='5').update(ignore=True)
+            models.BatchSummary.reconcile(models.Currency, batch.id)
+        self.batch.processed = True
+        self.batch.save()
+
+    def archive(self, **options):
+        return archive.archive( 'table', tables=['currency'], pause=0
+                              , **options )
+
+    def test_archive_table(self):
+        self.assertEqual({}, self.archive())  # younger than the retention
+        key = (self.batch.id, 'currency')
+        self.assertEqual({ key : (2, 1) }, self.archive(days=0, dry_run=True))
+        self.assertEqual(0, models.ArchivedRow.objects.count())
+        self.assertEqual({ key : (2, 1) }, self.archive(days=0))
+        archived = models.ArchivedRow.objects.order_by('row_id')
+        self.assertEqual( [ ( 'currency', self.batch.id, False, None
+                            , '1,GBP,British Pound' )
+                          , ( 'currency', self.batch.id, False, None
+                            , '4,JPY,Yen' )
+                          , ( 'currency', self.batch.id, True
+                            , 'currency_code', '5,chf,Swiss Franc' ) ]
+                        , [ ( x.table, x.batch_id, x.ignore
+                            , x.fields_in_error, x.data )
+                            for x in archived ] )
+        # the pending rows and the errors stay, and so does the other batch
+        self.assertEqual( [ ('pending', None), ('in_error', 'currency_code') ]
+                        , self.states('currency') )
+        self.assertEqual(5, len(self.states('currency', self.other)))
+        summary = models.BatchSummary.objects.get( batch=self.batch
+                                                 , table='currency' )
+        self.assertEqual( (1, 0, 1, 0)
+                        , ( summary.pending, summary.processed
+                          , summary.in_error, summary.ignored ) )
+        self.assertEqual({ key : (0, 0) }, self.archive(days=0))
+
+
+@override_settings(ROOT_URLCONF=__name__, HQ_DW_STATE_API_TOKEN='s3cret')
+class SetStateApiTest(LoadTestCase):
+    '''
+    Currencies with an error, moved to ignored through the API.
+    '''
+    REQUEST = { 'state' : 'ignored' , 'from' : 'in_error'
+              , 'object_type' : 'currency' }
+
+    def setUp(self):
+        super(SetStateApiTest, self).setUp()
+        self.load('currency', CURRENCIES, validate=True)
+        self.user = User.objects.create_user('operator')
+
+    def post(self, request=None, **headers):
+        return self.client.post( '/stage/state-api/'
+                               , json.dumps(request or self.REQUEST)
+                               , content_type='application/json', **headers )
+
+    def ignored(self):
+        return [ x[0] for x in self.states('currency') ].count('ignored')
+
+    def test_token(self):
+        self.assertEqual(403, self.post().status_code)
+        for header in [ 'Bearer secret', 'Bearer ', 's3cret' ]:
+            response = self.post(HTTP_AUTHORIZATION=header)
+            self.assertEqual(403, response.status_code, header)
+        with self.settings(HQ_DW_STATE_API_TOKEN=None):
+            response = self.post(HTTP_AUTHORIZATION='Bearer None')
+            self.assertEqual(403, response.status_code)
+        self.assertEqual(0, self.ignored())
+        response = self.post(HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, json.loads(response.content.decode())['total'])
+        self.assertEqual(1, self.ignored())
+
+    def session_post(self, request=None, csrf=True):
+        factory = RequestFactory()
+        request = factory.post( '/stage/state-api/'
+                              , json.dumps(request or self.REQUEST)
+                              , content_type='application/json' )
+        request.user = User.objects.get(id=self.user.id)  # fresh perms
+        request._dont_enforce_csrf_checks = csrf  # as the test client does
+        return views.SetStateView.as_view()(request)
+
+    def test_session(self):
+        self.assertEqual(403, self.session_post().status_code)
+        self.user.user_permissions.add(Permission.objects.get(
+            content_type__app_label='hq_stage', codename='change_currency' ))
+        self.assertEqual(403, self.session_post(csrf=False).status_code)
+        everything = { 'state' : 'ignored' , 'batch' : self.batch.id }
+        self.assertEqual(403, self.session_post(everything).status_code)
+        self.assertEqual(0, self.ignored())
+        self.assertEqual(200, self.session_post().status_code)
+        self.assertEqual(1, self.ignored())
+
+
+class ProcessingTest(LoadTestCase):
+
+    def test_process_batch(self):
+        self.load('currency', CURRENCIES)
+        self.load('offer', offers(['1', '2']))
+        counts = processing.process_batch(self.batch, chunk=2)
+        self.assertEqual((2, 1), counts['currency'])
+        self.assertEqual((2, 0), counts['offer'])
+        self.assertEqual( [ ('processed', None), ('processed', None)
+                          , ('in_error', 'currency_code') ]
+                        , self.states('currency') )
+        self.assertTrue(models.Batch.objects.get(id=self.batch.id).processed)
+
+    def test_fixed_rows_leave_error(self):
+        self.load('currency', CURRENCIES)
+        processing.process_batch(self.batch, ['currency'])
+        models.Currency.objects.filter(currency_code='eur') \
+                               .update(currency_code='EUR')
+        self.assertEqual( (1, 0)
+                        , processing.process_table( loader.TABLES['currency']
+                                                  , self.batch.id, 10 ) )
+        self.assertEqual(['processed'] * 3, [ x[0] for x in
+                                              self.states('currency') ])
+
+    def test_keeps_errors_it_cannot_check(self):
+        self.load('currency', CURRENCIES)
+        first = models.Currency.objects.order_by('id').first()
+        models.Currency.objects.filter(id=first.id).update(
+            processed=True, in_error=True, fields_in_error='by_hand' )
+        processing.process_batch(self.batch, ['currency'])
+        self.assertEqual( [ ('in_error', 'by_hand'), ('processed', None)
+                          , ('in_error', 'currency_code') ]
+                        , self.states('currency') )
+
+    def test_batch_processed_with_all_tables(self):
+        self.load('currency', CURRENCIES)
+        self.load('offer', offers(['1']))
+        processing.process_batch(self.batch, ['currency'])
+        self.assertFalse(models.Batch.objects.get(id=self.batch.id).processed)
+        processing.process_batch(self.batch, ['offer'])
+        self.assertTrue(models.Batch.objects.get(id=self.batch.id).processed)
+
+    def test_references_survive_processing(self):
+        self.load('currency', CURRENCIES)
+        self.load('offer', offers(['1', '9', '2', '8']))
+        counts = references.check_batch(self.batch, ['offer'], 'hash')
+        self.assertEqual(('hash', 4, 2), counts['offer'])
+        processing.process_batch(self.batch)
+        self.assertEqual( [ ('processed', None), ('in_error', 'currency_id')
+                          , ('processed', None), ('in_error', 'currency_id') ]
+                        , self.states('offer') )
+
+    def test_late_reference_is_processed(self):
+        self.load('offer', offers(['1', '9']))
+        references.check_batch(self.batch, ['offer'], 'sql')
+        self.assertEqual( [ 'in_error' ] * 2
+                        , [ x[0] for x in self.states('offer') ] )
+        self.load('currency', CURRENCIES)
+        processing.process_batch(self.batch)
+        self.assertEqual( [ ('processed', None), ('in_error', 'currency_id') ]
+                        , self.states('offer') )
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class PaginationTest(LoadTestCase):
+
+    def setUp(self):
+        super(PaginationTest, self).setUp()
+        self.load('offer', offers(['1'] * 7))
+        self.offers = models.Offer.objects.filter(batch=self.batch)
+        self.ids = [ x.id for x in self.offers.order_by('id') ]
+
+    def page(self, token=None, paginator=None):
+        paginator = paginator or pagination.KeysetPaginator(self.offers, 3)
+        page = paginator.page(token)
+        return [ x.id for x in page ], page.has_previous(), page.has_next()
+
+    def test_forward_and_back(self):
+        paginator = pagination.KeysetPaginator(self.offers, 3)
+        first = paginator.page()
+        second = paginator.page(first.next_page_number())
+        last = paginator.page(second.next_page_number())
+        self.assertEqual('a%i' % self.ids[2], first.next_page_number())
+        self.assertEqual('b%i' % self.ids[6], last.previous_page_number())
+        self.assertEqual((self.ids[:3], False, True), self.page())
+        self.assertEqual( (self.ids[3:6], True, True)
+                        , self.page(first.next_page_number()) )
+        self.assertEqual( (self.ids[6:], True, False)
+                        , self.page(second.next_page_number()) )
+        self.assertEqual( (self.ids[3:6], True, True)
+                        , self.page(last.previous_page_number()) )
+        self.assertEqual( (self.ids[:3], False, True)
+                        , self.page(second.previous_page_number()) )
+        # past the ends there is nothing, and nowhere to go
+        self.assertEqual( ([], False, False)
+                        , self.page('a%i' % self.ids[-1]) )
+        self.assertEqual( ([], False, False)
+                        , self.page('b%i' % self.ids[0]) )
+
+    def test_invalid_token(self):
+        paginator = pagination.KeysetPaginator(self.offers, 3)
+        for token in [ 'a', 'ax', 'c1', 'bad' ]:
+            with self.assertRaises(pagination.InvalidToken):
+                paginator.page(token)
+        response = self.client.get('/stage/offer/', { 'page' : 'bad' })
+        self.assertEqual(404, response.status_code)
+
+    def test_count_modes(self):
+        exact = pagination.KeysetPaginator(self.offers, 3, 'exact')
+        self.assertEqual((7, 3), (exact.count, exact.num_pages))
+        uncounted = pagination.KeysetPaginator(self.offers, 3, None)
+        self.assertEqual((None, 1), (uncounted.count, uncounted.num_pages))
+        counted = pagination.KeysetPaginator(self.offers, 3, lambda qs: 4)
+        self.assertEqual((4, 2), (counted.count, counted.num_pages))
+        approx = pagination.KeysetPaginator(self.offers, 3, 'approx')
+        self.assertGreaterEqual(approx.count, 0)
+        self.assertEqual(self.ids[:3], self.page(paginator=approx)[0])
+
+    def test_estimate_falls_back_to_count(self):
+        # the databases without planner statistics, e.g. SQLite
+        with mock.patch.object(connections['default'], 'vendor', 'sqlite'):
+            self.assertEqual(7, pagination.estimate_count(self.offers))
+            self.assertEqual(7, pagination.count_rows(self.offers))
+
+
+@skipUnless('postgresql' == connection.vendor, 'partitions need PostgreSQL')
+class PartitionTest(LoadTestCase):
+
+    def tearDown(self):
+        partitions.forget()  # the conversion is rolled back
+        super(PartitionTest, self).tearDown()
+
+    def relation(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute( 'SELECT relkind FROM pg_class '
+                            'WHERE oid = to_regclass(%s)', [ name ] )
+            row = cursor.fetchone()
+        return row and row[0]
+
+    def test_partitioned_life(self):
+        self.load('currency', CURRENCIES)
+        self.load('offer', offers(['1', '9']), engine='copy')
+        for model in partitions.data_models():
+            partitions.partition(model)
+            self.assertTrue(partitions.partitioned(model))
+            self.assertEqual('p', self.relation(model._meta.db_table))
+            self.assertEqual( 'r', self.relation(partitions.name( model
+                                                                , self.batch.id
+                                                                )) )
+        self.assertEqual(3, models.Currency.objects.count())
+        other = models.Batch()
+        other.save()
+        self.assertEqual(2, self.load( 'offer', offers(['1', '2']), other
+                                     , name='other.csv', engine='copy' ))
+        self.assertEqual( partitions.name(models.Offer, other.id)
+                        , partitions.table(models.Offer, other.id) )
+        self.assertEqual( 2, models.Offer.objects.filter(batch=other).count() )
+        ids = list(models.Offer.objects.values_list('id', flat=True))
+        self.assertEqual(len(set(ids)), len(ids))
+        row = models.Offer.objects.filter(batch=other).first()
+        row.processed = True
+        row.save()
+        archive.drop_batch(other.id)
+        self.assertIsNone(self.relation(partitions.name( models.Offer
+                                                       , other.id )))
+        self.assertEqual(2, models.Offer.objects.count())
+        processing.process_batch(self.batch)
+        self.assertIsNone(archive.archive( 'detach', days=0
+                                         , batch=self.batch.id
+                                         , tables=['currency'] )
+                          [(self.batch.id, 'currency')])  # eur is in error
+        states.set_state('ignored', tables=['currency'], batch=self.batch.id)
+        self.assertEqual( (2, 1)
+                        , archive.archive( 'detach', days=0
+                                         , batch=self.batch.id
+                                         , tables=['currency'] )
+                          [(self.batch.id, 'currency')] )
+        self.assertEqual( 'r', self.relation( 'hq_stage_currency_archived_%i'
+                                            % self.batch.id ) )
+        self.assertEqual(0, models.Currency.objects.count())
+        self.assertEqual( (0, 0)
+                        , archive.archive( 'detach', days=0
+                                         , batch=self.batch.id
+                                         , tables=['currency'] )
+                          [(self.batch.id, 'currency')] )  # again
+        self.assertEqual( [ ('processed', None), ('in_error', 'currency_id') ]
+                        , self.states('offer') )
+
+
+@override_settings(ROOT_URLCONF=__name__, HQ_DW_COMMIT_SIZE=2)
+class BulkUploadTest(TestCase):
+
+    def post(self, body, content_type, object_type='currency'):
+        response = self.client.post( '/stage/upload-api/bulk/'
+                                     '?object_type=%s' % object_type
+                                   , body, content_type=content_type )
+        if 200 != response.status_code:
+            return response.status_code
+        return json.loads(response.content.decode('utf-8'))
+
+    def record(self, i, **fields):
+        record = { 'external_id' : str(i) , 'currency_code' : 'GBP' }
+        record.update(fields)
+        return record
+
+    def loaded(self, result):
+        rows = models.Currency.objects.filter(batch=result['batch'])
+        return sorted(x.external_id for x in rows)
+
+    def test_ndjson(self):
+        lines = [ json.dumps(self.record(1)), ''
+                , json.dumps(self.record(2, currency_nam='Pound'))
+                , '{ "external_id" : "3",'
+                , json.dumps(self.record(4, currency_code=4))
+                , json.dumps(self.record(5)), json.dumps(self.record(6)) ]
+        result = self.post('\n'.join(lines), 'application/x-ndjson')
+        self.assertEqual(3, result['accepted'])
+        self.assertEqual( [ { 'line' : 3 , 'reason' : 'unknown fields: '
+                                                      'currency_nam' }
+                          , { 'line' : 4 , 'reason' : 'malformed JSON' }
+                          , { 'line' : 5
+                            , 'reason' : 'currency_code is not a string' } ]
+                        , result['rejected'] )
+        self.assertEqual(3, result['rejected_count'])
+        self.assertNotIn('error', result)
+        self.assertEqual(['1', '5', '6'], self.loaded(result))
+
+    def test_json_array(self):
+        records = [ self.record(1), 'GBP', self.record(3), self.record(4) ]
+        result = self.post(json.dumps(records), 'application/json')
+        self.assertEqual(3, result['accepted'])
+        self.assertEqual( [ { 'line' : 2 , 'reason' : 'not an object' } ]
+                        , result['rejected'] )
+        self.assertEqual(['1', '3', '4'], self.loaded(result))
+
+    def test_malformed_array(self):
+        # the records before the error are kept, in and out of a full chunk
+        records = [ json.dumps(self.record(x)) for x in range(1, 4) ]
+        body = '[ %s %s ]' % (', '.join(records), json.dumps(self.record(4)))
+        result = self.post(body, 'application/json')
+        self.assertEqual(3, result['accepted'])
+        self.assertEqual([], result['rejected'])
+        self.assertEqual('expected , or ] after element 3', result['error'])
+        self.assertEqual(['1', '2', '3'], self.loaded(result))
+
+    def test_wrong_content_type(self):
+        records = [ self.record(1), self.record(2) ]
+        # an array that is not said to be JSON is a single line of NDJSON
+        result = self.post(json.dumps(records), 'text/plain')
+        self.assertEqual(0, result['accepted'])
+        self.assertEqual( [ { 'line' : 1 , 'reason' : 'not an object' } ]
+                        , result['rejected'] )
+        # and lines of NDJSON said to be JSON are not an array
+        body = '\n'.join(json.dumps(x) for x in records)
+        result = self.post(body, 'application/json')
+        self.assertEqual(0, result['accepted'])
+        self.assertEqual('expected a JSON array', result['error'])
+        self.assertEqual([], self.loaded(result))
+        self.assertEqual(400, self.post(body, 'application/json', 'nothing'))
+
+
+class LandingTest(TransactionTestCase):
+    '''
+    The loads run in forked workers, with connections of their own.  What
+    they wrote is not seen from here on every backend (an in-memory SQLite
+    is copied by the fork), we look at the files and at what they said.
+    '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def land(self, name, data):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(data)
+
+    def listing(self, name=''):
+        return sorted(os.listdir(os.path.join(self.directory, name)))
+
+    def read(self, *path):
+        with open(os.path.join(self.directory, *path)) as f:
+            return f.read()
+
+    def test_scan_once(self):
+        self.land('hq-currency-20161018.csv', CURRENCIES.encode('ascii'))
+        broken = gzip.compress(CURRENCIES.encode('ascii'))[:-12]
+        self.land('hq-fx-20161018.csv.gz', broken)
+        self.land('readme.txt', b'no rule for me\n')
+        self.land('.hq-offer-20161018.csv', b'not complete yet\n')
+        out = io.StringIO()
+        service = landing.Service( self.directory, jobs=1, interval=0
+                                 , poll=True, out=out )
+        service.run(once=True)
+        self.assertEqual( [ '.hq-offer-20161018.csv', 'done', 'failed'
+                          , 'work' ]
+                        , self.listing() )
+        self.assertEqual([], self.listing('work'))
+        self.assertEqual( [ 'hq-currency-20161018.csv'
+                          , 'hq-currency-20161018.csv.log' ]
+                        , self.listing('done') )
+        self.assertEqual( [ 'hq-fx-20161018.csv.gz'
+                          , 'hq-fx-20161018.csv.gz.log', 'readme.txt' ]
+                        , self.listing('failed') )
+        self.assertIn( 'Rows: [ 3 ]'
+                     , self.read('done', 'hq-currency-20161018.csv.log') )
+        self.assertIn( 'Traceback'
+                     , self.read('failed', 'hq-fx-20161018.csv.gz.log') )
+        said = out.getvalue()
+        self.assertIn( 'watching %s with 1 workers, polling' % self.directory
+                     , said )
+        self.assertIn('failed readme.txt: no rule for its name', said)
+        self.assertIn('done currency hq-currency-20161018.csv: 3 rows', said)
+        self.assertIn('failed exchange-rate hq-fx-20161018.csv.gz: ', said)
+        self.assertEqual( { 'done' : 1 , 'failed' : 2 }
+                        , dict(service.files) )
+
+
+@override_settings(ROOT_URLCONF=__name__, HQ_DW_UPLOAD_BUFFER=10)
+class IngestTest(TransactionTestCase):
+    '''
+    The flusher writes with a connection of its own.
+    '''
+    RECORD = { 'external_id' : '1' , 'currency_code' : 'GBP'
+             , 'currency_name' : 'British Pound' }
+
+    def setUp(self):
+        self.batch = models.Batch()
+        self.batch.save()
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+
+    def queue(self, maxsize, flush_size, interval):
+        queue = ingest.IngestQueue(maxsize, flush_size, interval)
+        queue.thread.start()
+        self.queues.append(queue)
+        return queue
+
+    def put(self, queue, n=1):
+        row = loader.TABLES['currency'].from_record(self.RECORD)
+        for i in range(n):
+            queue.put('currency', self.batch.id, row)
+
+    def flushed(self, queue, rows, timeout=5):
+        '''
+        Seconds until `rows` records were flushed.
+        '''
+        start = time.time()
+        while queue.stats()['flushed'] < rows:
+            self.assertLess(time.time() - start, timeout)
+            time.sleep(0.01)
+        return time.time() - start
+
+    def post(self):
+        return self.client.post( '/stage/upload-api/'
+                               , json.dumps({ 'batch' : self.batch.id
+                                            , 'object_type' : 'currency'
+                                            , 'object_data' : self.RECORD })
+                               , content_type='application/json' )
+
+    def test_flush_on_time(self):
+        queue = self.queue(10, 5, 0.2)
+        self.put(queue)
+        self.assertLess(self.flushed(queue, 1), 1.5)
+        self.assertEqual(0, queue.stats()['depth'])
+        self.assertEqual(1, models.Currency.objects.count())
+
+    def test_flush_on_size(self):
+        queue = self.queue(10, 2, 60)
+        self.put(queue, 2)
+        self.assertLess(self.flushed(queue, 2), 1.5)
+        self.assertEqual(2, models.Currency.objects.count())
+
+    def test_full(self):
+        queue = self.queue(1, 10, 60)
+        with mock.patch.object(ingest, '_queue', queue):
+            self.assertEqual(202, self.post().status_code)
+            response = self.post()
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('1', response['Retry-After'])
+        self.assertEqual(1, queue.stats()['refused'])
+
+    def test_close(self):
+        queue = self.queue(10, 10, 60)
+        self.put(queue, 3)
+        queue.close()
+        self.assertEqual(3, queue.stats()['flushed'])
+        self.assertEqual(3, models.Currency.objects.count())
+        with self.assertRaises(ingest.Closed):
+            self.put(queue)
+        with mock.patch.object(ingest, '_queue', queue):
+            response = self.post()  # written at once
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(4, models.Currency.objects.count())
+
+
+@override_settings( ROOT_URLCONF=__name__, HQ_DW_CACHE='hq_stage'
+                  , CACHES={ 'default' : { 'BACKEND' : LOCMEM }
+                           , 'hq_stage' : { 'BACKEND' : LOCMEM
+                                          , 'LOCATION' : 'hq_stage' } } )
+class CacheTest(Loading, TransactionTestCase):
+    '''
+    The versions are bumped when the transaction commits, a TestCase never
+    commits.
+    '''
+    def summary(self):
+        response = self.client.get('/stage/batch/%i/summary/' % self.batch.id)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_changes_are_seen(self):
+        seen = [ self.summary() ]
+        self.assertEqual(seen[-1], self.summary())
+        self.assertGreater(caching.stats()['page']['hits'], 0)
+        self.load('currency', CURRENCIES)
+        seen.append(self.summary())
+        self.assertEqual(3, seen[-1]['tables']['currency']['pending'])
+        # behind the back of the cache nothing changes
+        models.BatchSummary.objects.update(pending=0)
+        self.assertEqual(seen[-1], self.summary())
+        models.BatchSummary.reconcile(models.Currency, self.batch.id)
+        states.set_state('processed', tables=['currency'], batch=self.batch.id)
+        seen.append(self.summary())
+        self.assertEqual(3, seen[-1]['tables']['currency']['processed'])
+        self.batch.processed = True
+        self.batch.save()
+        seen.append(self.summary())
+        self.assertTrue(seen[-1]['processed'])
+        archive.archive('table', days=0, batch=self.batch.id, pause=0)
+        seen.append(self.summary())
+        self.assertNotIn('currency', seen[-1]['tables'])
+        for before, after in zip(seen, seen[1:]):
+            self.assertNotEqual(before, after)
+
+
+class LoaddTest(SimpleTestCase):
+    '''
+    The protocol of the load daemon, on pairs of connected sockets.
+    '''
+    def setUp(self):
+        self.fds = []
+        self.sockets = []
+
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+        for sock in self.sockets:
+            sock.close()
+
+    def socketpair(self):
+        pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sockets.extend(pair)
+        return pair
+
+    def foreign(self):
+        '''
+        The other end of every socket is another user.
+        '''
+        return mock.patch.object( loadd, 'peer_uid'
+                                , return_value=os.getuid() + 1 )
+
+    def pipe(self):
+        r, w = os.pipe()
+        self.fds.extend([r, w])
+        return r, w
+
+    def test_framing(self):
+        client, server = self.socketpair()
+        r, w = self.pipe()
+        request = { 'tool' : 'load-table' , 'cwd' : '/tmp'
+                  , 'argv' : [ '-t', 'offer', '-f', 'x' * 100000 ] }
+        sender = threading.Thread( target=loadd.send_request
+                                 , args=(client, request, [r, w, w]) )
+        sender.start()
+        received, fds = loadd.receive_request(server)
+        sender.join()
+        self.fds.extend(fds)
+        self.assertEqual(request, received)
+        self.assertEqual(loadd.FDS, len(fds))
+        # the very same pipe, not a copy of what was in it
+        os.write(fds[2], b'job output')
+        self.assertEqual(b'job output', os.read(r, 100))
+        os.write(w, b'x')
+        self.assertEqual(b'x', os.read(fds[0], 1))
+
+    def test_hang_up(self):
+        client, server = self.socketpair()
+        r, w = self.pipe()
+        client.sendmsg( [ b'{' ]
+                      , [ ( socket.SOL_SOCKET, socket.SCM_RIGHTS
+                          , array.array('i', [r, w, w]) ) ] )
+        client.close()
+        with self.assertRaises(EOFError):
+            loadd.receive_request(server)
+
+    def test_unknown_tool(self):
+        client, server = self.socketpair()
+        r, w = self.pipe()
+        loadd.send_request(client, { 'tool' : 'rm' , 'argv' : [] }, [r, w, w])
+        with mock.patch.object(loadd, 'run') as run:
+            loadd.handle(server)
+        self.assertFalse(run.called)
+        self.assertEqual({ 'exit' : 2 }, json.loads(client.recv(100)))
+
+    def test_peer_uid(self):
+        client, server = self.socketpair()
+        self.assertEqual(os.getuid(), loadd.peer_uid(client))
+        self.assertEqual(os.getuid(), loadd.peer_uid(server))
+
+    def test_foreign_client_is_dropped(self):
+        client, server = self.socketpair()
+        r, w = self.pipe()
+        loadd.send_request( client, { 'tool' : 'load-table' , 'argv' : [] }
+                          , [r, w, w] )
+        with self.foreign(), mock.patch.object(loadd, 'run') as run:
+            loadd.handle(server)
+        self.assertFalse(run.called)
+        self.assertEqual([], select.select([client], [], [], 0)[0])
+
+    def test_foreign_daemon_is_refused(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'hqs-loadd.sock')
+        self.assertIsNone(loadd.client('print-errors', [], path))
+        listener = loadd.bind(path)
+        self.sockets.append(listener)
+        with self.foreign():
+            with self.assertRaises(loadd.Untrusted):
+                loadd.client('print-errors', ['-c'], path)
+        conn, addr = listener.accept()
+        self.sockets.append(conn)
+        self.assertEqual(b'', conn.recv(100))  # nothing was sent
@@ -5,7 +5,11 @@ from . import views
 
 app_name = 'hq_stage'
 urlpatterns = [
-      url( r'^batch/(?P<pk>\d+)/'
+      url( r'^batch/(?P<pk>\d+)/summary/$'
+         , views.BatchSummaryView.as_view()
+         , name='batch_summary'
+         )
+    , url( r'^batch/(?P<pk>\d+)/'
          , views.BatchView.as_view()
          , name='batch'
          )
@@ -37,6 +41,22 @@ urlpatterns = [
          , views.OfferListView.as_view()
          , name='offer_list'
          )
+    , url( r'^upload-api/bulk/$'
+         , views.BulkUploadView.as_view()
+         , name='bulk_api'
+         )
+    , url( r'^upload-api/stats/$'
+         , views.UploadStatsView.as_view()
+         , name='api_stats'
+         )
+    , url( r'^state-api/$'
+         , views.SetStateView.as_view()
+         , name='state_api'
+         )
+    , url( r'^cache-stats/$'
+         , views.CacheStatsView.as_view()
+         , name='cache_stats'
+         )
     , url( r'^upload-api/$'
          , views.UploadView.as_view()
          , name='api'
@@ -1,37 +1,7 @@
 # Do not import models here because these procedures are used from command line
 # scripts.  Pass the model class as an argument instead.
 
-def zip_default(keys, values, default=' '):
-    '''
-    Zips two lists into a dictionary.  But, contrary to plain `zip`, if the
-    list containing the keys is longer then the list containing the values add
-    the `default` value as the value for the remaining keys.
-    '''
-    while len(keys) > len(values):
-        values.append(default)
-    return dict(zip(keys, values))
-
-def diff_list(left, right):
-    '''
-    Compute set difference of lists, but keeps the order of fields in the left
-    operand (a real set difference would ignore order).
-    '''
-    for i in right:
-        if i in left:
-            left.remove(i)
-    return left
-
-def remove_abstract_fields(cls, abs, extra=None):
-    '''
-    Remove the abstract model fields from a subclass of it.
-
-    Accept extra fields to remove too.
-    '''
-    fields = list(map(lambda x: x.name, cls._meta.get_fields()))
-    ignore = list(map(lambda x: x.name, abs._meta.get_fields()))
-    if extra:
-        ignore += extra
-    return diff_list(fields, ignore)
+import json, codecs
 
 def get_model(model, pk=None):
     '''
@@ -69,3 +39,83 @@ def get_new_model(model, pk=None):
         inst = model()
     return inst
 
+
+def iter_ndjson(lines):
+    '''
+    Parse newline delimited JSON, one value per line, from an iterator of
+    lines (e.g. a request body).  Yields the line number and either the value
+    or the `ValueError` describing why the line could not be parsed.  Blank
+    lines are skipped.
+    '''
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            if bytes == type(line):
+                line = line.decode('utf-8')
+            yield lineno, json.loads(line)
+        except ValueError as e:
+            yield lineno, e
+
+def iter_json_array(read, size=1 << 16, limit=1 << 20):
+    '''
+    Incrementally parse a JSON array from a `read(size)` function (e.g. the
+    read method of a request), without holding more than a few buffers of it
+    in memory.  Yields the position of each element (starting at 1) and its
+    value.  If the array itself is malformed a `ValueError` is raised after
+    yielding the elements parsed so far, we cannot resynchronise after a
+    syntax error.  An element longer than `limit` characters is considered
+    malformed too.
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    eof = False
+    idx = 0
+
+    def more(buf, idx):
+        # drop what we have already parsed and append the next piece
+        data = read(size)
+        return buf[idx:] + utf8.decode(data, final=not data), 0, not data
+
+    def skip(buf, idx, eof):
+        # skip white space, reading more if needed
+        while True:
+            while idx < len(buf) and buf[idx] in ' \t\r\n':
+                idx += 1
+            if idx < len(buf) or eof:
+                return buf, idx, eof
+            buf, idx, eof = more(buf, idx)
+
+    buf, idx, eof = skip(buf, idx, eof)
+    if not buf[idx:idx+1] == '[':
+        raise ValueError('expected a JSON array')
+    buf, idx, eof = skip(buf, idx + 1, eof)
+    if buf[idx:idx+1] == ']':
+        return
+    pos = 0
+    while True:
+        pos += 1
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, idx)
+            except ValueError:
+                end = None
+            if end is not None:
+                # a number may continue in the next piece, only trust the
+                # value if we can see what follows it
+                follow = end
+                while follow < len(buf) and buf[follow] in ' \t\r\n':
+                    follow += 1
+                if eof or buf[follow:follow+1] in (',', ']'):
+                    break
+            if eof or len(buf) - idx > limit:
+                raise ValueError('malformed element %i' % pos)
+            buf, idx, eof = more(buf, idx)
+        yield pos, value
+        buf, idx, eof = skip(buf, end, eof)
+        if buf[idx:idx+1] == ']':
+            return
+        if not buf[idx:idx+1] == ',':
+            raise ValueError('expected , or ] after element %i' % pos)
+        buf, idx, eof = skip(buf, idx + 1, eof)
@@ -0,0 +1,210 @@
+'''
+Validation of the rows as they are loaded.
+
+Every column of the staging tables is a VARCHAR(255), anything goes in, and a
+price that is not a number or a date that is not a date only shows up when the
+upload to the warehouse fails.  The rules here catch most of that at load
+time: the rows that break a rule are inserted in error (see `DataRow`) with
+the offending fields listed in `fields_in_error`, ready for `hqs-print-errors`
+and `hqs-set-state`.
+
+The rules are declared per table in `RULES`, a list of fields and checks.  The
+chunks are checked column by column, never row by row: a check gets the
+distinct values of a column and returns the bad ones.  Where possible a check
+looks at all the values of the column joined together, with a single regular
+expression or string method call, and only goes through the values one by one
+if that fails.  Many columns repeat their values (dates, flags, codes) and
+only the rows of a column with a bad value are looked at one by one, so this
+costs a small fraction of the insert.
+
+Do not import models here.
+'''
+
+import re, datetime, functools
+
+
+def is_ascii(value):
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+class Pattern(object):
+    '''
+    The whole value must match the regular expression.
+    '''
+    def __init__(self, regex):
+        self.regex = re.compile(regex, re.ASCII)
+        self.all = re.compile('(?:%s\n)*' % regex, re.ASCII)
+        self.lines = re.compile('^(?:%s)$' % regex, re.ASCII | re.MULTILINE)
+
+    def good(self, values):
+        joined = '\n'.join(values)
+        # a value with a newline would pass as two values
+        if ( joined.count('\n') + 1 == len(values)
+             and self.all.fullmatch(joined + '\n') ):
+            return values
+        # and it never makes it whole into the good lines either
+        return set(self.lines.findall(joined))
+
+    def bad(self, values):
+        return values - self.good(values)
+
+
+class Digits(object):
+    '''
+    A non negative integer of up to `size` digits.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.pattern = Pattern(r'\d{1,%i}' % size)
+
+    def bad(self, values):
+        joined = ''.join(values)
+        if not is_ascii(joined):
+            return self.pattern.bad(values)  # str.isdigit() takes any digit
+        size = self.size
+        if ( joined.isdigit() and not '' in values
+             and max(map(len, values)) <= size ):
+            return set()
+        return set(x for x in values if not x.isdigit() or len(x) > size)
+
+
+DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})', re.ASCII)
+
+@functools.lru_cache(maxsize=4096)
+def is_date(value):
+    '''
+    Whether the value is a day of the calendar as YYYY-MM-DD.
+    '''
+    match = DATE.fullmatch(value)
+    if match is None:
+        return False
+    try:
+        datetime.date(*map(int, match.groups()))
+    except ValueError:
+        return False
+    return True
+
+
+class Date(object):
+    '''
+    A day as YYYY-MM-DD, there are only so many days in the files and they
+    are checked once each.
+    '''
+    def bad(self, values):
+        return set(x for x in values if not is_date(x))
+
+
+class Timestamp(Pattern):
+    '''
+    A day and a time as YYYY-MM-DD HH:MM:SS.
+    '''
+    def __init__(self):
+        super(Timestamp, self).__init__(
+            r'\d{4}-\d{2}-\d{2} (?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d' )
+
+    def bad(self, values):
+        good = self.good(values)
+        bad = values - good
+        days = set(x[:10] for x in good)
+        wrong = set(x for x in days if not is_date(x))
+        if wrong:
+            bad.update(x for x in good if x[:10] in wrong)
+        return bad
+
+
+class OneOf(object):
+    '''
+    One of the given values.
+    '''
+    def __init__(self, *choices):
+        self.choices = frozenset(choices)
+
+    def bad(self, values):
+        return values - self.choices
+
+
+class Text(object):
+    '''
+    Blank, or anything but blank if `required`.  The loader pads missing
+    fields with a space.
+    '''
+    def __init__(self, required=True):
+        self.required = required
+
+    def bad(self, values):
+        return set(x for x in values if bool(x.strip()) != self.required)
+
+
+integer = Digits(18)  # fits in 64 bits
+decimal = Pattern(r'-?\d{1,15}(?:\.\d{1,6})?')  # no thousands separators
+currency_code = Pattern(r'[A-Z]{3}')  # the shape of ISO 4217 codes
+date = Date()
+timestamp = Timestamp()
+flag = OneOf('0', '1')
+text = Text()
+blank = Text(required=False)  # e.g. a column that catches long rows
+
+
+RULES = {
+      'currency' : [
+          ( 'external_id' , integer )
+        , ( 'currency_code' , currency_code )
+        , ( 'currency_name' , text )
+        ]
+    , 'exchange-rate' : [
+          ( 'external_id' , integer )
+        , ( 'primary_currency_id' , integer )
+        , ( 'secondary_currency_id' , integer )
+        , ( 'date_valid' , date )
+        , ( 'currency_rate' , decimal )
+        ]
+    , 'offer' : [
+          ( 'external_id' , integer )
+        , ( 'hotel_id' , integer )
+        , ( 'currency_id' , integer )
+        , ( 'source_system_code' , text )
+        , ( 'available_cnt' , integer )
+        , ( 'selling_price' , decimal )
+        , ( 'checkin_date' , date )
+        , ( 'checkout_date' , date )
+        , ( 'valid_offer_flag' , flag )
+        , ( 'offer_valid_from' , date )
+        , ( 'offer_valid_to' , date )
+        , ( 'breakfast_included_flag' , flag )
+        , ( 'external_insert_datetime' , timestamp )
+        , ( 'dummy_field' , blank )
+        ]
+    }
+
+
+class Validator(object):
+    '''
+    Checks the rows of a table, `positions` maps the fields of the rules to
+    their positions in a row.
+    '''
+    def __init__(self, table, positions):
+        self.rules = [ (name, check, positions[name])
+                       for name, check in RULES.get(table, []) ]
+
+    def errors(self, rows):
+        '''
+        A dictionary from the position of every bad row to the list of its
+        bad fields.
+        '''
+        errors = {}
+        if not rows or not self.rules:
+            return errors
+        columns = list(zip(*rows))
+        for name, check, pos in self.rules:
+            column = columns[pos]
+            bad = check.bad(set(column))
+            if not bad:
+                continue
+            for i, x in enumerate(column):
+                if x in bad:
+                    errors.setdefault(i, []).append(name)
+        return errors
@@ -1,44 +1,186 @@
 from django.views import generic
-from django import http
+from django import http, shortcuts
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.middleware.csrf import CsrfViewMiddleware
+from django.contrib import auth
+from django.conf import settings
 
-import json
+import hmac, json
 
-from . import models, util
+from . import models, util, loader, ingest, pagination, states, caching
+from . import sizing
 
 
 class DocView(generic.TemplateView):
     template_name = 'hq_stage/doc.html'
 
 
-class HqStageListView(generic.ListView):
+class CachedPageMixin(object):
+    '''
+    Serve the page from the cache if we have it (see the `caching` module).
+    A page is cached as of the version of the batch returned by `cache_batch`,
+    or of all batches if that is None, so it is rendered again as soon as the
+    data it shows changes.  Only successful GET requests are cached, and never
+    pages with forms since these carry a CSRF token.
+    '''
+    def cache_batch(self):
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        if 'GET' != request.method:
+            return super(CachedPageMixin, self).dispatch(
+                request, *args, **kwargs )
+        user = getattr(request, 'user', None)
+        name = '%s|%s' % (request.get_full_path(), getattr(user, 'pk', None))
+        key, entry = caching.lookup('page', name, self.cache_batch())
+        if entry is not None:
+            return http.HttpResponse(entry[0], content_type=entry[1])
+        response = super(CachedPageMixin, self).dispatch(
+            request, *args, **kwargs )
+        if key is not None and 200 == response.status_code:
+            if hasattr(response, 'render'):
+                response.render()
+            caching.store(key, (response.content, response['Content-Type']))
+        return response
+
+
+class HqStageListView(CachedPageMixin, generic.ListView):
+    '''
+    Lists are paginated by primary key (see the `pagination` module), the
+    `page` parameter is a token and not a page number, so a deep page is as
+    quick as the first one.  The count of rows is an estimate unless
+    `HQ_DW_LIST_COUNT` is set to `exact` (or to None for no count at all).
+
+    The rows can be filtered with query parameters, see `get_filters`.
+    '''
     template_name = 'hq_main/list.html'
     context_object_name = 'object_list'
     paginate_by = 12  # I just like the number 12
 
+    def get_filters(self):
+        return {}
+
+    def get_queryset(self):
+        qs = super(HqStageListView, self).get_queryset()
+        try:
+            return qs.filter(**self.get_filters())
+        except ValueError:
+            raise http.Http404('Invalid filter')
+
+    def count_rows(self, queryset):
+        '''
+        The count is the same on every page of a list, we cache it.
+        '''
+        mode = getattr(settings, 'HQ_DW_LIST_COUNT', 'approx')
+        name = 'count:%s:%s:%s' % ( self.model._meta.label, mode
+                                  , sorted(self.get_filters().items()) )
+        return caching.memoize( name, self.cache_batch()
+                              , lambda: pagination.count_rows(queryset, mode) )
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = pagination.KeysetPaginator(
+            queryset, page_size, self.count_rows )
+        try:
+            page = paginator.page(self.request.GET.get(self.page_kwarg))
+        except pagination.InvalidToken:
+            raise http.Http404('Invalid page')
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def page_url(self, token):
+        query = self.request.GET.copy()
+        query[self.page_kwarg] = token
+        return '?' + query.urlencode()
+
+    def get_context_data(self, **kwargs):
+        context = super(HqStageListView, self).get_context_data(**kwargs)
+        page = context['page_obj']
+        if page.has_next():
+            context['next_url'] = self.page_url(page.next_page_number())
+        if page.has_previous():
+            context['prev_url'] = self.page_url(page.previous_page_number())
+        return context
+
 
 class BatchListView(HqStageListView):
+    '''
+    Filter with `?processed=0` or `?processed=1`.
+    '''
     model = models.Batch
 
+    def get_filters(self):
+        processed = self.request.GET.get('processed')
+        if processed in ('0', '1'):
+            return { 'processed' : '1' == processed }
+        return {}
+
 
-class CurrencyListView(HqStageListView):
+class DataRowListView(HqStageListView):
+    '''
+    Filter with `?batch=<batch>` and `?state=<state>`, the state is one of
+    `pending`, `processed`, `in_error` or `ignored` (see `DataRow`).
+    '''
+    def cache_batch(self):
+        try:
+            return int(self.request.GET.get('batch'))
+        except (TypeError, ValueError):
+            return None
+
+    def get_filters(self):
+        filters = {}
+        batch = self.request.GET.get('batch')
+        if batch:
+            filters['batch_id'] = int(batch)
+        state = self.request.GET.get('state')
+        if state:
+            if not state in models.ROW_STATES:
+                raise ValueError(state)
+            filters.update(models.ROW_STATES[state])
+        return filters
+
+
+class CurrencyListView(DataRowListView):
     model = models.Currency
 
 
-class ExchangeListView(HqStageListView):
+class ExchangeListView(DataRowListView):
     model = models.ExchangeRate
 
 
-class OfferListView(HqStageListView):
+class OfferListView(DataRowListView):
     model = models.Offer
 
 
-class BatchView(generic.DetailView):
+class BatchView(CachedPageMixin, generic.DetailView):
     model = models.Batch
     template_name = 'hq_stage/batch.html'
     context_object_name = 'batch'
 
+    def cache_batch(self):
+        return int(self.kwargs['pk'])
+
+
+class BatchSummaryView(CachedPageMixin, generic.View):
+    '''
+    The number of rows of a batch in each state, per table, as JSON.  Read
+    from the `BatchSummary` (and cached) so it is cheap enough to be polled
+    by monitoring.
+    '''
+    def cache_batch(self):
+        return int(self.kwargs['pk'])
+
+    def get(self, request, *args, **kwargs):
+        batch = shortcuts.get_object_or_404(models.Batch, pk=kwargs['pk'])
+        tables = {}
+        for summary in batch.summary_set.all():
+            tables[summary.table] = dict(
+                (x, getattr(summary, x)) for x in models.ROW_STATES )
+        return http.JsonResponse({
+              'batch' : batch.id
+            , 'processed' : batch.processed
+            , 'tables' : tables
+            })
+
 
 class CurrencyUpdateView(generic.edit.UpdateView):
     model = models.Currency
@@ -80,9 +222,8 @@ class UploadView(generic.View):
 
     Current issues:
 
-    *   Only a single record can be uploaded at a time.  Adding a list upload
-        should not be hard but it will need a lot of checking code to ensure
-        that people do not upload mixed lists.
+    *   Only a single record can be uploaded at a time, use `BulkUploadView`
+        to upload many records of the same type.
 
     *   This has not been tested at all, it is probably buggy as hell.
 
@@ -100,6 +241,11 @@ class UploadView(generic.View):
     And response
 
     { 'batch' 3 }  // if the batch was reused, otherwise a new number
+
+    If `HQ_DW_UPLOAD_BUFFER` is set the record is only validated and queued,
+    the response is then 202 and the record is written to the database by the
+    background flusher of the `ingest` module.  When the queue is full the
+    response is 503 with a Retry-After header.
     '''
     ALLOWED_OBJECTS = {
           'currency' : models.Currency
@@ -124,13 +270,31 @@ class UploadView(generic.View):
             return http.HttpResponseBadRequest()  # 400
         if not dict == type(object_data):
             return http.HttpResponseBadRequest()  # 400
-        if str == type(object_type):
+        if not str == type(object_type):
             return http.HttpResponseBadRequest()  # 400
         if not object_type in self.ALLOWED_OBJECTS:
             return http.HttpResponseBadRequest()  # 400
         batch = util.get_new_model(models.Batch, batchno)
         if not batch:
             return http.HttpResponseBadRequest()  # 400
+        buffered = ingest.get_queue()
+        if buffered:
+            try:
+                row = loader.TABLES[object_type].from_record(object_data)
+            except ValueError:
+                return http.HttpResponseBadRequest()  # 400
+            if batch.pk is None:
+                batch.save()
+            try:
+                buffered.put(object_type, batch.id, row)
+                return http.JsonResponse({'batch': batch.id}, status=202)
+            except ingest.Full:
+                response = http.HttpResponse(status=503)
+                response['Retry-After'] = str(
+                    getattr(settings, 'HQ_DW_UPLOAD_RETRY_AFTER', 1) )
+                return response
+            except ingest.Closed:
+                pass  # shutting down, fall back to a synchronous insert
         try:
             obj = self.ALLOWED_OBJECTS[object_type](
                   batch=batch
@@ -140,6 +304,240 @@ class UploadView(generic.View):
             return http.HttpResponseBadRequest()  # 400
         # there are almost no foreign keys here, this is rather safe
         batch.save()
+        obj.batch = batch  # a new batch only got its id now
         obj.save()
         return http.JsonResponse({'batch': batch.id})
 
+
+
+class UploadStatsView(generic.View):
+    '''
+    Queue depth and flush latency of the buffered upload API in this process.
+    '''
+    def get(self, request, *args, **kwargs):
+        buffered = ingest.get_queue()
+        if not buffered:
+            return http.JsonResponse({'enabled': False})
+        stats = buffered.stats()
+        stats['enabled'] = True
+        return http.JsonResponse(stats)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BulkUploadView(generic.View):
+    '''
+    Bulk version of the upload API.  The object type (and the batch, which is
+    optional) go in the query string and the body is either newline delimited
+    JSON, one object per line, or a JSON array of objects (when the content
+    type is `application/json`).  All objects are of the same type and go into
+    a single batch.
+
+    The body is parsed as it is read and the objects are inserted every
+    `HQ_DW_COMMIT_SIZE` records, the size of an upload is not limited by
+    memory.
+    Every record is checked against the fields of the model, invalid records
+    are rejected one by one and the remaining ones are inserted.  A malformed
+    JSON array cannot be parsed any further, the records before the error are
+    kept.
+
+    Example request:
+
+    POST /upload-api/bulk/?object_type=currency&batch=3
+    Content-Type: application/x-ndjson
+
+    { "external_id" : "3", "currency_code" : "GBP", "currency_name" : "Pound" }
+    { "external_id" : "4", "currency_code" : "EUR", "currency_nam" : "Euro" }
+
+    And response
+
+    { "batch" : 3
+    , "accepted" : 1
+    , "rejected" :
+        [ { "line" : 2 , "reason" : "unknown fields: currency_nam" } ]
+    , "rejected_count" : 1
+    }
+
+    For a JSON array `line` is the position of the object in the array.  Only
+    the first `MAX_REJECTED` rejections are listed.
+    '''
+    MAX_REJECTED = 1000
+
+    def get(self, request, *args, **kwargs):
+        return http.HttpResponseForbidden()  # 403
+
+    def post(self, request, *args, **kwargs):
+        object_type = request.GET.get('object_type')
+        if not object_type in loader.TABLES:
+            return http.HttpResponseBadRequest()  # 400
+        batch = util.get_new_model(models.Batch, request.GET.get('batch'))
+        if not batch:
+            return http.HttpResponseBadRequest()  # 400
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if content_type.startswith('application/json'):
+            records = util.iter_json_array(request.read)
+        else:
+            records = util.iter_ndjson(request)
+        batch.save()
+        spec = loader.TABLES[object_type]
+        build, insert = spec.compile(batch, loader.now())
+        commit_num = sizing.fixed_size()
+        accepted = 0
+        rejected = []
+        rejected_count = 0
+        chunk = []
+        error = None
+        try:
+            for line, data in records:
+                try:
+                    if isinstance(data, ValueError):
+                        raise ValueError('malformed JSON')
+                    chunk.append(spec.from_record(data))
+                except ValueError as e:
+                    rejected_count += 1
+                    if len(rejected) < self.MAX_REJECTED:
+                        rejected.append({ 'line' : line , 'reason' : str(e) })
+                if len(chunk) == commit_num:
+                    insert(build(chunk))
+                    accepted += len(chunk)
+                    chunk = []
+        except ValueError as e:
+            error = str(e)
+        insert(build(chunk))
+        accepted += len(chunk)
+        response = {
+              'batch' : batch.id
+            , 'accepted' : accepted
+            , 'rejected' : rejected
+            , 'rejected_count' : rejected_count
+            }
+        if error:
+            response['error'] = error
+        return http.JsonResponse(response)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class SetStateView(generic.View):
+    '''
+    API version of `hqs-set-state`, moves the rows of a batch or of a table
+    to another state in chunked updates (see the `states` module).  The state
+    is required, and so is a batch or an object type (or both).  The source
+    state, a pattern to look for in the fields in error and a dry run are
+    optional.
+
+    Example request:
+
+    POST /state-api/
+
+    { "state" : "ignored"
+    , "from" : "in_error"
+    , "object_type" : "offer"
+    , "batch" : 3
+    , "fields_in_error" : "hotel_id"
+    , "dry_run" : false
+    }
+
+    And response
+
+    { "state" : "ignored"
+    , "dry_run" : false
+    , "counts" : { "offer" : { "in_error" : 300000 } }
+    , "total" : 300000
+    }
+
+    A transition not allowed by the state machine of `DataRow` is answered
+    with a 400 and the reason in `error`.
+
+    Any client can change a whole table with one request, so the request
+    must carry the token of the `HQ_DW_STATE_API_TOKEN` setting in an
+    `Authorization: Bearer <token>` header, or come from a logged in user
+    allowed to change the rows of the tables (with a CSRF token, as a form
+    would).  Anything else is answered with a 403.
+    '''
+    def token(self, request):
+        '''
+        Whether the request carries the right token, None if it carries none.
+        '''
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        if not header.startswith('Bearer '):
+            return None
+        token = getattr(settings, 'HQ_DW_STATE_API_TOKEN', None)
+        given = header[len('Bearer '):].strip()
+        return bool(token) and hmac.compare_digest( given.encode('utf-8')
+                                                  , token.encode('utf-8') )
+
+    def session(self, request):
+        '''
+        The logged in user, if the request passes the CSRF check a form would,
+        or None.  The view is only exempt for the clients with a token.
+        '''
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            return None
+        if CsrfViewMiddleware().process_view(request, None, (), {}):
+            return None
+        return user
+
+    def permitted(self, user, tables):
+        '''
+        Whether the user may change the rows of all the tables.
+        '''
+        return user.has_perms([
+            '%s.%s' % ( x._meta.app_label
+                      , auth.get_permission_codename('change', x._meta) )
+            for x in [ loader.TABLES[t].model for t in tables ] ])
+
+    def get(self, request, *args, **kwargs):
+        return http.HttpResponseForbidden()  # 403
+
+    def post(self, request, *args, **kwargs):
+        token = self.token(request)
+        user = None if token is not None else self.session(request)
+        if not token and user is None:
+            return http.HttpResponseForbidden()  # 403
+        try:
+            json_data = json.loads(request.body)
+        except json.decoder.JSONDecodeError:
+            return http.HttpResponseBadRequest()  # 400
+        if not dict == type(json_data):
+            return http.HttpResponseBadRequest()  # 400
+        target = json_data.get('state')
+        source = json_data.get('from')
+        object_type = json_data.get('object_type')
+        batchno = json_data.get('batch')
+        pattern = json_data.get('fields_in_error')
+        dry_run = bool(json_data.get('dry_run'))
+        if not str == type(target):
+            return http.HttpResponseBadRequest()  # 400
+        if source is not None and not str == type(source):
+            return http.HttpResponseBadRequest()  # 400
+        if object_type is None and batchno is None:
+            return http.HttpResponseBadRequest()  # 400
+        if object_type is not None and not object_type in loader.TABLES:
+            return http.HttpResponseBadRequest()  # 400
+        if batchno is not None and not int == type(batchno):
+            return http.HttpResponseBadRequest()  # 400
+        if pattern is not None and not str == type(pattern):
+            return http.HttpResponseBadRequest()  # 400
+        tables = [object_type] if object_type else None
+        if user is not None \
+                and not self.permitted(user, tables or loader.TABLES):
+            return http.HttpResponseForbidden()  # 403
+        try:
+            counts = states.set_state( target, source, tables, batchno
+                                     , pattern, dry_run=dry_run )
+        except states.TransitionError as e:
+            return http.JsonResponse({'error': str(e)}, status=400)
+        return http.JsonResponse({
+              'state' : target
+            , 'dry_run' : dry_run
+            , 'counts' : counts
+            , 'total' : sum( sum(x.values()) for x in counts.values() )
+            })
+
+
+class CacheStatsView(generic.View):
+    '''
+    Hits, misses and hit rates of the cached pages and aggregates.
+    '''
+    def get(self, request, *args, **kwargs):
+        return http.JsonResponse(caching.stats())
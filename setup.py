@@ -29,6 +29,18 @@ REQS = [
 CONSOLE_SCRIPTS = [
       'hqs-load-table=hq_stage.command_line:load_table'
     , 'hqs-print-errors=hq_stage.command_line:print_errors'
+    , 'hqs-set-state=hq_stage.command_line:set_state'
+    , 'hqs-reconcile-summary=hq_stage.command_line:reconcile_summary'
+    , 'hqs-process-batch=hq_stage.command_line:process_batch'
+    , 'hqs-check-references=hq_stage.command_line:check_references'
+    , 'hqs-archive=hq_stage.command_line:archive'
+    , 'hqs-drop-batch=hq_stage.command_line:drop_batch'
+    , 'hqs-partition=hq_stage.command_line:partition'
+    , 'hqs-loadd=hq_stage.command_line:loadd'
+    , 'hqs-loadc=hq_stage.command_line:loadc'
+    , 'hqs-watch=hq_stage.command_line:watch'
+    , 'hqs-bench-queries=hq_stage.command_line:bench_queries'
+    , 'hqs-bench-load=hq_stage.command_line:bench_load'
     ]
 
 setup(
@@ -40,7 +52,7 @@ setup(
     , license          = hq_stage.__license__
     , url              = hq_stage.__url__
     , long_description = read('README')
-    , packages         = [ 'hq_stage' ]
+    , packages         = [ 'hq_stage' , 'hq_stage.benchmark' ]
     , classifiers      = CLS
     , install_requires = REQS
     , entry_points     = {